@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import argparse
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import InclinationCost
+from benchmark_utils import hill_terrain, check
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Concurrent rollouts of several callers sharing one DPhysics module '
+                                                 'against the sequential ones')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--n_callers', type=int, nargs='+', default=[1, 2, 4], help='Numbers of concurrent callers')
+    parser.add_argument('--n_sim_trajs', type=int, default=32, help='Number of trajectories of a caller')
+    parser.add_argument('--horizons', type=float, nargs='+', default=[3.0, 2.0, 4.0],
+                        help='Time horizons [sec] of the callers (cycled)')
+    parser.add_argument('--n_calls', type=int, default=3, help='Number of rollouts of a caller')
+    parser.add_argument('--backward', action='store_true',
+                        help='Backpropagate the path costs to the height maps in the calls, the gradients are checked')
+    return parser.parse_args()
+
+
+def benchmark():
+    args = arg_parser()
+    torch.manual_seed(0)
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.record_forces = None
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+
+    def caller(i):
+        """
+        Returns the config, height map and control inputs of the i-th caller (own horizon and terrain).
+        """
+        cfg = copy.deepcopy(dphys_cfg)
+        cfg.traj_sim_time = args.horizons[i % len(args.horizons)]
+        z_grid = hill_terrain(dphys_cfg, height=0.2 * (i + 1))
+        controls, _ = generate_controls(n_trajs=args.n_sim_trajs, time_horizon=cfg.traj_sim_time, dt=cfg.dt,
+                                        per_step=False)
+        return cfg, z_grid.to(args.device), controls.to(args.device)
+
+    def run(cfg, z_grid, controls):
+        results = []
+        for _ in range(args.n_calls):
+            z = z_grid.clone().requires_grad_(args.backward)
+            with torch.set_grad_enabled(args.backward):
+                states, _, info = dphysics.rollout(z, controls, dphys_cfg=cfg,
+                                                   costs={'inclination': InclinationCost()}, return_info=True)
+            if args.backward:
+                # the backward pass runs after the call, the per-call state of the module is reset
+                info['cost'].sum().backward()
+            states = tuple(s.detach() for s in states)
+            assert states[0].shape[1] == int(cfg.traj_sim_time / cfg.dt), 'The horizon of the caller is not kept'
+            results.append((states, info['cost'].detach(), z.grad))
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        return results
+
+    print(f'Concurrent rollouts: robot={args.robot}, device={args.device}, n_sim_trajs={args.n_sim_trajs}, '
+          f'horizons={args.horizons} [sec], {args.n_calls} calls per caller')
+    print(f'{"callers":>7} | {"sequential [sec]":>16} | {"concurrent [sec]":>16} | {"speedup":>7} | '
+          f'{"max state diff":>14} | {"max cost diff":>13} | {"max grad diff":>13}')
+    for n_callers in args.n_callers:
+        callers = [caller(i) for i in range(n_callers)]
+        t0 = time()
+        sequential = [run(*c) for c in callers]
+        t_seq = time() - t0
+
+        t0 = time()
+        with ThreadPoolExecutor(max_workers=n_callers) as pool:
+            concurrent = list(pool.map(lambda c: run(*c), callers))
+        t_conc = time() - t0
+
+        # the concurrent rollouts match the sequential ones of the same caller
+        state_diff, cost_diff, grad_diff = 0.0, 0.0, 0.0
+        for seq, conc in zip(sequential, concurrent):
+            for (states_seq, cost_seq, grad_seq), (states_conc, cost_conc, grad_conc) in zip(seq, conc):
+                state_diff = max([state_diff] + [(s - c).abs().max().item() for s, c in zip(states_seq, states_conc)])
+                cost_diff = max(cost_diff, (cost_seq - cost_conc).abs().max().item())
+                if args.backward:
+                    grad_diff = max(grad_diff, ((grad_seq - grad_conc).norm() / grad_seq.norm()).item())
+        grad = f'{grad_diff:13.2e}' if args.backward else f'{"-":>13}'
+        print(f'{n_callers:7d} | {t_seq:16.3f} | {t_conc:16.3f} | {t_seq / t_conc:7.2f} | '
+              f'{state_diff:14.2e} | {cost_diff:13.2e} | {grad}')
+        check({'state diff': state_diff, 'cost diff': cost_diff, 'grad diff': grad_diff}, tol=1e-5)
+        # the module config is not changed by the callers
+        assert dphysics.dphys_cfg is dphys_cfg and dphysics.rollout_state.dphys_cfg is None
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import argparse
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import GoalDistanceCost, InclinationCost
+from fusionforce.models.traj_predictor.control_optimizer import ControlOptimizer
+from benchmark_utils import timed
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Gradient-based control optimization from a few seeds against '
+                                                 'blind shooting of many random control inputs')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--n_shooting', type=int, nargs='+', default=[64, 256], help='Numbers of shooting rollouts')
+    parser.add_argument('--n_seeds', type=int, default=4, help='Number of the optimized seed control inputs')
+    parser.add_argument('--n_iters', type=int, default=10, help='Number of the gradient steps')
+    parser.add_argument('--lr', type=float, default=0.2, help='Learning rate of the gradient steps')
+    parser.add_argument('--control_dt', type=float, default=1.0,
+                        help='Duration of the optimized piecewise-constant control inputs [sec]')
+    parser.add_argument('--time_budget', type=float, default=None, help='Wall-clock budget of the optimization [sec]')
+    parser.add_argument('--goal', type=float, nargs=2, default=[3.0, 1.5], help='Goal position (x, y) [m]')
+    parser.add_argument('--traj_sim_time', type=float, default=5.0, help='Trajectory simulation time')
+    return parser.parse_args()
+
+
+def benchmark():
+    args = arg_parser()
+    torch.manual_seed(0)
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.traj_sim_time = args.traj_sim_time
+    dphys_cfg.record_forces = None
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+
+    # a hill between the robot and the goal
+    x_grid, y_grid = dphys_cfg.x_grid, dphys_cfg.y_grid
+    z_grid = 0.5 * torch.exp(-(x_grid - 1.5) ** 2 / 0.5) * torch.exp(-(y_grid - 0.75) ** 2 / 0.5)
+    z_grid = z_grid.unsqueeze(0).to(args.device)  # shared by all the trajectories
+    costs = {'goal': GoalDistanceCost(goal=args.goal), 'inclination': InclinationCost()}
+
+    print(f'Control optimization: robot={args.robot}, device={args.device}, goal={args.goal}, '
+          f'traj_sim_time={args.traj_sim_time} [sec]')
+    print(f'{"method":>24} | {"rollouts":>8} | {"time [sec]":>10} | {"best cost":>9}')
+
+    def shooting(n_trajs):
+        controls, _ = generate_controls(n_trajs=n_trajs, time_horizon=args.traj_sim_time, dt=dphys_cfg.dt,
+                                        per_step=False)
+        with torch.no_grad():
+            _, _, info = dphysics(z_grid=z_grid, controls=controls.to(args.device), costs=costs, return_info=True)
+        return info['cost']
+
+    for n_trajs in args.n_shooting:
+        cost, t = timed(lambda: shooting(n_trajs), args.device)
+        print(f'{"shooting":>24} | {n_trajs:8d} | {t:10.3f} | {cost.min().item():9.4f}')
+
+    optimizer = ControlOptimizer(dphysics, costs, n_iters=args.n_iters, lr=args.lr,
+                                 time_budget=args.time_budget, control_dt=args.control_dt)
+    seeds, _ = generate_controls(n_trajs=args.n_seeds, time_horizon=args.traj_sim_time, dt=dphys_cfg.dt,
+                                 per_step=False)
+    (_, info), t = timed(lambda: optimizer.optimize(z_grid, seeds), args.device)
+    n_rollouts = args.n_seeds * info['n_evals']
+    print(f'{"seeds":>24} | {args.n_seeds:8d} | {"":>10} | {info["costs"][:, 0].min().item():9.4f}')
+    method = f'gradient ({info["n_evals"] - 1} steps)'
+    print(f'{method:>24} | {n_rollouts:8d} | {t:10.3f} | {info["cost"].min().item():9.4f}')
+
+
+if __name__ == '__main__':
+    benchmark()
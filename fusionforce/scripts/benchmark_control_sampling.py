@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import argparse
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Coverage of the control space and of the reachable positions '
+                                                 'by the random, low-discrepancy and lattice control inputs')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--samplings', type=str, nargs='+', default=['random', 'sobol', 'halton', 'lattice'],
+                        help='Sampling modes of generate_controls')
+    parser.add_argument('--n_sim_trajs', type=int, nargs='+', default=[8, 16, 32, 64], help='Numbers of trajectories')
+    parser.add_argument('--n_knots', type=int, default=1, help='Number of knots of the time-varying control inputs')
+    parser.add_argument('--n_reference', type=int, default=1024,
+                        help='Number of the reference trajectories covering the reachable positions')
+    parser.add_argument('--n_seeds', type=int, default=4, help='Number of random seeds of the random sampling')
+    parser.add_argument('--traj_sim_time', type=float, default=3.0, help='Trajectory simulation time')
+    return parser.parse_args()
+
+
+def coverage(reference, samples):
+    """
+    Returns the max and mean distance of the reference points to the nearest sample (coverage radius).
+    """
+    dists = torch.cdist(reference, samples).min(dim=1).values
+    return dists.max().item(), dists.mean().item()
+
+
+def benchmark():
+    args = arg_parser()
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.traj_sim_time = args.traj_sim_time
+    dphys_cfg.record_forces = None
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+    z_grid = torch.zeros((1,) + dphys_cfg.x_grid.shape, device=args.device)  # flat terrain
+    v_range = (-dphys_cfg.vel_max, dphys_cfg.vel_max)
+    w_range = (-dphys_cfg.omega_max, dphys_cfg.omega_max)
+    control_scale = torch.tensor([v_range[1] - v_range[0], w_range[1] - w_range[0]])
+
+    def sample(n_trajs, sampling, seed=None):
+        """
+        Returns the normalized control inputs (knots) and the trajectory end positions (x, y).
+        """
+        if seed is not None:
+            torch.manual_seed(seed)
+        controls, _ = generate_controls(n_trajs=n_trajs, time_horizon=args.traj_sim_time, dt=dphys_cfg.dt,
+                                        v_range=v_range, w_range=w_range, sampling=sampling, n_knots=args.n_knots,
+                                        seed=seed if sampling != 'random' else None)
+        # the control inputs at the knots (evenly spaced time steps) normalized to the unit ranges
+        knots = torch.linspace(0, controls.shape[1] - 1, args.n_knots).long()
+        u = (controls[:, knots] / control_scale).view(n_trajs, -1)
+        with torch.no_grad():
+            states, _ = dphysics(z_grid=z_grid, controls=controls.to(args.device))
+        return u, states[0][:, -1, :2].cpu()
+
+    u_ref, x_ref = sample(args.n_reference, 'sobol', seed=12345)
+
+    print(f'Control sampling coverage: robot={args.robot}, n_knots={args.n_knots}, '
+          f'traj_sim_time={args.traj_sim_time} [sec], {args.n_reference} reference trajectories')
+    print(f'{"sampling":>8} | {"trajs":>5} | {"controls cover max":>18} | {"controls cover mean":>19} | '
+          f'{"end pos cover max [m]":>21} | {"end pos cover mean [m]":>22}')
+    for sampling in args.samplings:
+        if sampling == 'lattice' and args.n_knots > 1:
+            continue  # constant control inputs only
+        for n_trajs in args.n_sim_trajs:
+            # the random sampling is averaged over the seeds, the other ones are deterministic
+            seeds = range(args.n_seeds) if sampling == 'random' else [None]
+            results = []
+            for seed in seeds:
+                u, x = sample(n_trajs, sampling, seed=seed)
+                results.append(coverage(u_ref, u) + coverage(x_ref, x))
+            c = [sum(r) / len(results) for r in zip(*results)]
+            print(f'{sampling:>8} | {n_trajs:5d} | {c[0]:18.3f} | {c[1]:19.3f} | {c[2]:21.3f} | {c[3]:22.3f}')
+
+
+if __name__ == '__main__':
+    benchmark()
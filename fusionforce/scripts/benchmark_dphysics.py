@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import argparse
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from benchmark_utils import timed, hill_terrain, check
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Benchmark of the fixed-step DPhysics rollout')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to run the rollouts on')
+    parser.add_argument('--n_sim_trajs', type=int, nargs='+', default=[64, 256, 1024], help='Numbers of trajectories')
+    parser.add_argument('--traj_sim_time', type=float, default=5.0, help='Trajectory simulation time')
+    parser.add_argument('--n_runs', type=int, default=3, help='Number of timed runs per configuration')
+    parser.add_argument('--quaternion_state', action='store_true', help='Propagate the orientation as a quaternion')
+    return parser.parse_args()
+
+
+def time_rollout(dphysics, z_grid, controls, device, n_runs=3):
+    """
+    Returns the states of the rollout, the time of the first (warm-up, compilation) rollout
+    and the mean time of the following ones.
+    """
+    f = lambda: dphysics(z_grid=z_grid, controls=controls)[0]
+    with torch.no_grad():
+        _, t_first = timed(f, device)
+        states, t_mean = timed(f, device, n_runs=n_runs)
+    return states, t_first, t_mean
+
+
+def benchmark():
+    args = arg_parser()
+    print(f'Benchmarking DPhysics rollout: robot={args.robot}, device={args.device}, '
+          f'traj_sim_time={args.traj_sim_time} [sec], quaternion_state={args.quaternion_state}')
+
+    results, positions = {}, {}
+    for compile_dynamics in [False, True]:
+        dphys_cfg = DPhysConfig(robot=args.robot)
+        dphys_cfg.use_odeint = False
+        dphys_cfg.compile_dynamics = compile_dynamics
+        dphys_cfg.traj_sim_time = args.traj_sim_time
+        dphys_cfg.quaternion_state = args.quaternion_state
+        dphysics = DPhysics(dphys_cfg, device=args.device)
+
+        for n_trajs in args.n_sim_trajs:
+            # the heightmap is shared by all the trajectories
+            z_grid = hill_terrain(dphys_cfg).to(args.device)
+            # the same control inputs for the eager and compiled rollouts
+            torch.manual_seed(n_trajs)
+            controls, _ = generate_controls(n_trajs=n_trajs, time_horizon=dphys_cfg.traj_sim_time, dt=dphys_cfg.dt,
+                                            per_step=False)
+            controls = controls.to(args.device)
+
+            states, t_first, t_mean = time_rollout(dphysics, z_grid, controls, args.device, n_runs=args.n_runs)
+            results[(compile_dynamics, n_trajs)] = t_mean
+            positions[(compile_dynamics, n_trajs)] = states[0]
+            print(f'compile_dynamics={compile_dynamics}, n_sim_trajs={n_trajs}: '
+                  f'first run {t_first:.3f} [sec], mean {t_mean:.3f} [sec]')
+
+    print('\nn_sim_trajs | eager [sec] | compiled [sec] | speedup | pos diff med')
+    pos_diffs = {}
+    for n_trajs in args.n_sim_trajs:
+        t_eager, t_compiled = results[(False, n_trajs)], results[(True, n_trajs)]
+        # the compiled kernels differ by the rounding, the chaotic trajectories amplify it
+        pos_diff = torch.norm(positions[(True, n_trajs)] - positions[(False, n_trajs)], dim=-1).amax(dim=-1)
+        pos_diffs[f'pos diff ({n_trajs} trajectories)'] = pos_diff.median().item()
+        print(f'{n_trajs:11d} | {t_eager:11.3f} | {t_compiled:14.3f} | {t_eager / t_compiled:6.2f}x | '
+              f'{pos_diff.median().item():12.2e}')
+    check(pos_diffs, tol=1e-3)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import copy
+import argparse
+import threading
+from time import time
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from benchmark_utils import hill_terrain, check
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Memory benchmark of the backpropagation through DPhysics rollouts')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to run the rollouts on')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[4, 16, 64], help='Numbers of trajectories')
+    parser.add_argument('--horizons', type=float, nargs='+', default=[1.0, 5.0], help='Trajectory simulation times')
+    parser.add_argument('--checkpoint_steps', type=int, default=50, help='Time steps per checkpointed segment')
+    parser.add_argument('--odeint', action='store_true', help='Compare odeint and odeint_adjoint rollouts')
+    return parser.parse_args()
+
+
+class SavedTensorsMemory:
+    """
+    Measures the memory of the tensors saved for the backward pass (unique storages), which is the memory
+    bounded by the checkpointing. On CUDA, the peak allocated memory is reported as well.
+    """
+    def __init__(self):
+        self.storages = {}
+
+    def pack(self, x):
+        storage = x.untyped_storage()
+        self.storages[storage.data_ptr()] = storage.nbytes()
+        return x
+
+    def __enter__(self):
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda x: x)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
+
+    @property
+    def mbytes(self):
+        return sum(self.storages.values()) / 2 ** 20
+
+
+def measure(dphys_cfg, batch_size, device):
+    """
+    Returns the memory of the saved tensors [MB], the peak allocated memory on CUDA [MB] (None on CPU)
+    and the time [sec] of a rollout with the backward pass.
+    """
+    dphysics = DPhysics(dphys_cfg, device=device)
+    z_grid = hill_terrain(dphys_cfg).repeat(batch_size, 1, 1).to(device).requires_grad_(True)
+    controls, _ = generate_controls(n_trajs=batch_size, time_horizon=dphys_cfg.traj_sim_time, dt=dphys_cfg.dt,
+                                    per_step=False)
+    controls = controls.to(device)
+
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    t0 = time()
+    with SavedTensorsMemory() as memory:
+        states, forces = dphysics(z_grid=z_grid, controls=controls)
+    loss = states[0][:, -1].pow(2).sum()
+    loss.backward()
+    t = time() - t0
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.startswith('cuda') else None
+    return memory.mbytes, peak, t
+
+
+def gradient_check(robot, checkpoint_steps, device, odeint=False, batch_size=4, traj_sim_time=1.0):
+    """
+    Relative differences of the gradients w.r.t. the height map through the re-entrant DPhysics.rollout (the per-call
+    state is reset before the backward pass), with the backward pass in the calling thread and in another one,
+    with moving joints and without and with an ensemble of the terrain parameters.
+    The checkpointed rollouts are compared against the non-checkpointed ones, the odeint_adjoint rollouts against
+    the odeint_adjoint rollouts of DPhysics.dphysics (the per-call state is kept until the next call).
+    """
+    dphys_cfg = DPhysConfig(robot=robot)
+    dphys_cfg.use_odeint = odeint
+    dphys_cfg.use_adjoint = odeint
+    dphys_cfg.traj_sim_time = traj_sim_time
+    dphysics = DPhysics(dphys_cfg, device=device)
+    z_grid = hill_terrain(dphys_cfg).repeat(batch_size, 1, 1).to(device)
+    controls, _ = generate_controls(n_trajs=batch_size, time_horizon=traj_sim_time, dt=dphys_cfg.dt, per_step=False)
+    controls = controls.to(device)
+    N = int(traj_sim_time / dphys_cfg.dt)
+    joint_angles = torch.linspace(-1, 1, N).view(1, N, 1).repeat(batch_size, 1, 4).to(device)
+    ensemble = {'stiffness': dphys_cfg.stiffness * torch.tensor([0.5, 2.0]),
+                'damping': dphys_cfg.damping * torch.tensor([0.5, 2.0])}
+
+    def height_gradient(steps, ensemble, reentrant=True, thread=False):
+        z = z_grid.clone().requires_grad_(True)
+        if reentrant:
+            cfg = copy.copy(dphys_cfg)
+            cfg.checkpoint_steps = steps
+            states, _ = dphysics.rollout(z, controls, dphys_cfg=cfg, joint_angles=joint_angles, ensemble=ensemble)
+        else:
+            states, _ = dphysics.dphysics(z, controls, joint_angles=joint_angles, ensemble=ensemble)
+        loss = states[0].pow(2).sum()
+        if thread:
+            backward = threading.Thread(target=loss.backward)
+            backward.start()
+            backward.join()
+        else:
+            loss.backward()
+        return z.grad
+
+    diffs = {}
+    for name, e in [('joints', None), ('joints + ensemble', ensemble)]:
+        grad_ref = height_gradient(None, e, reentrant=not odeint)
+        for thread in [False, True]:
+            grad = height_gradient(checkpoint_steps, e, thread=thread)
+            diffs[name + (' (thread)' if thread else '')] = (torch.norm(grad - grad_ref) / torch.norm(grad_ref)).item()
+    return diffs
+
+
+def benchmark():
+    args = arg_parser()
+    if args.odeint:
+        diffs = gradient_check(args.robot, None, args.device, odeint=True)
+        print('Gradients of the odeint_adjoint DPhysics.rollout against DPhysics.dphysics, relative differences: '
+              + ', '.join(f'{name} {diff:.1e}' for name, diff in diffs.items()))
+    else:
+        diffs = gradient_check(args.robot, args.checkpoint_steps, args.device)
+        print('Gradients of the checkpointed DPhysics.rollout against the full backpropagation, relative differences: '
+              + ', '.join(f'{name} {diff:.1e}' for name, diff in diffs.items()))
+    check(diffs, tol=1e-5)
+    if args.odeint:
+        modes = {'odeint': dict(use_odeint=True, use_adjoint=False),
+                 'odeint_adjoint': dict(use_odeint=True, use_adjoint=True)}
+    else:
+        modes = {'full': dict(use_odeint=False, checkpoint_steps=None),
+                 f'checkpoint_{args.checkpoint_steps}': dict(use_odeint=False, checkpoint_steps=args.checkpoint_steps)}
+    print(f'Memory benchmark of DPhysics backpropagation: robot={args.robot}, device={args.device}')
+    print(f'{"mode":>16} | {"batch":>5} | {"T [sec]":>7} | {"saved [MB]":>10} | {"peak [MB]":>9} | {"time [sec]":>10}')
+    for T in args.horizons:
+        for batch_size in args.batch_sizes:
+            for mode, params in modes.items():
+                dphys_cfg = DPhysConfig(robot=args.robot)
+                dphys_cfg.traj_sim_time = T
+                dphys_cfg.record_forces = None
+                for key, value in params.items():
+                    setattr(dphys_cfg, key, value)
+                saved, peak, t = measure(dphys_cfg, batch_size, args.device)
+                peak = f'{peak:9.1f}' if peak is not None else f'{"-":>9}'
+                print(f'{mode:>16} | {batch_size:5d} | {T:7.1f} | {saved:10.1f} | {peak} | {t:10.2f}')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import argparse
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from benchmark_utils import timed, hill_terrain
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Accuracy and speed of the reduced-precision DPhysics rollouts')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--n_sim_trajs', type=int, default=256, help='Number of trajectories')
+    parser.add_argument('--traj_sim_time', type=float, default=5.0, help='Trajectory simulation time')
+    parser.add_argument('--precisions', type=str, nargs='+', default=['bfloat16', 'float16'],
+                        help='Contact math precisions compared to float32')
+    parser.add_argument('--n_runs', type=int, default=3, help='Number of timed runs per configuration')
+    return parser.parse_args()
+
+
+def create_terrains(dphys_cfg):
+    """
+    Synthetic terrains from scripts/robot_control.py: hill, waves, flat ground and a wall.
+    """
+    x_grid, y_grid = dphys_cfg.x_grid, dphys_cfg.y_grid
+    wall = torch.zeros_like(x_grid)
+    wall[80:81, 0:100] = 1.0
+    terrains = {
+        'hill': hill_terrain(dphys_cfg)[0],
+        'waves': torch.sin(x_grid) * torch.cos(y_grid),
+        'flat': torch.zeros_like(x_grid),
+        'wall': wall,
+    }
+    return {name: z_grid.unsqueeze(0) for name, z_grid in terrains.items()}
+
+
+def rollout(dphys_cfg, z_grid, controls, device, n_runs=3):
+    """
+    Returns the states of the rollout and its mean time [sec] (after a warm-up run).
+    """
+    dphysics = DPhysics(dphys_cfg, device=device)
+    with torch.no_grad():
+        return timed(lambda: dphysics(z_grid=z_grid, controls=controls)[0], device, n_runs=n_runs, warmup=True)
+
+
+def rotation_error(Rs, Rs_ref):
+    """
+    Angle [rad] of the relative rotation between the rotation matrices (..., 3, 3).
+    """
+    cos = ((Rs_ref.transpose(-2, -1) @ Rs).diagonal(dim1=-2, dim2=-1).sum(dim=-1) - 1) / 2
+    return torch.arccos(torch.clamp(cos, min=-1.0, max=1.0))
+
+
+def report():
+    args = arg_parser()
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.traj_sim_time = args.traj_sim_time
+    dphys_cfg.record_forces = None
+    controls, _ = generate_controls(n_trajs=args.n_sim_trajs, time_horizon=args.traj_sim_time, dt=dphys_cfg.dt,
+                                    per_step=False)
+    controls = controls.to(args.device)
+
+    print(f'Reduced-precision DPhysics rollouts: robot={args.robot}, device={args.device}, '
+          f'n_sim_trajs={args.n_sim_trajs}, traj_sim_time={args.traj_sim_time} [sec]')
+    print(f'{"terrain":>7} | {"precision":>9} | {"time [sec]":>10} | {"speedup":>7} | '
+          f'{"pos err mean [m]":>16} | {"pos err max [m]":>15} | {"rot err max [deg]":>17}')
+    for name, z_grid in create_terrains(dphys_cfg).items():
+        z_grid = z_grid.to(args.device)
+        dphys_cfg.contact_precision = 'float32'
+        states_ref, t_ref = rollout(dphys_cfg, z_grid, controls, args.device, n_runs=args.n_runs)
+        print(f'{name:>7} | {"float32":>9} | {t_ref:10.3f} | {1.0:6.2f}x | {"-":>16} | {"-":>15} | {"-":>17}')
+        for precision in args.precisions:
+            dphys_cfg.contact_precision = precision
+            states, t = rollout(dphys_cfg, z_grid, controls, args.device, n_runs=args.n_runs)
+            pos_err = torch.norm(states[0] - states_ref[0], dim=-1)
+            rot_err = torch.rad2deg(rotation_error(states[2], states_ref[2]))
+            print(f'{name:>7} | {precision:>9} | {t:10.3f} | {t_ref / t:6.2f}x | {pos_err.mean():16.4f} | '
+                  f'{pos_err.max():15.4f} | {rot_err.max():17.3f}')
+
+
+if __name__ == '__main__':
+    report()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import copy
+import argparse
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import InclinationCost, SlipEnergyCost
+from benchmark_utils import timed, hill_terrain, check
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Ensemble rollouts under terrain parameters hypotheses against '
+                                                 'rollouts of the batch for each hypothesis')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--n_sim_trajs', type=int, default=64, help='Number of trajectories')
+    parser.add_argument('--n_hypotheses', type=int, nargs='+', default=[4, 8], help='Numbers of hypotheses K')
+    parser.add_argument('--traj_sim_time', type=float, default=5.0, help='Trajectory simulation time')
+    parser.add_argument('--n_runs', type=int, default=3, help='Number of timed runs per configuration')
+    return parser.parse_args()
+
+
+def sample_hypotheses(dphys_cfg, K):
+    """
+    Friction scales, stiffness and damping hypotheses around the nominal terrain parameters, (K,).
+    """
+    return {
+        'friction_scale': torch.empty(K).uniform_(0.5, 1.5),
+        'stiffness': dphys_cfg.stiffness * torch.empty(K).uniform_(0.5, 2.0),
+        'damping': dphys_cfg.damping * torch.empty(K).uniform_(0.5, 2.0),
+    }
+
+
+def benchmark():
+    args = arg_parser()
+    torch.manual_seed(0)
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.traj_sim_time = args.traj_sim_time
+    dphys_cfg.record_forces = None
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+
+    B = args.n_sim_trajs
+    z_grid = hill_terrain(dphys_cfg).repeat(B, 1, 1).to(args.device)  # height map per trajectory
+    controls, _ = generate_controls(n_trajs=B, time_horizon=args.traj_sim_time, dt=dphys_cfg.dt, per_step=False)
+    controls = controls.to(args.device)
+
+    print(f'Ensemble rollouts: robot={args.robot}, device={args.device}, n_sim_trajs={B}, '
+          f'traj_sim_time={args.traj_sim_time} [sec]')
+    print(f'{"K":>3} | {"per-hypothesis [sec]":>20} | {"ensemble [sec]":>14} | {"speedup":>7} | '
+          f'{"cost diff med":>13} | {"cost std mean":>13}')
+    for K in args.n_hypotheses:
+        ensemble = sample_hypotheses(dphys_cfg, K)
+
+        def per_hypothesis():
+            # a rollout of the whole batch for each hypothesis, the terrain is prepared K times
+            friction = dphys_cfg.friction.to(args.device) * ensemble['friction_scale'].view(K, 1, 1).to(args.device)
+            costs_k = []
+            for k in range(K):
+                cfg = copy.copy(dphys_cfg)
+                cfg.stiffness, cfg.damping = ensemble['stiffness'][k].item(), ensemble['damping'][k].item()
+                costs = {'inclination': InclinationCost(), 'slip': SlipEnergyCost(weight=0.01)}
+                _, _, info = dphysics.rollout(z_grid=z_grid.clone(), controls=controls, dphys_cfg=cfg,
+                                              friction=friction[k].expand(B, -1, -1), costs=costs, return_info=True)
+                costs_k.append(info['cost'])
+            return torch.stack(costs_k, dim=1)
+
+        def ensemble_rollout():
+            costs = {'inclination': InclinationCost(), 'slip': SlipEnergyCost(weight=0.01)}
+            _, _, info = dphysics(z_grid=z_grid, controls=controls, costs=costs, return_info=True, ensemble=ensemble)
+            return info
+
+        with torch.no_grad():
+            cost_rep, t_rep = timed(per_hypothesis, args.device, n_runs=args.n_runs, warmup=True)
+            info, t_ens = timed(ensemble_rollout, args.device, n_runs=args.n_runs, warmup=True)
+        # the ensemble rollout matches the rollouts of the batch for each hypothesis: median relative difference,
+        # the rounding errors are amplified by the contact dynamics of some trajectories over long horizons
+        cost_diff = ((info['cost'] - cost_rep).abs() / cost_rep.abs().clamp(min=1e-6)).median().item()
+        print(f'{K:3d} | {t_rep:20.3f} | {t_ens:14.3f} | {t_rep / t_ens:6.2f}x | {cost_diff:13.2e} | '
+              f'{info["cost_var"].sqrt().mean().item():13.4f}')
+        check({f'cost diff (K={K})': cost_diff}, tol=1e-3)
+
+
+if __name__ == '__main__':
+    benchmark()
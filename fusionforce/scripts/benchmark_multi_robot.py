@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import argparse
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import ContactForceCost
+from benchmark_utils import optional_float, timed, hill_terrain, check
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Rollouts of a heterogeneous robots batch against sequential '
+                                                 'rollouts of the individual robots on the same terrain')
+    parser.add_argument('--robots', type=str, nargs='+', default=['marv', 'tradr', 'husky'], help='Robot names')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--n_sim_trajs', type=int, nargs='+', default=[16, 64, 256],
+                        help='Numbers of trajectories per robot')
+    parser.add_argument('--traj_sim_time', type=float, default=5.0, help='Trajectory simulation time')
+    parser.add_argument('--n_runs', type=int, default=3, help='Number of timed runs per configuration')
+    parser.add_argument('--contact_heights', type=optional_float, nargs='+', default=None,
+                        help='Contact heights of the robots (see DPhysConfig.contact_height, none: all the points), '
+                             'the robot points of the batch are padded if their numbers differ')
+    return parser.parse_args()
+
+
+def benchmark():
+    args = arg_parser()
+    torch.manual_seed(0)
+    robot_cfgs = []
+    contact_heights = args.contact_heights or [None] * len(args.robots)
+    for robot, contact_height in zip(args.robots, contact_heights):
+        dphys_cfg = DPhysConfig(robot=robot)
+        if contact_height is not None:
+            dphys_cfg.contact_height = contact_height
+            dphys_cfg.update_robot_geometry()
+        dphys_cfg.use_odeint = False
+        dphys_cfg.traj_sim_time = args.traj_sim_time
+        dphys_cfg.record_forces = 'stats'
+        robot_cfgs.append(dphys_cfg)
+    R = len(robot_cfgs)
+    dphys_cfg = robot_cfgs[0]
+
+    # the heightmap is shared by all the trajectories
+    z_grid = hill_terrain(dphys_cfg).to(args.device)
+
+    singles = [DPhysics(cfg, device=args.device) for cfg in robot_cfgs]
+    batch = DPhysics(dphys_cfg, device=args.device, robot_cfgs=robot_cfgs)
+
+    print(f'Heterogeneous robots batch: robots={args.robots}, device={args.device}, '
+          f'traj_sim_time={args.traj_sim_time} [sec]')
+    print(f'{"trajs per robot":>15} | {"sequential [sec]":>16} | {"batch [sec]":>11} | {"speedup":>7} | '
+          f'{"pos diff max [m]":>16} | {"force spread diff med":>21}')
+    for n_trajs in args.n_sim_trajs:
+        controls, _ = generate_controls(n_trajs=n_trajs * R, time_horizon=args.traj_sim_time, dt=dphys_cfg.dt,
+                                        per_step=False)
+        controls = controls.to(args.device)
+        robot_ids = torch.arange(R, device=args.device).repeat_interleave(n_trajs)
+
+        def sequential():
+            return [dphysics(z_grid=z_grid, controls=controls[robot_ids == i], costs={'force': ContactForceCost()},
+                             return_info=True)
+                    for i, dphysics in enumerate(singles)]
+
+        with torch.no_grad():
+            outputs_seq, t_seq = timed(sequential, args.device, n_runs=args.n_runs, warmup=True)
+            (states, forces, info), t_batch = timed(lambda: batch(z_grid=z_grid, controls=controls, robot_ids=robot_ids,
+                                                                  costs={'force': ContactForceCost()},
+                                                                  return_info=True),
+                                                    args.device, n_runs=args.n_runs, warmup=True)
+        pos_diff = max((states[0][robot_ids == i] - s[0]).abs().max().item() for i, (s, _, _) in enumerate(outputs_seq))
+        # the contact forces spread (path cost and recorded statistics) is over the points of each robot,
+        # without the padding points of the batch: median relative difference, the rounding errors are amplified
+        # by the contact dynamics of some trajectories
+        spread_diff = max(max(((info['cost'][robot_ids == i] - info_i['cost']).abs() /
+                               info_i['cost'].abs().clamp(min=1e-6)).median().item(),
+                              ((forces[0][robot_ids == i] - f[0]).abs() / f[0].abs().clamp(min=1e-6)).median().item())
+                          for i, (_, f, info_i) in enumerate(outputs_seq))
+        print(f'{n_trajs:15d} | {t_seq:16.3f} | {t_batch:11.3f} | {t_seq / t_batch:6.2f}x | {pos_diff:16.2e} | '
+              f'{spread_diff:21.2e}')
+        check({f'pos diff ({n_trajs} trajs)': pos_diff}, tol=1e-2)
+        check({f'force spread diff ({n_trajs} trajs)': spread_diff}, tol=1e-3)
+
+
+if __name__ == '__main__':
+    benchmark()
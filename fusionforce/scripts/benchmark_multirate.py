@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import copy
+import argparse
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import InclinationCost, SlipEnergyCost
+from fusionforce.models.traj_predictor.surrogate import random_terrains
+from benchmark_utils import optional_float, timed, spearman
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Accuracy report of the multi-rate rollout (fine steps near '
+                                                 'the robot, coarse ones far ahead) against the uniform dt rollout')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--n_trajs', type=int, default=64, help='Number of trajectories per terrain')
+    parser.add_argument('--n_terrains', type=int, default=5, help='Number of random terrains')
+    parser.add_argument('--traj_sim_time', type=float, default=5.0, help='Trajectory simulation time')
+    parser.add_argument('--schedules', type=str, nargs='+',
+                        default=['5:0.02', '1:0.01,5:0.02', '1:0.01,5:0.06', '0.5:0.01,1.5:0.03,5:0.06', '5:0.06'],
+                        help='Step size schedules t_end:step_dt,... (the last step size holds until the end)')
+    parser.add_argument('--substep_dt_max', type=optional_float, nargs='+', default=[0.015, 0.02, None],
+                        help='Maximal substep sizes [sec] of the coarse steps (none: no substeps)')
+    return parser.parse_args()
+
+
+def parse_schedule(s):
+    return [[float(v) for v in segment.split(':')] for segment in s.split(',')]
+
+
+def yaw_error(Rs, Rs_ref):
+    """
+    Heading difference [rad] of the rotation matrices (..., 3, 3).
+    """
+    yaw = torch.atan2(Rs[..., 1, 0], Rs[..., 0, 0])
+    yaw_ref = torch.atan2(Rs_ref[..., 1, 0], Rs_ref[..., 0, 0])
+    return torch.atan2(torch.sin(yaw - yaw_ref), torch.cos(yaw - yaw_ref)).abs()
+
+
+def benchmark():
+    args = arg_parser()
+    torch.manual_seed(0)
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.traj_sim_time = args.traj_sim_time
+    dphys_cfg.record_forces = None
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+
+    # number of the force evaluations (fused steps, including the substeps) of the last rollout
+    n_evals = [0]
+    step = dphysics.step
+
+    def counted_step(*step_args):
+        n_evals[0] += 1
+        return step(*step_args)
+    dphysics.step = counted_step
+
+    T, dt = args.traj_sim_time, dphys_cfg.dt
+    z_grids = random_terrains(dphys_cfg, args.n_terrains, generator=torch.Generator().manual_seed(0)).to(args.device)
+    controls, _ = generate_controls(n_trajs=args.n_trajs, time_horizon=T, dt=dt, n_knots=4,
+                                    v_range=(-dphys_cfg.vel_max, dphys_cfg.vel_max),
+                                    w_range=(-dphys_cfg.omega_max, dphys_cfg.omega_max))
+    controls = controls.to(args.device)
+
+    def run(schedule, substep_dt_max):
+        cfg = copy.deepcopy(dphys_cfg)
+        cfg.dt_schedule, cfg.substep_dt_max = schedule, substep_dt_max
+        outputs, n, t = [], 0, 0.0
+        for z_grid in z_grids:
+            costs = {'inclination': InclinationCost(), 'slip': SlipEnergyCost(weight=1e-3)}
+            n_evals[0] = 0
+            with torch.no_grad():
+                (states, _, info), t_z = timed(lambda: dphysics.rollout(z_grid[None], controls, dphys_cfg=cfg,
+                                                                        costs=costs, return_info=True), args.device)
+            outputs.append((states, info['cost']))
+            n, t = n + n_evals[0], t + t_z
+        return outputs, n, t
+
+    def height_gradient(schedule, substep_dt_max):
+        # gradient of the final positions of the trajectories w.r.t. the first height map
+        cfg = copy.deepcopy(dphys_cfg)
+        cfg.dt_schedule, cfg.substep_dt_max = schedule, substep_dt_max
+        z_grid = z_grids[:1].clone().requires_grad_(True)
+        states, _ = dphysics.rollout(z_grid, controls, dphys_cfg=cfg)
+        states[0][:, -1].sum().backward()
+        return z_grid.grad
+
+    run(None, None)  # warm-up
+    ref, n_ref, t_ref = run(None, None)
+    grad_ref = height_gradient(None, None)
+    ids = {f'{t:g}s': int(round(t / dt)) - 1 for t in (1.0, T / 2, T)}
+
+    print(f'Multi-rate rollout accuracy: robot={args.robot}, device={args.device}, {args.n_terrains} terrains x '
+          f'{args.n_trajs} trajectories, traj_sim_time={T} [sec], reference uniform dt={dt} [sec] '
+          f'({n_ref // args.n_terrains} steps, {t_ref:.2f} [sec])')
+    print(f'{"schedule t_end:step_dt":>24} | {"substep":>7} | {"steps":>5} | {"speedup":>7} | ' +
+          ' | '.join(f'{"pos err " + k:>12}' for k in ids) + f' | {"max err":>7} | {"yaw err":>7} | '
+          f'{"cost err":>8} | {"rank corr":>9} | {"grad norm ratio":>15}')
+    evaluated = set()
+    for s in args.schedules:
+        schedule = parse_schedule(s)
+        for substep_dt_max in args.substep_dt_max:
+            # the substeps split only the steps longer than substep_dt_max
+            if substep_dt_max is not None and max(step_dt for _, step_dt in schedule) <= substep_dt_max:
+                substep_dt_max = None
+            if (s, substep_dt_max) in evaluated:
+                continue
+            evaluated.add((s, substep_dt_max))
+            outputs, n, t = run(schedule, substep_dt_max)
+            pos_err = torch.cat([torch.norm(o[0][0] - r[0][0], dim=-1) for o, r in zip(outputs, ref)])
+            yaw_err = torch.cat([yaw_error(o[0][2][:, -1], r[0][2][:, -1]) for o, r in zip(outputs, ref)])
+            cost_err = torch.cat([(o[1] - r[1]).abs() / r[1].abs().clamp(min=1e-6) for o, r in zip(outputs, ref)])
+            rank_corr = sum(spearman(o[1], r[1]) for o, r in zip(outputs, ref)) / len(ref)
+            grad = height_gradient(schedule, substep_dt_max)
+            # the gradients of the contact dynamics are too sensitive for an error, their magnitude shows the
+            # stability of the backward pass
+            grad_ratio = (torch.norm(grad) / torch.norm(grad_ref)).item()
+            substep = str(substep_dt_max) if substep_dt_max is not None else '-'
+            if not torch.isfinite(pos_err).all():
+                print(f'{s:>24} | {substep:>7} | {n // args.n_terrains:5d} | {t_ref / t:7.1f} | diverged')
+                continue
+            print(f'{s:>24} | {substep:>7} | {n // args.n_terrains:5d} | {t_ref / t:7.1f} | ' +
+                  ' | '.join(f'{pos_err[:, i].mean().item():12.3f}' for i in ids.values()) +
+                  f' | {pos_err.max().item():7.3f} | {yaw_err.mean().item():7.3f} | {cost_err.mean().item():8.3f} | '
+                  f'{rank_corr:9.3f} | {grad_ratio:15.3g}')
+
+
+if __name__ == '__main__':
+    benchmark()
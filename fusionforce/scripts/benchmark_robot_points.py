@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import argparse
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from benchmark_utils import timed, hill_terrain
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Number of robot points, rollout speed and trajectory deviation '
+                                                 'of the contact points selection')
+    parser.add_argument('--robots', type=str, nargs='+', default=['marv', 'tradr', 'husky'], help='Robot names')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to run the rollouts on')
+    parser.add_argument('--n_sim_trajs', type=int, default=256, help='Number of trajectories')
+    parser.add_argument('--traj_sim_time', type=float, default=5.0, help='Trajectory simulation time')
+    parser.add_argument('--contact_heights', type=float, nargs='+', default=[0.1, 0.2, 0.3],
+                        help='Heights of the hull bottom contact points, [m]')
+    parser.add_argument('--contact_voxel_size', type=float, default=0.1, help='Voxel size of the contact points')
+    parser.add_argument('--inertia_voxel_size', type=float, default=0.2, help='Voxel size of the inertia points')
+    parser.add_argument('--n_runs', type=int, default=3, help='Number of timed runs per configuration')
+    return parser.parse_args()
+
+
+def rollout(dphys_cfg, z_grid, controls, device, n_runs=3):
+    """
+    Returns the states of the rollout and its mean time [sec] (after a warm-up run).
+    """
+    dphysics = DPhysics(dphys_cfg, device=device)
+    with torch.no_grad():
+        return timed(lambda: dphysics(z_grid=z_grid, controls=controls)[0], device, n_runs=n_runs, warmup=True)
+
+
+def report():
+    args = arg_parser()
+    torch.manual_seed(0)
+    print(f'Contact points selection: device={args.device}, n_sim_trajs={args.n_sim_trajs}, '
+          f'traj_sim_time={args.traj_sim_time} [sec]')
+    print(f'{"robot":>6} | {"contact_height":>14} | {"N_pts":>5} | {"N_I":>5} | {"time [sec]":>10} | {"speedup":>7} | '
+          f'{"pos err mean [m]":>16} | {"pos err final max [m]":>21}')
+    for robot in args.robots:
+        dphys_cfg = DPhysConfig(robot=robot)
+        dphys_cfg.use_odeint = False
+        dphys_cfg.traj_sim_time = args.traj_sim_time
+        dphys_cfg.record_forces = None
+        # the heightmap is shared by all the trajectories
+        z_grid = hill_terrain(dphys_cfg, noise=0.02).to(args.device)
+        controls, _ = generate_controls(n_trajs=args.n_sim_trajs, time_horizon=args.traj_sim_time, dt=dphys_cfg.dt,
+                                        per_step=False)
+        controls = controls.to(args.device)
+
+        # reference: all the robot body points
+        states_ref, t_ref = rollout(dphys_cfg, z_grid, controls, args.device, n_runs=args.n_runs)
+        n_pts = len(dphys_cfg.robot_points)
+        print(f'{robot:>6} | {"all":>14} | {n_pts:5d} | {n_pts:5d} | {t_ref:10.3f} | {1.0:6.2f}x | '
+              f'{"-":>16} | {"-":>21}')
+
+        for contact_height in args.contact_heights:
+            dphys_cfg.contact_height = contact_height
+            dphys_cfg.contact_voxel_size = args.contact_voxel_size
+            dphys_cfg.inertia_voxel_size = args.inertia_voxel_size
+            dphys_cfg.update_robot_geometry()
+            states, t = rollout(dphys_cfg, z_grid, controls, args.device, n_runs=args.n_runs)
+            pos_err = torch.norm(states[0] - states_ref[0], dim=-1)
+            print(f'{robot:>6} | {contact_height:14.2f} | {len(dphys_cfg.robot_points):5d} | '
+                  f'{len(dphys_cfg.inertia_points):5d} | {t:10.3f} | {t_ref / t:6.2f}x | '
+                  f'{pos_err.mean():16.4f} | {pos_err[:, -1].max():21.4f}')
+
+
+if __name__ == '__main__':
+    report()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import InclinationCost
+from fusionforce.models.traj_predictor.server import RolloutServer
+from benchmark_utils import hill_terrain, check
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Throughput and latency of the small rollouts of several callers, '
+                                                 'run separately or merged by the rollout server')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--n_callers', type=int, nargs='+', default=[2, 4, 8], help='Numbers of concurrent callers')
+    parser.add_argument('--n_sim_trajs', type=int, default=8, help='Number of trajectories of a request')
+    parser.add_argument('--n_calls', type=int, default=4, help='Number of requests of a caller')
+    parser.add_argument('--max_delay', type=float, default=0.01, help='Waiting time for more requests [sec]')
+    parser.add_argument('--traj_sim_time', type=float, default=3.0, help='Trajectory simulation time')
+    return parser.parse_args()
+
+
+def benchmark():
+    args = arg_parser()
+    torch.manual_seed(0)
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.traj_sim_time = args.traj_sim_time
+    dphys_cfg.record_forces = None
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+
+    def caller(i):
+        """
+        Returns the height map and control inputs of the i-th caller (own terrain).
+        """
+        z_grid = hill_terrain(dphys_cfg, height=0.2 * (i + 1))
+        controls, _ = generate_controls(n_trajs=args.n_sim_trajs, time_horizon=args.traj_sim_time, dt=dphys_cfg.dt,
+                                        per_step=False)
+        return z_grid.to(args.device), controls.to(args.device)
+
+    def run(rollout, z_grid, controls):
+        """
+        Returns the outputs (states, path costs) and latencies [sec] of the requests of a caller.
+        """
+        outputs, latencies = [], []
+        for _ in range(args.n_calls):
+            t0 = time()
+            outputs.append(rollout(z_grid, controls))
+            latencies.append(time() - t0)
+        return outputs, latencies
+
+    def separate(z_grid, controls):
+        with torch.no_grad():
+            states, _, info = dphysics.rollout(z_grid, controls, costs={'inclination': InclinationCost()},
+                                               return_info=True)
+        return states, info['cost']
+
+    def merged(z_grid, controls):
+        states, _, info = server.rollout(z_grid, controls)
+        return states, info['cost']
+
+    print(f'Rollout server: robot={args.robot}, device={args.device}, {args.n_sim_trajs} trajectories per request, '
+          f'{args.n_calls} requests per caller, max_delay={args.max_delay} [sec]')
+    print(f'{"callers":>7} | {"mode":>8} | {"total [sec]":>11} | {"trajs / sec":>11} | {"latency mean [sec]":>18} | '
+          f'{"rollouts":>8} | {"pos diff med":>12} | {"max cost diff":>13}')
+    for n_callers in args.n_callers:
+        callers = [caller(i) for i in range(n_callers)]
+        results = {}
+        server = RolloutServer(dphysics, costs={'inclination': InclinationCost()},
+                               max_batch_size=n_callers * args.n_sim_trajs, max_delay=args.max_delay)
+        with server:
+            modes = {'separate': separate, 'server': merged}
+            for mode, rollout in modes.items():
+                t0 = time()
+                with ThreadPoolExecutor(max_workers=n_callers) as pool:
+                    results[mode] = list(pool.map(lambda c: run(rollout, *c), callers))
+                t_total = time() - t0
+                latencies = [t for _, caller_latencies in results[mode] for t in caller_latencies]
+                n_rollouts = n_callers * args.n_calls if mode == 'separate' else server.n_rollouts
+                # the merged rollouts match the separate ones of the same caller
+                pairs = [(o0, o1) for (outputs0, _), (outputs1, _) in zip(results['separate'], results[mode])
+                         for o0, o1 in zip(outputs0, outputs1)]
+                # the batched rollouts differ by the rounding, the chaotic trajectories amplify it
+                pos_diff = torch.cat([torch.norm(states0[0] - states1[0], dim=-1).amax(dim=-1)
+                                      for (states0, _), (states1, _) in pairs])
+                pos_diff = pos_diff.median().item()
+                cost_diff = max((c0 - c1).abs().max().item() for (_, c0), (_, c1) in pairs)
+                print(f'{n_callers:7d} | {mode:>8} | {t_total:11.3f} | '
+                      f'{n_callers * args.n_calls * args.n_sim_trajs / t_total:11.1f} | '
+                      f'{sum(latencies) / len(latencies):18.3f} | {n_rollouts:8d} | {pos_diff:12.2e} | '
+                      f'{cost_diff:13.2e}')
+                check({f'pos diff ({n_callers} callers)': pos_diff, f'cost diff ({n_callers} callers)': cost_diff})
+
+
+if __name__ == '__main__':
+    benchmark()
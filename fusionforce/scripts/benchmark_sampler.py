@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import argparse
+from time import time
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import GoalDistanceCost, InclinationCost
+from fusionforce.models.traj_predictor.samplers import ControlSampler
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Receding-horizon planning with the warm-started control sampler '
+                                                 'against the fixed control inputs set of the ROS nodes')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--n_sim_trajs', type=int, default=128,
+                        help='Number of trajectories of the fixed set (the sampled numbers are run as well)')
+    parser.add_argument('--n_samples', type=int, nargs='+', default=[16, 32], help='Numbers of sampled trajectories')
+    parser.add_argument('--methods', type=str, nargs='+', default=['mppi', 'cem'], help='Sampler methods')
+    parser.add_argument('--control_dt', type=float, default=0.5, help='Duration of the sampled control inputs [sec]')
+    parser.add_argument('--cycle_dt', type=float, default=0.5, help='Planning cycle period [sec]')
+    parser.add_argument('--n_cycles', type=int, default=10, help='Number of planning cycles')
+    parser.add_argument('--n_episodes', type=int, default=4, help='Number of planning episodes (random seeds)')
+    parser.add_argument('--goal', type=float, nargs=2, default=[3.0, 1.5], help='Goal position (x, y) [m]')
+    parser.add_argument('--traj_sim_time', type=float, default=3.0, help='Trajectory simulation time')
+    return parser.parse_args()
+
+
+def fixed_controls(dphys_cfg, n_trajs):
+    """
+    Constant control inputs drawn once, forward and backward halves (as in the ROS nodes).
+    """
+    kwargs = dict(time_horizon=dphys_cfg.traj_sim_time, dt=dphys_cfg.dt, per_step=False,
+                  w_range=(-dphys_cfg.omega_max, dphys_cfg.omega_max))
+    controls_front, _ = generate_controls(n_trajs=n_trajs // 2, v_range=(dphys_cfg.vel_max / 2, dphys_cfg.vel_max),
+                                          **kwargs)
+    controls_back, _ = generate_controls(n_trajs=n_trajs // 2, v_range=(-dphys_cfg.vel_max, -dphys_cfg.vel_max / 2),
+                                         **kwargs)
+    return torch.cat([controls_front, controls_back], dim=0)
+
+
+def receding_horizon(dphysics, z_grid, costs, args, get_controls, update=None, control_dt=None):
+    """
+    Runs the planning cycles, the robot follows the lowest-cost trajectory for cycle_dt between the cycles.
+
+    Returns:
+    - Mean time of a cycle [sec], mean lowest path cost and the final distance to the goal [m].
+    """
+    dphys_cfg = dphysics.dphys_cfg
+    state = (torch.zeros(1, 3), torch.zeros(1, 3), torch.eye(3).unsqueeze(0), torch.zeros(1, 3))
+    state = tuple(s.to(args.device) for s in state)
+    k = int(round(args.cycle_dt / dphys_cfg.dt)) - 1  # state index reached at the next cycle
+    t_cycles, best_costs = 0.0, []
+    for i in range(args.n_cycles):
+        t0 = time()
+        controls = get_controls(i * args.cycle_dt)
+        B = controls.shape[0]
+        with torch.no_grad():
+            states, _, info = dphysics(z_grid=z_grid, controls=controls, state=tuple(s.repeat_interleave(B, 0)
+                                                                                     for s in state),
+                                       control_dt=control_dt, costs=costs, return_info=True)
+        if update is not None:
+            update(controls, info['cost'])
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        t_cycles += time() - t0
+
+        j = torch.argmin(info['cost'])
+        best_costs.append(info['cost'][j].item())
+        state = tuple(s[j:j + 1, k].clone() for s in states)
+    goal_dist = torch.norm(state[0][0, :2].cpu() - torch.tensor(args.goal)).item()
+    return t_cycles / args.n_cycles, sum(best_costs) / len(best_costs), goal_dist
+
+
+def episodes(f, n_episodes):
+    """
+    Returns the results of receding_horizon averaged over the episodes, the random seed is set per episode.
+    """
+    results = []
+    for i in range(n_episodes):
+        torch.manual_seed(i)
+        results.append(f())
+    return [sum(r) / n_episodes for r in zip(*results)]
+
+
+def benchmark():
+    args = arg_parser()
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.traj_sim_time = args.traj_sim_time
+    dphys_cfg.record_forces = None
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+
+    # a hill between the robot and the goal
+    x_grid, y_grid = dphys_cfg.x_grid, dphys_cfg.y_grid
+    z_grid = 0.5 * torch.exp(-(x_grid - 1.5) ** 2 / 0.5) * torch.exp(-(y_grid - 0.75) ** 2 / 0.5)
+    z_grid = z_grid.unsqueeze(0).to(args.device)  # shared by all the trajectories
+    costs = {'goal': GoalDistanceCost(goal=args.goal), 'inclination': InclinationCost()}
+
+    print(f'Receding-horizon planning: robot={args.robot}, device={args.device}, goal={args.goal}, '
+          f'{args.n_episodes} episodes of {args.n_cycles} cycles of {args.cycle_dt} [sec], '
+          f'traj_sim_time={args.traj_sim_time} [sec]')
+    print(f'{"method":>8} | {"trajs":>5} | {"cycle time [sec]":>16} | {"mean best cost":>14} | {"goal dist [m]":>13}')
+
+    for n_trajs in [args.n_sim_trajs] + args.n_samples:
+        def fixed():
+            controls = fixed_controls(dphys_cfg, n_trajs).to(args.device)
+            return receding_horizon(dphysics, z_grid, costs, args, get_controls=lambda t: controls)
+
+        t, cost, dist = episodes(fixed, args.n_episodes)
+        print(f'{"fixed":>8} | {n_trajs:5d} | {t:16.3f} | {cost:14.4f} | {dist:13.3f}')
+
+    for method in args.methods:
+        for n_samples in args.n_samples:
+            def sampled():
+                sampler = ControlSampler(dphys_cfg, n_samples=n_samples, control_dt=args.control_dt, method=method,
+                                         device=args.device)
+
+                def get_controls(t):
+                    sampler.shift(t)
+                    return sampler.sample()
+
+                return receding_horizon(dphysics, z_grid, costs, args, get_controls=get_controls,
+                                        update=sampler.update, control_dt=args.control_dt)
+
+            t, cost, dist = episodes(sampled, args.n_episodes)
+            print(f'{method:>8} | {n_samples:5d} | {t:16.3f} | {cost:14.4f} | {dist:13.3f}')
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import copy
+import argparse
+from time import time
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import InclinationCost
+from fusionforce.models.traj_predictor.scheduler import RolloutScheduler
+from benchmark_utils import hill_terrain, check
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Latency of the anytime scheduled rollouts against the fixed '
+                                                 'rollouts of all the trajectories')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--n_sim_trajs', type=int, default=64, help='Maximal number of trajectories')
+    parser.add_argument('--deadlines', type=float, nargs='+', default=[0.5, 1.0, 2.0], help='Latency budgets [sec]')
+    parser.add_argument('--horizons', type=float, nargs='+', default=[5.0, 4.0, 3.0], help='Time horizons [sec]')
+    parser.add_argument('--dts', type=float, nargs='+', default=[0.01, 0.02], help='Step sizes [sec]')
+    parser.add_argument('--chunk_size', type=int, default=16, help='Number of trajectories evaluated at once')
+    parser.add_argument('--n_cycles', type=int, default=5, help='Number of planning cycles')
+    return parser.parse_args()
+
+
+def benchmark():
+    args = arg_parser()
+    torch.manual_seed(0)
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.traj_sim_time = args.horizons[0]
+    dphys_cfg.dt = args.dts[0]
+    dphys_cfg.record_forces = None
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+
+    B = args.n_sim_trajs
+    z_grid = hill_terrain(dphys_cfg).to(args.device)  # shared by all the trajectories
+    controls, _ = generate_controls(n_trajs=B, time_horizon=args.horizons[0], dt=args.dts[0], per_step=False,
+                                    sampling='sobol')
+    controls = controls.to(args.device)
+    state = (torch.zeros(B, 3), torch.zeros(B, 3), torch.eye(3).repeat(B, 1, 1), torch.zeros(B, 3))
+    state = tuple(s.to(args.device) for s in state)
+    costs = {'inclination': InclinationCost()}
+
+    print(f'Scheduled rollouts: robot={args.robot}, device={args.device}, n_sim_trajs={B}, '
+          f'horizons={args.horizons} [sec], dts={args.dts} [sec], {args.n_cycles} cycles')
+    print(f'{"deadline [sec]":>14} | {"latency mean [sec]":>18} | {"latency max [sec]":>17} | {"missed":>6} | '
+          f'{"trajs":>5} | {"horizon [sec]":>13} | {"dt [sec]":>8} | {"best cost":>9} | {"cost diff max":>13}')
+
+    # fixed rollouts of all the trajectories
+    latencies, best = [], []
+    for _ in range(args.n_cycles):
+        t0 = time()
+        with torch.no_grad():
+            _, _, info = dphysics(z_grid=z_grid, controls=controls, state=tuple(s.clone() for s in state),
+                                  costs=costs, return_info=True)
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        latencies.append(time() - t0)
+        best.append(info['cost'].min().item())
+    print(f'{"fixed":>14} | {sum(latencies) / len(latencies):18.3f} | {max(latencies):17.3f} | {"":>6} | '
+          f'{B:5d} | {args.horizons[0]:13.1f} | {args.dts[0]:8.3f} | {sum(best) / len(best):9.4f}')
+
+    for deadline in args.deadlines:
+        scheduler = RolloutScheduler(dphysics, deadline=deadline, n_trajs_range=(args.chunk_size, B),
+                                     horizons=args.horizons, dts=args.dts, chunk_size=args.chunk_size)
+        latencies, best, n_trajs = [], [], []
+        for _ in range(args.n_cycles):
+            with torch.no_grad():
+                states, path_costs, info = scheduler.run(z_grid, controls, state, costs=costs)
+            latencies.append(info['time'])
+            best.append(path_costs.min().item())
+            n_trajs.append(len(info['ids']))
+
+        # the scheduled trajectories of the last cycle match a rollout of the same trajectories with the scheduled
+        # horizon and step size, and the horizon and step size of the module are kept
+        cfg = copy.copy(dphys_cfg)
+        cfg.traj_sim_time, cfg.dt = info['traj_sim_time'], info['dt']
+        ids = info['ids']
+        with torch.no_grad():
+            states_ref, _, info_ref = dphysics.rollout(z_grid, controls[ids], dphys_cfg=cfg,
+                                                       state=tuple(s[ids].clone() for s in state), costs=costs,
+                                                       return_info=True)
+        cost_diff = (path_costs - info_ref['cost']).abs().max().item()
+        assert states[0].shape == states_ref[0].shape == (len(ids), int(cfg.traj_sim_time / cfg.dt), 3)
+        assert (dphysics.dphys_cfg.traj_sim_time, dphysics.dphys_cfg.dt) == (args.horizons[0], args.dts[0])
+
+        missed = sum(t > deadline for t in latencies)
+        print(f'{deadline:14.2f} | {sum(latencies) / len(latencies):18.3f} | {max(latencies):17.3f} | '
+              f'{missed:6d} | {sum(n_trajs) / len(n_trajs):5.1f} | {info["traj_sim_time"]:13.1f} | '
+              f'{info["dt"]:8.3f} | {sum(best) / len(best):9.4f} | {cost_diff:13.2e}')
+        check({f'cost diff (deadline {deadline} sec)': cost_diff}, tol=1e-3)
+
+
+if __name__ == '__main__':
+    benchmark()
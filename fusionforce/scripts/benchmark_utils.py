@@ -0,0 +1,82 @@
+"""
+Helpers shared by the benchmark scripts: timing, synthetic terrains, rank correlation and the checks
+of the benchmarked outputs.
+"""
+from time import time
+import torch
+
+
+def optional_float(s):
+    """
+    Parses a float argument, 'none' for None.
+    """
+    return None if s.lower() == 'none' else float(s)
+
+
+def timed(f, device, n_runs=1, warmup=False):
+    """
+    Returns the outputs of the last call of f and its mean time [sec] over n_runs calls.
+
+    Parameters:
+    - f: Function without arguments.
+    - device: Device of the computation, the CUDA kernels are synchronized before the time measurements.
+    - n_runs: Number of timed calls.
+    - warmup: Whether to call f once before the timed calls (compilation, allocations).
+    """
+    if warmup:
+        f()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    t0 = time()
+    for _ in range(n_runs):
+        outputs = f()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return outputs, (time() - t0) / n_runs
+
+
+def hill_terrain(dphys_cfg, height=1.0, noise=0.0):
+    """
+    Height map of a hill ahead of the robot (as in scripts/robot_control.py), (1, H, W).
+
+    Parameters:
+    - dphys_cfg: DPhysConfig of the height map grid.
+    - height: Height of the hill [m].
+    - noise: Standard deviation of the Gaussian noise added to the heights [m].
+    """
+    x_grid, y_grid = dphys_cfg.x_grid, dphys_cfg.y_grid
+    z_grid = height * torch.exp(-(x_grid - 2) ** 2 / 4) * torch.exp(-(y_grid - 0) ** 2 / 2)
+    if noise > 0:
+        z_grid = z_grid + noise * torch.randn_like(z_grid)
+    return z_grid.unsqueeze(0)
+
+
+def random_hills(dphys_cfg, n, max_height=0.5):
+    """
+    Height maps of a hill at a random position with a random height, (n, H, W).
+    """
+    x_grid, y_grid = dphys_cfg.x_grid, dphys_cfg.y_grid
+    centers = (torch.rand(n, 2, 1, 1) - 0.5) * 2 * dphys_cfg.d_max
+    heights = max_height * torch.rand(n, 1, 1)
+    return heights * torch.exp(-((x_grid - centers[:, 0]) ** 2 + (y_grid - centers[:, 1]) ** 2) / 2)
+
+
+def spearman(a, b):
+    """
+    Spearman rank correlation of the values a and b (N,).
+    """
+    ra, rb = a.argsort().argsort().float(), b.argsort().argsort().float()
+    ra, rb = ra - ra.mean(), rb - rb.mean()
+    return ((ra * rb).sum() / (ra.norm() * rb.norm())).item()
+
+
+def check(diffs, tol=1e-4):
+    """
+    Fails if any of the differences of the benchmarked outputs from their references exceeds the tolerance.
+
+    Parameters:
+    - diffs: Dictionary of the differences {name: value}.
+    - tol: Tolerance of the differences.
+    """
+    failed = [f'{name} {diff:.2e}' for name, diff in diffs.items() if not diff <= tol]
+    assert not failed, f'Differences above the tolerance {tol:g}: ' + ', '.join(failed)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import argparse
+from time import time
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import InclinationCost
+from fusionforce.models.traj_predictor.vec_env import DPhysVecEnv
+from benchmark_utils import random_hills, check
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Throughput of the vectorized environment stepping the robots '
+                                                 'on random terrains with the partial resets of the done episodes')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the environments on')
+    parser.add_argument('--n_envs', type=int, nargs='+', default=[16, 64, 256], help='Numbers of environments')
+    parser.add_argument('--n_steps', type=int, default=500, help='Number of steps')
+    parser.add_argument('--max_steps', type=int, default=200, help='Maximal number of steps of an episode')
+    parser.add_argument('--n_check_envs', type=int, default=8,
+                        help='Number of environments of the check against the rollouts')
+    return parser.parse_args()
+
+
+def check_rollout(dphysics, n_envs, device):
+    """
+    Checks the episodes of the environments against the rollouts of the same control inputs and joint angles,
+    and the partial reset of the environments.
+    """
+    dphys_cfg = dphysics.dphys_cfg
+    z_grids = random_hills(dphys_cfg, n_envs)
+    controls, _ = generate_controls(n_trajs=n_envs, time_horizon=dphys_cfg.traj_sim_time, dt=dphys_cfg.dt,
+                                    per_step=False)
+    controls = controls.to(device)
+    # the same tensor is passed every step, the static joints check runs once
+    joint_angles = 0.3 * (2 * torch.rand(n_envs, 4, device=device) - 1)
+    x = torch.zeros((n_envs, 3), device=device)
+    state = (x, torch.zeros_like(x), torch.eye(3, device=device).repeat(n_envs, 1, 1), torch.zeros_like(x))
+    costs = {'inclination': InclinationCost()}
+
+    with torch.no_grad():
+        states, _, info = dphysics(z_grid=z_grids, controls=controls, joint_angles=joint_angles,
+                                   state=tuple(s.clone() for s in state), costs=costs, return_info=True)
+        env = DPhysVecEnv(dphysics, n_envs, z_grids, costs={'inclination': InclinationCost()})
+        env.reset(state=state)
+        xs, step_costs = [], []
+        for _ in range(env.max_steps):
+            env_state, cost, done, _ = env.step(controls, joint_angles)
+            xs.append(env_state[0])
+            step_costs.append(cost)
+    assert done.all(), 'The episodes are not done after max_steps'
+
+    # the rollout positions are shifted to the equilibrium height, see DPhysics.rollout_outputs
+    Xs, Rs = states[0], states[2]
+    delta_h = dphys_cfg.robot_mass * dphys_cfg.gravity / (dphysics.stiffness + 1e-6)
+    pos_diff = (Xs - Rs[..., :3, 2] * delta_h - torch.stack(xs, dim=1)).abs().max().item()
+    cost_diff = (torch.stack(step_costs, dim=1).mean(dim=1) - info['cost']).abs().max().item()
+
+    # the partial reset places the robots of the reset environments only
+    ids = torch.arange(0, n_envs, 2, device=device)
+    kept = torch.arange(1, n_envs, 2, device=device)
+    before = env.states()
+    after = env.reset(ids, z_grid=torch.zeros(len(ids), *z_grids.shape[1:]))
+    reset_diff = max((s0[kept] - s1[kept]).abs().max().item() for s0, s1 in zip(before, after))
+    assert (env.n_steps[ids] == 0).all() and (env.n_steps[kept] == env.max_steps).all(), \
+        f'Number of the steps after the partial reset: {env.n_steps.tolist()}'
+    assert after[0][ids, :2].abs().max() == 0, 'The reset robots are not at the origin'
+
+    print(f'Check against the rollouts ({n_envs} environments, {env.max_steps} steps): max pos diff {pos_diff:.2e}, '
+          f'max cost diff {cost_diff:.2e}, partial reset diff {reset_diff:.2e}')
+    check({'pos diff': pos_diff, 'cost diff': cost_diff, 'partial reset diff': reset_diff}, tol=1e-4)
+
+
+def benchmark():
+    args = arg_parser()
+    torch.manual_seed(0)
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+    limits = torch.tensor([dphys_cfg.vel_max, dphys_cfg.omega_max], device=args.device)
+
+    check_rollout(dphysics, args.n_check_envs, args.device)
+    print(f'Vectorized environment: robot={args.robot}, device={args.device}, {args.n_steps} steps, '
+          f'max_steps={args.max_steps}, dt={dphys_cfg.dt} [sec]')
+    print(f'{"envs":>5} | {"time [sec]":>10} | {"env steps / sec":>15} | {"episodes":>8} | {"terminated":>10} | '
+          f'{"mean cost":>9}')
+    for n_envs in args.n_envs:
+        env = DPhysVecEnv(dphysics, n_envs, random_hills(dphys_cfg, n_envs),
+                          costs={'inclination': InclinationCost()}, max_steps=args.max_steps)
+        env.reset()
+        controls = (2 * torch.rand(n_envs, 2, device=args.device) - 1) * limits
+        n_episodes = torch.zeros((), dtype=torch.long, device=args.device)
+        n_terminated = torch.zeros_like(n_episodes)
+        cost_sum = torch.zeros((), device=args.device)
+        t0 = time()
+        with torch.no_grad():
+            for _ in range(args.n_steps):
+                _, cost, done, info = env.step(controls)
+                cost_sum += cost.sum()
+                n_episodes += done.sum()
+                n_terminated += (info['termination_reason'] > 0).sum()
+                # the done environments start new episodes on new terrains with new control inputs
+                n_done = int(done.sum())
+                if n_done > 0:
+                    env.reset(done, z_grid=random_hills(dphys_cfg, n_done))
+                    controls[done] = (2 * torch.rand(n_done, 2, device=args.device) - 1) * limits
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        t = time() - t0
+        print(f'{n_envs:5d} | {t:10.3f} | {n_envs * args.n_steps / t:15.1f} | {n_episodes.item():8d} | '
+              f'{n_terminated.item():10d} | {cost_sum.item() / (n_envs * args.n_steps):9.4f}')
+
+
+if __name__ == '__main__':
+    benchmark()
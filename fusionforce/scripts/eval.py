@@ -34,7 +34,7 @@ def arg_parser():
 
 
 class FusionData(ROUGH):
-    def __init__(self, path, lss_cfg=None, dphys_cfg=DPhysConfig(), is_train=False):
+    def __init__(self, path, lss_cfg=None, dphys_cfg=None, is_train=False):
         super(FusionData, self).__init__(path, lss_cfg, dphys_cfg=dphys_cfg, is_train=is_train)
 
     def get_sample(self, i):
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import os
+import argparse
+import numpy as np
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import GoalDistanceCost, InclinationCost
+from fusionforce.models.traj_predictor.surrogate import SurrogateDynamics, random_terrains
+from benchmark_utils import timed, spearman
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Fidelity report of the surrogate dynamics against DPhysics: '
+                                                 'trajectory errors, path cost ranking and speed by terrain class')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts on')
+    parser.add_argument('--weights', type=str, default=None,
+                        help='Path of the surrogate weights (../config/weights/surrogate/<robot>.pth if None)')
+    parser.add_argument('--step_dt', type=float, default=0.05, help='Time step of the surrogate [sec]')
+    parser.add_argument('--patch_size', type=int, default=16, help='Number of the terrain patch cells along a side')
+    parser.add_argument('--patch_res', type=float, default=0.2, help='Resolution of the terrain patch [m]')
+    parser.add_argument('--hidden', type=int, default=128, help='Size of the hidden layers')
+    parser.add_argument('--n_terrains', type=int, default=30, help='Number of the evaluation terrains')
+    parser.add_argument('--n_candidates', type=int, default=256, help='Number of the candidate trajectories')
+    parser.add_argument('--top_k', type=int, default=8, help='Number of the best trajectories kept by the planner')
+    parser.add_argument('--prefilter', type=int, default=4,
+                        help='The surrogate prefilter keeps prefilter * top_k candidates for DPhysics')
+    parser.add_argument('--traj_sim_time', type=float, default=3.0, help='Trajectory simulation time')
+    return parser.parse_args()
+
+
+def evaluate():
+    args = arg_parser()
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.traj_sim_time = args.traj_sim_time
+    dphys_cfg.record_forces = None
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+    weights = args.weights or os.path.join('..', 'config', 'weights', 'surrogate', f'{args.robot}.pth')
+    surrogate = SurrogateDynamics(dphys_cfg, step_dt=args.step_dt, patch_size=args.patch_size,
+                                  patch_res=args.patch_res, hidden=args.hidden,
+                                  device=args.device).from_pretrained(weights).eval()
+    step_every = int(round(args.step_dt / dphys_cfg.dt))
+
+    # held-out terrains (other random seed than the training ones) and their roughness: mean slope
+    generator = torch.Generator().manual_seed(12345)
+    z_grids = random_terrains(dphys_cfg, args.n_terrains, generator=generator)
+    dz_x, dz_y = torch.gradient(z_grids, spacing=dphys_cfg.grid_res, dim=(1, 2))
+    roughness = torch.sqrt(dz_x ** 2 + dz_y ** 2).mean(dim=(1, 2))
+    goals = (2 * torch.rand(args.n_terrains, 2, generator=generator) - 1) * 2.5
+
+    controls, _ = generate_controls(n_trajs=args.n_candidates, time_horizon=args.traj_sim_time, dt=dphys_cfg.dt,
+                                    v_range=(-dphys_cfg.vel_max, dphys_cfg.vel_max),
+                                    w_range=(-dphys_cfg.omega_max, dphys_cfg.omega_max),
+                                    per_step=False, sampling='sobol')
+    controls = controls.to(args.device)
+    K, M = args.top_k, args.prefilter * args.top_k
+
+    results = []
+    for g in range(args.n_terrains):
+        z_grid = z_grids[g:g + 1].to(args.device)
+        costs = {'goal': GoalDistanceCost(goal=goals[g]), 'inclination': InclinationCost()}
+        with torch.no_grad():
+            (states, _, info), t_dphys = timed(lambda: dphysics(z_grid=z_grid, controls=controls, costs=costs,
+                                                                return_info=True), args.device)
+            cost = info['cost']
+            (states_s, _, info_s), t_sur = timed(lambda: surrogate(z_grid, controls, costs=costs, return_info=True),
+                                                 args.device)
+            cost_s = info_s['cost']
+        # the DPhysics states at the surrogate steps
+        N_s = states_s[0].shape[1]
+        ids = torch.arange(1, N_s + 1, device=args.device) * step_every - 1
+        pos_err = torch.norm(states[0][:, ids] - states_s[0], dim=-1)
+        cost_range = (cost.max() - cost.min()).clamp(min=1e-6)
+        best = cost.argsort()[:K]
+        best_s = cost_s.argsort()
+        results.append({
+            'pos_err_mean': pos_err.mean().item(),
+            'pos_err_end': pos_err[:, -1].mean().item(),
+            'spearman': spearman(cost, cost_s),
+            # normalized cost increase of the trajectory chosen by the surrogate
+            'regret': ((cost[best_s[0]] - cost[best[0]]) / cost_range).item(),
+            # DPhysics best trajectories among the surrogate best ones
+            'recall': np.isin(best.cpu().numpy(), best_s[:M].cpu().numpy()).mean(),
+            't_dphys': t_dphys,
+            't_sur': t_sur,
+        })
+
+    print(f'Surrogate fidelity: robot={args.robot}, device={args.device}, step_dt={args.step_dt} [sec], '
+          f'{args.n_terrains} terrains, {args.n_candidates} candidates, traj_sim_time={args.traj_sim_time} [sec]')
+    print(f'{"terrain":>8} | {"slope":>5} | {"pos err [m]":>11} | {"end err [m]":>11} | {"rank corr":>9} | '
+          f'{"regret":>6} | {"recall":>6} | {"speedup":>7} | {"use":>24}')
+    # terrain classes: tertiles of the roughness
+    order = roughness.argsort().tolist()
+    classes = {'flat': order[:len(order) // 3], 'moderate': order[len(order) // 3:2 * len(order) // 3],
+               'rough': order[2 * len(order) // 3:]}
+    for name, ids in list(classes.items()) + [('all', order)]:
+        r = {k: np.mean([results[i][k] for i in ids]) for k in results[0]}
+        # the surrogate alone if it ranks the candidates as DPhysics, as a prefilter if it keeps the best ones
+        if r['spearman'] >= 0.9 and r['regret'] <= 0.05:
+            use = 'surrogate'
+        elif r['recall'] >= 0.9:
+            use = f'surrogate top-{M} + DPhysics'
+        else:
+            use = 'DPhysics'
+        print(f'{name:>8} | {roughness[ids].mean().item():5.2f} | {r["pos_err_mean"]:11.3f} | '
+              f'{r["pos_err_end"]:11.3f} | {r["spearman"]:9.3f} | {r["regret"]:6.3f} | {r["recall"]:6.2f} | '
+              f'{r["t_dphys"] / r["t_sur"]:7.1f} | {use:>24}')
+
+
+if __name__ == '__main__':
+    evaluate()
@@ -102,10 +102,10 @@ def shoot_multiple():
     # z_grid = torch.sin(x_grid) * torch.cos(y_grid)
     # z_grid = torch.zeros_like(x_grid)
 
-    # repeat the heightmap for each rigid body
-    x_grid = x_grid.repeat(num_trajs, 1, 1)
-    y_grid = y_grid.repeat(num_trajs, 1, 1)
-    z_grid = z_grid.repeat(num_trajs, 1, 1)
+    # the heightmap is shared by all the rigid bodies
+    x_grid = x_grid.unsqueeze(0)
+    y_grid = y_grid.unsqueeze(0)
+    z_grid = z_grid.unsqueeze(0)
 
     # control inputs in m/s and rad/s
     controls_front, _ = generate_controls(n_trajs=num_trajs // 2,
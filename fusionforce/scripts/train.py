@@ -38,6 +38,9 @@ def arg_parser():
     parser.add_argument('--phys_weight', type=float, default=1.0, help='Weight for physics loss')
     parser.add_argument('--traj_sim_time', type=float, default=5.0, help='Trajectory simulation time')
     parser.add_argument('--dphys_grid_res', type=float, default=0.4, help='DPhys grid resolution')
+    parser.add_argument('--checkpoint_steps', type=int, default=None,
+                        help='DPhys rollout time steps per gradient checkpointing segment (no checkpointing if None)')
+    parser.add_argument('--use_adjoint', type=str2bool, default=False, help='Use odeint_adjoint for DPhys rollout')
 
     return parser.parse_args()
 
@@ -441,7 +444,7 @@ class TrainerLSS(TrainerCore):
 
 
 class Points(ROUGH):
-    def __init__(self, path, lss_cfg=None, dphys_cfg=DPhysConfig(), is_train=True):
+    def __init__(self, path, lss_cfg=None, dphys_cfg=None, is_train=True):
         super(Points, self).__init__(path, lss_cfg, dphys_cfg=dphys_cfg, is_train=is_train)
 
     def get_sample(self, i):
@@ -530,7 +533,7 @@ class TrainerVoxelNet(TrainerCore):
 
 
 class Fusion(ROUGH):
-    def __init__(self, path, lss_cfg=None, dphys_cfg=DPhysConfig(), is_train=True):
+    def __init__(self, path, lss_cfg=None, dphys_cfg=None, is_train=True):
         super(Fusion, self).__init__(path, lss_cfg, dphys_cfg=dphys_cfg, is_train=is_train)
 
     def get_sample(self, i):
@@ -646,6 +649,8 @@ def main():
     # load configs: DPhys and LSS (terrain encoder)
     dphys_cfg = DPhysConfig(robot=args.robot, grid_res=args.dphys_grid_res)
     dphys_cfg.traj_sim_time = args.traj_sim_time
+    dphys_cfg.checkpoint_steps = args.checkpoint_steps
+    dphys_cfg.use_adjoint = args.use_adjoint
     lss_config_path = args.lss_cfg_path
     assert os.path.isfile(lss_config_path), 'LSS config file %s does not exist' % lss_config_path
     lss_cfg = read_yaml(lss_config_path)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import sys
+sys.path.append('../src')
+import os
+import argparse
+from glob import glob
+from time import time
+import numpy as np
+import torch
+from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
+from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.surrogate import SurrogateDynamics, random_terrains, rollout_trajectories
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Distill DPhysics into the surrogate step model: generate the '
+                                                 'training rollouts on random and recorded terrains and train it')
+    parser.add_argument('--robot', type=str, default='marv', help='Robot name')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the rollouts and the training on')
+    parser.add_argument('--n_terrains', type=int, default=48, help='Number of random terrains')
+    parser.add_argument('--n_recorded', type=int, default=0,
+                        help='Number of recorded terrains from the ROUGH sequences (cached terrain height maps)')
+    parser.add_argument('--seq_paths', type=str, nargs='+', default=sorted(glob('../data/ROUGH/*')),
+                        help='Paths of the ROUGH sequences of the recorded terrains')
+    parser.add_argument('--n_trajs', type=int, default=32, help='Number of trajectories per terrain')
+    parser.add_argument('--traj_sim_time', type=float, default=3.0, help='Trajectory simulation time')
+    parser.add_argument('--step_dt', type=float, default=0.05, help='Time step of the surrogate [sec]')
+    parser.add_argument('--patch_size', type=int, default=16, help='Number of the terrain patch cells along a side')
+    parser.add_argument('--patch_res', type=float, default=0.2, help='Resolution of the terrain patch [m]')
+    parser.add_argument('--hidden', type=int, default=128, help='Size of the hidden layers')
+    parser.add_argument('--unroll', type=int, default=4,
+                        help='Number of the surrogate steps unrolled from the DPhysics states in the training')
+    parser.add_argument('--nepochs', type=int, default=10, help='Number of epochs')
+    parser.add_argument('--bsz', type=int, default=1024, help='Batch size')
+    parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--weights', type=str, default=None,
+                        help='Path of the trained weights (../config/weights/surrogate/<robot>.pth if None)')
+    return parser.parse_args()
+
+
+def recorded_terrains(dphys_cfg, n, seq_paths):
+    """
+    Cached terrain height maps of the ROUGH sequences (see ROUGH.get_terrain_height_map)
+    resampled to the DPhysics grid, at most n of them.
+    """
+    paths = sorted(p for seq in seq_paths for p in glob(os.path.join(seq, 'terrain', 'rigid', '*.npy')))
+    if not paths:
+        print('No recorded terrains found, using the random ones only')
+        return torch.zeros((0,) + dphys_cfg.x_grid.shape)
+    paths = [paths[i] for i in np.linspace(0, len(paths) - 1, min(n, len(paths))).astype(int)]
+    hms = torch.stack([torch.as_tensor(np.load(p)[0], dtype=torch.float32) for p in paths])
+    return torch.nn.functional.adaptive_avg_pool2d(hms.unsqueeze(1), dphys_cfg.x_grid.shape).squeeze(1)
+
+
+def training_controls(dphys_cfg, n_trajs):
+    """
+    Control inputs for each time step covering the control ranges: constant ones and smooth time-varying ones
+    (B-splines through 4 knots), half of the trajectories each.
+    """
+    kwargs = dict(time_horizon=dphys_cfg.traj_sim_time, dt=dphys_cfg.dt,
+                  v_range=(-dphys_cfg.vel_max, dphys_cfg.vel_max), w_range=(-dphys_cfg.omega_max, dphys_cfg.omega_max))
+    controls_const, _ = generate_controls(n_trajs=n_trajs // 2, n_knots=1, **kwargs)
+    controls_spline, _ = generate_controls(n_trajs=n_trajs - n_trajs // 2, n_knots=4, **kwargs)
+    return torch.cat([controls_const, controls_spline], dim=0)
+
+
+def generate_data(dphysics, z_grids, args):
+    """
+    DPhysics trajectories on the terrains, the robots start at random poses.
+    """
+    dphys_cfg = dphysics.dphys_cfg
+    data = []
+    for g in range(len(z_grids)):
+        B = args.n_trajs
+        x = torch.zeros(B, 3)
+        x[:, :2] = (2 * torch.rand(B, 2) - 1) * dphys_cfg.d_max / 2
+        yaw = 2 * np.pi * torch.rand(B)
+        R = torch.eye(3).repeat(B, 1, 1)
+        R[:, 0, 0], R[:, 0, 1], R[:, 1, 0], R[:, 1, 1] = yaw.cos(), -yaw.sin(), yaw.sin(), yaw.cos()
+        controls = training_controls(dphys_cfg, B)
+        # half of the robots start at rest, half moving with the first control inputs (as in DPhysics by default)
+        moving = (torch.arange(B) % 2 == 1).float()
+        xd = R[:, :, 0] * (moving * controls[:, 0, 0]).unsqueeze(1)
+        omega = torch.zeros(B, 3)
+        omega[:, 2] = moving * controls[:, 0, 1]
+        state = tuple(s.to(args.device) for s in (x, xd, R, omega))
+        data.append(rollout_trajectories(dphysics, z_grids[g:g + 1].to(args.device), controls.to(args.device),
+                                         state=state))
+        data[-1]['terrain_ids'] = torch.full_like(data[-1]['terrain_ids'], g)
+    return {
+        'states': tuple(torch.cat(s, dim=0) for s in zip(*[d['states'] for d in data])),
+        'controls': torch.cat([d['controls'] for d in data], dim=0),
+        'terrain_ids': torch.cat([d['terrain_ids'] for d in data], dim=0),
+        'init_height': torch.cat([d['init_height'] for d in data], dim=0),
+    }
+
+
+def train():
+    args = arg_parser()
+    torch.manual_seed(args.seed)
+    dphys_cfg = DPhysConfig(robot=args.robot)
+    dphys_cfg.use_odeint = False
+    dphys_cfg.traj_sim_time = args.traj_sim_time
+    dphys_cfg.record_forces = None
+    dphysics = DPhysics(dphys_cfg, device=args.device)
+
+    z_grids = torch.cat([random_terrains(dphys_cfg, args.n_terrains),
+                         recorded_terrains(dphys_cfg, args.n_recorded, args.seq_paths)], dim=0)
+    t0 = time()
+    data = generate_data(dphysics, z_grids, args)
+    z_grids = z_grids.to(args.device)
+    B, N = data['controls'].shape[:2]
+    print(f'Generated {B} trajectories of {len(z_grids)} terrains in {time() - t0:.1f} [sec]')
+
+    surrogate = SurrogateDynamics(dphys_cfg, step_dt=args.step_dt, patch_size=args.patch_size,
+                                  patch_res=args.patch_res, hidden=args.hidden, device=args.device)
+    k = int(round(args.step_dt / dphys_cfg.dt))  # DPhysics time steps of a surrogate step
+    H = args.unroll
+    state_at = lambda b, t: tuple(s[b, t] for s in data['states'])
+
+    def unrolled_loss(b, t):
+        """
+        Loss of the surrogate steps unrolled from the DPhysics states (trajectories b, time steps t):
+        the predicted velocity changes against the ones reaching the DPhysics velocities after each step.
+        """
+        state = state_at(b, t)
+        terrain_ids = data['terrain_ids'][b]
+        loss = 0.0
+        for h in range(H):
+            next_state = state_at(b, t + (h + 1) * k)
+            target = surrogate.velocity_changes(state, next_state).detach() / surrogate.step_model.out_std
+            state, dv = surrogate.step(z_grids, state, data['controls'][b, t + h * k + 1], terrain_ids=terrain_ids)
+            loss = loss + ((dv - target) ** 2).mean()
+        return loss / H
+
+    def windows(trajs, n):
+        """
+        Random start time steps of n unrolled windows of the trajectories.
+        """
+        b = trajs[torch.randint(len(trajs), (n,), device=args.device)]
+        t = torch.randint(N - H * k, (n,), device=args.device)
+        return b, t
+
+    # normalization from a subset of the single step transitions
+    with torch.no_grad():
+        b, t = windows(torch.arange(B, device=args.device), 50000)
+        state = state_at(b, t)
+        patch, height = surrogate.terrain_patch(z_grids, state, terrain_ids=data['terrain_ids'][b])
+        features = surrogate.features(state, data['controls'][b, t + 1], height)
+        surrogate.step_model.set_normalization(features, surrogate.velocity_changes(state, state_at(b, t + k)))
+        surrogate.init_height.fill_(data['init_height'].mean())
+
+    # held-out trajectories for validation
+    perm = torch.randperm(B, device=args.device)
+    val_trajs, train_trajs = perm[:B // 10], perm[B // 10:]
+    n_windows = len(train_trajs) * (N - H * k) // H  # the same number of steps for each unroll length
+    val_b, val_t = windows(val_trajs, n_windows // 10)
+    optimizer = torch.optim.Adam(surrogate.parameters(), lr=args.lr)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.nepochs)
+    for epoch in range(args.nepochs):
+        surrogate.train()
+        b, t = windows(train_trajs, n_windows)
+        train_loss = 0.0
+        for i in range(0, n_windows, args.bsz):
+            loss = unrolled_loss(b[i:i + args.bsz], t[i:i + args.bsz])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item() * len(b[i:i + args.bsz])
+        scheduler.step()
+
+        surrogate.eval()
+        with torch.no_grad():
+            val_loss = 0.0
+            for i in range(0, len(val_b), args.bsz):
+                val_loss += unrolled_loss(val_b[i:i + args.bsz], val_t[i:i + args.bsz]).item() * len(val_b[i:i + args.bsz])
+        print(f'Epoch {epoch}: train loss {train_loss / n_windows:.4f}, val loss {val_loss / len(val_b):.4f}')
+
+    weights = args.weights or os.path.join('..', 'config', 'weights', 'surrogate', f'{args.robot}.pth')
+    os.makedirs(os.path.dirname(weights), exist_ok=True)
+    torch.save(surrogate.state_dict(), weights)
+    print('Saved the surrogate weights to', weights)
+
+
+if __name__ == '__main__':
+    train()
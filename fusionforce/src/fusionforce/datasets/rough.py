@@ -16,7 +16,6 @@ from ..utils import normalize, load_calib
 from .wildscenes import METAINFO as WILDSCENES_METAINFO
 from PIL import Image
 from tqdm import tqdm
-import open3d as o3d
 
 
 __all__ = [
@@ -359,6 +358,8 @@ class ROUGH(Dataset):
         return trajectory_points
 
     def get_global_cloud(self, vis=False, cached=True, save=False, step=1):
+        import open3d as o3d
+
         path = os.path.join(self.path, 'map', 'map.pcd')
         if cached and os.path.exists(path):
             # print('Loading global cloud from file...')
@@ -537,6 +538,8 @@ class ROUGH(Dataset):
         return seg
 
     def get_semantic_cloud(self, i, classes=None, vis=False):
+        import open3d as o3d
+
         mi = WILDSCENES_METAINFO
         if classes is None:
             classes = mi['classes']
@@ -595,6 +598,8 @@ class ROUGH(Dataset):
         return points, colors
 
     def global_hm_cloud(self, vis=False):
+        import open3d as o3d
+
         # create global heightmap cloud
         global_hm_cloud = []
         for i in tqdm(range(len(self))):
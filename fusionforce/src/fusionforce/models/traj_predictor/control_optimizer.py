@@ -0,0 +1,130 @@
+from time import time
+import torch
+
+
+class ControlOptimizer:
+    """
+    Gradient-based optimization of the control inputs through the differentiable DPhysics rollouts.
+    A batch of seed control inputs is refined by gradient steps on the accumulated path cost (see costs.py).
+    The trajectories are optimized independently: each of them keeps its lowest-cost control inputs.
+
+    Parameters:
+    - dphysics: DPhysics module running the rollouts.
+    - costs: Dictionary of the differentiable path cost terms {name: PathCost}.
+    - n_iters: Maximum number of the gradient steps.
+    - lr: Learning rate of the Adam optimizer.
+    - time_budget: Wall-clock budget of the optimization [sec] (no limit if None). A step is started only if
+                   it is expected to finish within the budget (the duration of the previous step is used),
+                   the first step and the final evaluation rollout are always run.
+    - control_dt: Duration of the piecewise-constant control inputs [sec] optimized from the constant seeds,
+                  the whole time horizon (constant control inputs) if None.
+    """
+    def __init__(self, dphysics, costs, n_iters=10, lr=0.1, time_budget=None, control_dt=None):
+        self.dphysics = dphysics
+        self.costs = costs
+        self.n_iters = n_iters
+        self.lr = lr
+        self.time_budget = time_budget
+        self.control_dt = control_dt
+
+    def init_controls(self, controls):
+        """
+        Returns the optimized variables initialized from the seed control inputs (B, 2) or (B, K, 2).
+        """
+        controls = torch.as_tensor(controls, dtype=torch.float32, device=self.dphysics.device)
+        if controls.dim() == 2 and self.control_dt is not None:
+            # piecewise-constant control inputs held for control_dt
+            K = int(round(self.dphysics.dphys_cfg.traj_sim_time / self.control_dt))
+            controls = controls.unsqueeze(1).repeat(1, K, 1)
+        return controls.detach().clone().requires_grad_(True)
+
+    def clamp_controls(self, controls):
+        """
+        Projects the control inputs to the robot velocity limits in place.
+        """
+        cfg = self.dphysics.dphys_cfg
+        with torch.no_grad():
+            controls[..., 0].clamp_(-cfg.vel_max, cfg.vel_max)
+            controls[..., 1].clamp_(-cfg.omega_max, cfg.omega_max)
+
+    def rollout(self, z_grid, controls, state=None, friction=None, terrain_ids=None):
+        """
+        Simulates the trajectories and returns their states and path costs (B,).
+        """
+        if state is not None:
+            state = tuple(s.clone() for s in state)  # the initial state is set to the terrain height in place
+        states, _, info = self.dphysics(z_grid=z_grid, controls=controls, state=state, friction=friction,
+                                        terrain_ids=terrain_ids, control_dt=self.control_dt,
+                                        costs=self.costs, return_info=True)
+        return states, info['cost']
+
+    def optimize(self, z_grid, controls, state=None, friction=None, terrain_ids=None):
+        """
+        Refines the seed control inputs with gradient steps on the path cost.
+
+        Parameters:
+        - z_grid: Height maps (G, H, W), see DPhysics.dphysics.
+        - controls: Seed control inputs (B, 2), or piecewise-constant control inputs (B, K, 2) held for control_dt.
+        - state: Initial robot state (x, xd, R, omega).
+        - friction: Friction maps, same shape as z_grid.
+        - terrain_ids: Index of the height map used by each trajectory (B,).
+
+        Returns:
+        - Lowest-cost control inputs of each trajectory, (B, 2) or (B, K, 2).
+        - Dictionary of the optimization results:
+            - states: Robot states (x, xd, R, omega) of the lowest-cost control inputs.
+            - cost: Lowest path cost of each trajectory (B,).
+            - costs: Path cost of each trajectory at each iteration (B, n_evals).
+            - n_evals: Number of the batch rollouts.
+            - time: Duration of the optimization [sec].
+        """
+        t0 = time()
+        u = self.init_controls(controls)
+        self.clamp_controls(u)
+        optimizer = torch.optim.Adam([u], lr=self.lr)
+
+        best_u = u.detach().clone()
+        best_cost = torch.full((u.shape[0],), float('inf'), device=u.device)
+        best_states = None
+        costs = []
+        t_iter = 0.0
+        for i in range(self.n_iters + 1):
+            t_start = time()
+            # the last evaluation is a rollout without the gradient step
+            last = i == self.n_iters or (self.time_budget is not None and
+                                         t_start - t0 + 2 * t_iter > self.time_budget)
+            with torch.set_grad_enabled(not last):
+                states, cost = self.rollout(z_grid, u, state=state, friction=friction, terrain_ids=terrain_ids)
+
+            # keep the lowest-cost control inputs of each trajectory
+            with torch.no_grad():
+                cost_d = torch.nan_to_num(cost.detach(), nan=float('inf'))
+                better = cost_d < best_cost
+                best_cost = torch.where(better, cost_d, best_cost)
+                best_u[better] = u.detach()[better]
+                states_d = tuple(s.detach() for s in states)
+                if best_states is None:
+                    best_states = states_d
+                else:
+                    best_states = tuple(torch.where(better.view(-1, *[1] * (s.dim() - 1)), s, b)
+                                        for s, b in zip(states_d, best_states))
+            costs.append(cost_d)
+            if last:
+                break
+
+            # gradient step: the trajectories are independent, so the summed cost gives the per-trajectory gradients
+            optimizer.zero_grad()
+            cost.sum().backward()
+            torch.nan_to_num_(u.grad, nan=0.0, posinf=0.0, neginf=0.0)
+            optimizer.step()
+            self.clamp_controls(u)
+            t_iter = time() - t_start
+
+        info = {
+            'states': best_states,
+            'cost': best_cost,
+            'costs': torch.stack(costs, dim=1),
+            'n_evals': len(costs),
+            'time': time() - t0,
+        }
+        return best_u, info
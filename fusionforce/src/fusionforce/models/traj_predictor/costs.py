@@ -0,0 +1,224 @@
+import torch
+
+
+def roll_pitch_from_rotation(R):
+    """
+    Computes the roll and pitch angles (extrinsic 'xyz' Euler angles) directly from the rotation matrices.
+
+    Parameters:
+    - R: Rotation matrices (..., 3, 3).
+
+    Returns:
+    - Roll (...) and pitch (...) angles [rad].
+    """
+    roll = torch.atan2(R[..., 2, 1], R[..., 2, 2])
+    pitch = -torch.asin(torch.clamp(R[..., 2, 0], min=-1.0, max=1.0))
+    return roll, pitch
+
+
+def contact_force_spread(F, mask=None):
+    """
+    Spread of the contact forces over the robot points: standard deviation of the force magnitudes.
+
+    Parameters:
+    - F: Forces at the robot points, (..., N_pts, 3).
+    - mask: Mask of the robot points, (..., N_pts), without the padding points of a robots batch
+            (see DPhysics.robot_point_mask), all the points if None.
+
+    Returns:
+    - Standard deviation of the force magnitudes over the robot points, (...).
+    """
+    f = torch.norm(F, dim=-1)
+    if mask is None:
+        return f.std(dim=-1)
+    # unbiased standard deviation over the points of each robot
+    mask = mask.to(f.dtype)
+    n = mask.sum(dim=-1)
+    mean = (f * mask).sum(dim=-1) / n
+    var = (((f - mean.unsqueeze(-1)) * mask) ** 2).sum(dim=-1) / torch.clamp(n - 1, min=1)
+    return torch.sqrt(var)
+
+
+def rows(x, ids=None):
+    """
+    Returns the rows ids of the per-trajectory tensor x, all of them if ids is None.
+    """
+    return x if ids is None else x[ids]
+
+
+def set_rows(x, values, ids=None):
+    """
+    Returns the per-trajectory tensor x with the rows ids set to values (all of them if ids is None).
+    """
+    return values if ids is None else x.index_copy(0, ids, values)
+
+
+class PathCost:
+    """
+    Path cost term accumulated step by step during the rollout.
+    The accumulated values are per trajectory, (B,), no per-step values are stored.
+    Terminated trajectories stop accumulating: the updates are then given for the active trajectories only.
+    The steps are weighted by their duration, which differs along the path in the multi-rate rollout
+    (see DPhysConfig.dt_schedule).
+
+    Parameters:
+    - weight: Weight of the cost term in the total path cost.
+    """
+    def __init__(self, weight=1.0):
+        self.weight = weight
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the accumulated cost before a new rollout.
+        """
+        self.duration = None
+        self.total = None
+
+    @staticmethod
+    def step_duration(dphysics):
+        """
+        Returns the duration of the current time step [sec], longer than dt in the multi-rate rollout.
+        """
+        return dphysics.step_dt if dphysics.step_dt is not None else dphysics.dphys_cfg.dt
+
+    def step_cost(self, dphysics, state, forces, controls_t, joint_angles_t):
+        """
+        Computes the cost of a single time step.
+
+        Parameters:
+        - dphysics: DPhysics module running the rollout.
+        - state: Tuple of the robot state (x, xd, R, omega) after the time step.
+        - forces: Tuple of the forces (F_spring, F_friction) at the robot points, (B, N_pts, 3).
+        - controls_t: Control inputs at the time step (B, 2).
+        - joint_angles_t: Joint angles at the time step (B, 4).
+
+        Returns:
+        - Cost of the time step (B,).
+        """
+        raise NotImplementedError
+
+    def init_accumulators(self, x):
+        """
+        Initializes the accumulators at the first update (all the trajectories are active) from the step cost x (B,).
+        """
+        self.duration = torch.zeros_like(x)
+        self.total = torch.zeros_like(x)
+
+    def update(self, dphysics, state, forces, controls_t, joint_angles_t, ids=None):
+        """
+        Accumulates the cost of a time step, see step_cost.
+
+        Parameters:
+        - ids: Indices of the active trajectories the state, forces and inputs belong to (all of them if None).
+        """
+        x = self.step_cost(dphysics, state, forces, controls_t, joint_angles_t)
+        dt = self.step_duration(dphysics)
+        if self.duration is None:
+            self.init_accumulators(x)
+        self.duration = set_rows(self.duration, rows(self.duration, ids) + dt, ids)
+        self.total = set_rows(self.total, rows(self.total, ids) + x * dt, ids)
+
+    def result(self):
+        """
+        Returns the accumulated cost (B,), mean of the step costs over time
+        (the mean over the time steps for a uniform step size).
+        """
+        return self.total / torch.clamp(self.duration, min=1e-6)
+
+
+class InclinationCost(PathCost):
+    """
+    Mean absolute roll and pitch angles of the robot along the path (over time).
+    """
+    def step_cost(self, dphysics, state, forces, controls_t, joint_angles_t):
+        roll, pitch = roll_pitch_from_rotation(state[2])
+        return roll.abs() + pitch.abs()
+
+
+class ContactForceCost(PathCost):
+    """
+    Variation over time of the contact forces spread over the robot points:
+    standard deviation over time of the per-step standard deviation of the contact force magnitudes.
+
+    Parameters:
+    - force: Contact force used, 'spring' (terrain reaction) or 'friction'.
+    """
+    def __init__(self, weight=1.0, force='spring'):
+        assert force in ('spring', 'friction'), f'Unknown contact force: {force}'
+        self.force_id = 0 if force == 'spring' else 1
+        super().__init__(weight=weight)
+
+    def init_accumulators(self, x):
+        # running (Welford) mean and sum of squared differences weighted by the steps duration
+        self.n_steps = torch.zeros_like(x)
+        self.duration = torch.zeros_like(x)
+        self.mean = torch.zeros_like(x)
+        self.m2 = torch.zeros_like(x)
+
+    def step_cost(self, dphysics, state, forces, controls_t, joint_angles_t):
+        return contact_force_spread(forces[self.force_id], dphysics.robot_point_mask())
+
+    def update(self, dphysics, state, forces, controls_t, joint_angles_t, ids=None):
+        x = self.step_cost(dphysics, state, forces, controls_t, joint_angles_t)
+        dt = self.step_duration(dphysics)
+        if self.duration is None:
+            self.init_accumulators(x)
+        n = rows(self.n_steps, ids) + 1
+        duration = rows(self.duration, ids) + dt
+        mean = rows(self.mean, ids)
+        delta = x - mean
+        mean = mean + delta * dt / duration
+        m2 = rows(self.m2, ids) + delta * (x - mean) * dt
+        self.n_steps = set_rows(self.n_steps, n, ids)
+        self.duration = set_rows(self.duration, duration, ids)
+        self.mean = set_rows(self.mean, mean, ids)
+        self.m2 = set_rows(self.m2, m2, ids)
+
+    def result(self):
+        # the sample standard deviation (n - 1 correction) for a uniform step size
+        var = self.m2 / torch.clamp(self.duration, min=1e-6) * self.n_steps / torch.clamp(self.n_steps - 1, min=1)
+        return torch.sqrt(var)
+
+
+class SlipEnergyCost(PathCost):
+    """
+    Energy dissipated by the track slip along the path [J]:
+    time integral of the friction forces power on the slip velocities (commanded minus actual point velocities).
+    """
+    def step_cost(self, dphysics, state, forces, controls_t, joint_angles_t):
+        _, xd_points = dphysics.points_motion(state, joint_angles_t)
+        cmd_vels = dphysics.commanded_velocities(state[2], controls_t)
+        return (forces[1] * (cmd_vels - xd_points)).sum(dim=-1).abs().sum(dim=-1)
+
+    def result(self):
+        # time integral of the slip power
+        return self.total
+
+
+class GoalDistanceCost(PathCost):
+    """
+    Mean distance of the robot from the goal position in the xy-plane along the path (over time) [m].
+
+    Parameters:
+    - goal: Goal position (x, y) in the height map frame.
+    """
+    def __init__(self, goal, weight=1.0):
+        self.goal = torch.as_tensor(goal, dtype=torch.float32)
+        super().__init__(weight=weight)
+
+    def step_cost(self, dphysics, state, forces, controls_t, joint_angles_t):
+        return torch.norm(state[0][:, :2] - self.goal.to(state[0].device), dim=-1)
+
+
+def total_cost(costs):
+    """
+    Weighted sum of the accumulated cost terms.
+
+    Parameters:
+    - costs: Dictionary of the cost terms {name: PathCost}.
+
+    Returns:
+    - Total path cost (B,).
+    """
+    return sum(c.weight * c.result() for c in costs.values())
@@ -2,7 +2,17 @@ import torch
 import numpy as np
 import yaml
 import os
-import open3d as o3d
+
+
+def robot_mesh_path(robot):
+    """
+    Returns the path to the robot mesh file.
+    """
+    if 'tradr' in robot:
+        robot = 'tradr'
+    elif 'marv' in robot:
+        robot = 'marv'
+    return os.path.join(os.path.dirname(__file__), f'../../../../config/meshes/{robot}.obj')
 
 
 def get_points_from_robot_mesh(robot, voxel_size=0.1, return_mesh=False):
@@ -17,11 +27,9 @@ def get_points_from_robot_mesh(robot, voxel_size=0.1, return_mesh=False):
     Returns:
     - Point cloud as vertices of the robot mesh.
     """
-    if 'tradr' in robot:
-        robot = 'tradr'
-    elif 'marv' in robot:
-        robot = 'marv'
-    mesh_path = os.path.join(os.path.dirname(__file__), f'../../../../config/meshes/{robot}.obj')
+    import open3d as o3d
+
+    mesh_path = robot_mesh_path(robot)
     assert os.path.exists(mesh_path), f'Mesh file {mesh_path} does not exist.'
     mesh = o3d.io.read_triangle_mesh(mesh_path)
     pcd = o3d.geometry.PointCloud()
@@ -35,14 +43,20 @@ def get_points_from_robot_mesh(robot, voxel_size=0.1, return_mesh=False):
     return x_points
 
 
-def robot_geometry(robot):
+def driving_parts_masks(robot, x_points, cog, robot_size):
     """
-    Returns the parameters of the rigid body.
-    """
-    x_points = get_points_from_robot_mesh(robot)
-    s_x, s_y = x_points[:, 0].max() - x_points[:, 0].min(), x_points[:, 1].max() - x_points[:, 1].min()
+    Returns the masks of the robot points belonging to the driving parts (tracks, flippers or wheels).
 
-    cog = x_points.mean(dim=0)
+    Parameters:
+    - robot: Name of the robot.
+    - x_points: Robot points, (N, 3).
+    - cog: Center of the robot body points, (3,).
+    - robot_size: Size of the robot body (s_x, s_y).
+
+    Returns:
+    - List of the driving parts masks, [(N,), ...].
+    """
+    s_x, s_y = robot_size
     if robot in ['tradr', 'tradr2']:
         # divide the point cloud into left and right parts
         mask_l = (x_points[..., 1] > (cog[1] + s_y / 4.)) & (x_points[..., 2] < cog[2])
@@ -63,15 +77,141 @@ def robot_geometry(robot):
         driving_parts = [mask_fl, mask_fr, mask_rl, mask_rr]
     else:
         raise ValueError(f'Robot {robot} not supported. Available robots: tradr, marv, husky')
+    return driving_parts
+
+
+def robot_geometry_cache_path(robot, voxel_size=0.1, contact_voxel_size=None, contact_height=None,
+                              inertia_voxel_size=None):
+    """
+    Returns the path to the cached robot geometry, one file per robot and points parameters,
+    in the user cache directory ($XDG_CACHE_HOME/fusionforce, ~/.cache/fusionforce by default).
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    name = f'{robot}_{voxel_size}_{contact_voxel_size}_{contact_height}_{inertia_voxel_size}.npz'
+    return os.path.join(cache_dir, 'fusionforce', name)
+
+
+def load_robot_geometry(cache_path, mesh_path):
+    """
+    Loads the cached robot geometry, see robot_geometry.
+    Returns None if the cache does not exist or is older than the robot mesh.
+    """
+    if not os.path.exists(cache_path):
+        return None
+    if os.path.exists(mesh_path) and os.path.getmtime(mesh_path) > os.path.getmtime(cache_path):
+        return None
+    data = np.load(cache_path)
+    contact_points = torch.as_tensor(data['contact_points'])
+    contact_parts = list(torch.as_tensor(data['contact_parts']))
+    robot_size = tuple(torch.as_tensor(s) for s in data['robot_size'])
+    inertia_points = torch.as_tensor(data['inertia_points'])
+    inertia_parts = list(torch.as_tensor(data['inertia_parts']))
+    return contact_points, contact_parts, robot_size, inertia_points, inertia_parts
+
+
+def save_robot_geometry(cache_path, contact_points, contact_parts, robot_size, inertia_points, inertia_parts):
+    """
+    Saves the robot geometry to the cache, see robot_geometry.
+    The cache is best-effort: returns False if it can not be written (e.g. a read-only file system).
+    """
+    # write to a temporary file first so that concurrent processes never read a partial cache
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        np.savez(tmp_path,
+                 contact_points=contact_points.numpy(),
+                 contact_parts=torch.stack(contact_parts).numpy(),
+                 robot_size=torch.stack([torch.as_tensor(s) for s in robot_size]).numpy(),
+                 inertia_points=inertia_points.numpy(),
+                 inertia_parts=torch.stack(inertia_parts).numpy())
+        os.replace(tmp_path, cache_path)
+    except OSError as ex:
+        print(f'Robot geometry is not cached, {cache_path} can not be written: {ex}')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    return True
+
+
+def robot_geometry(robot, voxel_size=0.1, contact_voxel_size=None, contact_height=None, inertia_voxel_size=None,
+                   cache=True):
+    """
+    Returns the parameters of the rigid body.
+
+    The contact points are the robot points interacting with the terrain. Optionally, they are sampled with
+    their own density and reduced to the driving parts (tracks, flippers, wheels) and the bottom of the hull,
+    as the upper-body points never touch the ground. The inertia points are a separate set of the points of
+    the whole body, used for the inertia tensor only.
+
+    Parameters:
+    - robot: Name of the robot.
+    - voxel_size: Voxel size of the robot body points, [m].
+    - contact_voxel_size: Voxel size of the contact points, [m], voxel_size if None.
+    - contact_height: Height of the hull bottom above the lowest body point kept in the contact points, [m].
+                      The driving parts points are always kept. All the points are kept if None.
+    - inertia_voxel_size: Voxel size of the inertia points, [m]. If None, the inertia points are the contact points.
+    - cache: Whether to load the geometry from (and save it to) the user cache directory
+             instead of reading and downsampling the mesh, see robot_geometry_cache_path.
+
+    Returns:
+    - Contact points, (N, 3), driving parts masks of the contact points, [(N,), ...], robot size (s_x, s_y),
+      inertia points, (N_I, 3), and driving parts masks of the inertia points, [(N_I,), ...].
+    """
+    if cache:
+        cache_path = robot_geometry_cache_path(robot, voxel_size=voxel_size, contact_voxel_size=contact_voxel_size,
+                                               contact_height=contact_height, inertia_voxel_size=inertia_voxel_size)
+        geometry = load_robot_geometry(cache_path, robot_mesh_path(robot))
+        if geometry is not None:
+            return geometry
+
+    # reference geometry of the robot body: size, center and height of the bottom
+    x_points = get_points_from_robot_mesh(robot, voxel_size=voxel_size)
+    s_x, s_y = x_points[:, 0].max() - x_points[:, 0].min(), x_points[:, 1].max() - x_points[:, 1].min()
+    cog = x_points.mean(dim=0)
+    z_min = x_points[:, 2].min()
 
     # robot size
     robot_size = (s_x, s_y)
 
-    # put tensors on the device
-    x_points = x_points
-    driving_parts = [p for p in driving_parts]
+    # contact points: driving parts and the hull bottom
+    if contact_voxel_size is not None and contact_voxel_size != voxel_size:
+        contact_points = get_points_from_robot_mesh(robot, voxel_size=contact_voxel_size)
+    else:
+        contact_points = x_points
+    contact_parts = driving_parts_masks(robot, contact_points, cog, robot_size)
+    if contact_height is not None:
+        keep = torch.stack(contact_parts).any(dim=0) | (contact_points[:, 2] <= z_min + contact_height)
+        contact_points = contact_points[keep]
+        contact_parts = [mask[keep] for mask in contact_parts]
+
+    # inertia points: the whole body
+    if inertia_voxel_size is not None:
+        inertia_points = get_points_from_robot_mesh(robot, voxel_size=inertia_voxel_size)
+        inertia_parts = driving_parts_masks(robot, inertia_points, cog, robot_size)
+    else:
+        inertia_points, inertia_parts = contact_points, contact_parts
+
+    if cache:
+        save_robot_geometry(cache_path, contact_points, contact_parts, robot_size, inertia_points, inertia_parts)
+
+    return contact_points, contact_parts, robot_size, inertia_points, inertia_parts
+
 
-    return x_points, driving_parts, robot_size
+def driving_parts_to_ids(driving_parts):
+    """
+    Converts the driving parts masks to a point-to-part index tensor.
+
+    Parameters:
+    - driving_parts: List of P driving parts masks, [(N,), ...].
+
+    Returns:
+    - Index of the driving part of each point, (N,). The points not belonging to any driving part have index P.
+    """
+    P = len(driving_parts)
+    part_ids = torch.full_like(driving_parts[0], P, dtype=torch.long)
+    for i, mask in enumerate(driving_parts):
+        part_ids[mask] = i
+    return part_ids
 
 
 class DPhysConfig:
@@ -124,7 +264,12 @@ class DPhysConfig:
             }
         else:
             raise ValueError(f'Robot {robot} not supported. Available robots: tradr, marv, husky')
-        self.robot_points, self.driving_parts, self.robot_size = robot_geometry(robot=robot)
+        # robot points: contact points interacting with the terrain and the points of the inertia tensor
+        self.contact_voxel_size = None  # voxel size of the contact points, [m], 0.1 if None
+        self.contact_height = None  # height of the hull bottom contact points above the lowest point, [m], all if None
+        self.inertia_voxel_size = None  # voxel size of the inertia points, [m], the contact points if None
+        self.geometry_cache = True  # load the robot points from the cache (~/.cache/fusionforce/*.npz) if available
+        self.update_robot_geometry()
 
         self.gravity = 9.81  # acceleration due to gravity, m/s^2
         self.gravity_direction = torch.tensor([0., 0., -1.])  # gravity direction in the world frame
@@ -148,9 +293,55 @@ class DPhysConfig:
         self.dt = 0.01
         self.n_sim_trajs = 64
         self.integration_mode = 'euler'  # 'euler', 'rk4'
+        # multi-rate fixed-step rollout: step size schedule [[t_end, step_dt], ...] over the time horizon,
+        # the step sizes are multiples of dt and the last one holds until traj_sim_time (uniform dt if None),
+        # the coarse steps are split into substeps of at most substep_dt_max for the contact stability
+        self.dt_schedule = None
+        # [sec], with the default contact stiffness the gradients of the explicit steps explode above ~0.016 sec
+        # and the states diverge above ~0.03 sec
+        self.substep_dt_max = 0.015
+        # the multi-rate rollout outputs are resampled to the time stamps of dt (at the schedule steps if False)
+        self.resample_outputs = True
 
         # using odeint for integration or not, from torchdiffeq: https://github.com/rtqichen/torchdiffeq
         self.use_odeint = True
+        # compile the fused fixed-step rollout kernel with torch.compile (used if use_odeint is False)
+        self.compile_dynamics = False
+        # memory-bounded backpropagation: gradient checkpointing of segments of checkpoint_steps time steps
+        # of the fixed-step rollout (no checkpointing if None), adjoint method for the odeint rollout
+        self.checkpoint_steps = None
+        self.use_adjoint = False
+        # precision of the per-point contact math in the forward kinematics: 'float32', 'bfloat16', 'float16',
+        # the state integration and the sums over the robot points are always in float32
+        self.contact_precision = 'float32'
+        # propagate the robot orientation as a unit quaternion in the fixed-step rollout (use_odeint is False),
+        # the recorded orientations are converted to rotation matrices on output
+        self.quaternion_state = False
+
+        # rollout outputs: record the states every record_every time step
+        self.record_every = 1
+        # recorded forces: 'points' (per robot point), 'stats' (mean, std, max over time of the contact forces
+        # spread over the robot points), None (not recorded)
+        self.record_forces = 'points'
+
+        # early termination of the trajectories (fixed-step rollout): the terminated trajectories are removed
+        # from the batch, their recorded states are padded with the last state and forces with zeros
+        self.early_termination = False
+        self.termination_check_every = 10  # check the termination conditions every n-th time step
+        self.rollover_angle = np.pi / 3  # terminate if the robot tilt exceeds the angle, [rad]
+        self.stuck_time = 1.0  # terminate if the robot moves less than stuck_dist during stuck_time, [sec]
+        self.stuck_dist = 0.05  # [m]
+        self.max_cost = None  # terminate if the accumulated path cost exceeds the value (if not None)
+
+    def update_robot_geometry(self):
+        """
+        Computes the robot points, to be called after changing the contact or inertia points parameters.
+        """
+        self.robot_points, self.driving_parts, self.robot_size, self.inertia_points, self.inertia_parts = \
+            robot_geometry(robot=self.robot, contact_voxel_size=self.contact_voxel_size,
+                           contact_height=self.contact_height, inertia_voxel_size=self.inertia_voxel_size,
+                           cache=self.geometry_cache)
+        self.driving_part_ids = driving_parts_to_ids(self.driving_parts)  # driving part index of each point
 
     def __str__(self):
         return str(self.__dict__)
@@ -1,7 +1,12 @@
+import threading
+import contextlib
+import functools
 import numpy as np
 import torch
-from torchdiffeq import odeint
+from torch.utils.checkpoint import checkpoint
+from torchdiffeq import odeint, odeint_adjoint
 from .dphys_config import DPhysConfig
+from .costs import total_cost, rows, set_rows, contact_force_spread
 
 
 def normalized(x, eps=1e-6, dim=-1):
@@ -30,18 +35,178 @@ def skew_symmetric(v):
     - Skew-symmetric matrix of the input vector.
     """
     assert v.dim() == 2 and v.shape[1] == 3
-    U = torch.zeros(v.shape[0], 3, 3, device=v.device)
-    U[:, 0, 1] = -v[:, 2]
-    U[:, 0, 2] = v[:, 1]
-    U[:, 1, 2] = -v[:, 0]
-    U[:, 1, 0] = v[:, 2]
-    U[:, 2, 0] = -v[:, 1]
-    U[:, 2, 1] = v[:, 0]
+    x, y, z = v.unbind(dim=1)
+    o = torch.zeros_like(x)
+    U = torch.stack([o, -z, y,
+                     z, o, -x,
+                     -y, x, o], dim=1).view(-1, 3, 3)
     return U
 
+def quaternion_multiply(q1, q2):
+    """
+    Hamilton product of quaternions (w, x, y, z).
+
+    Parameters:
+    - q1: Tensor of quaternions (..., 4).
+    - q2: Tensor of quaternions (..., 4).
+
+    Returns:
+    - Product q1 * q2 (..., 4).
+    """
+    w1, x1, y1, z1 = q1.unbind(dim=-1)
+    w2, x2, y2, z2 = q2.unbind(dim=-1)
+    return torch.stack([w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                        w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                        w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2], dim=-1)
+
+
+def quaternion_to_rotation(q):
+    """
+    Converts unit quaternions (w, x, y, z) to rotation matrices.
+
+    Parameters:
+    - q: Tensor of unit quaternions (..., 4).
+
+    Returns:
+    - Rotation matrices (..., 3, 3).
+    """
+    w, x, y, z = q.unbind(dim=-1)
+    R = torch.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y),
+                     2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x),
+                     2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], dim=-1)
+    return R.view(q.shape[:-1] + (3, 3))
+
+
+def rotation_to_quaternion(R):
+    """
+    Converts rotation matrices to unit quaternions (w, x, y, z) with a non-negative scalar part.
+
+    Parameters:
+    - R: Tensor of rotation matrices (..., 3, 3).
+
+    Returns:
+    - Unit quaternions (..., 4).
+    """
+    m00, m01, m02 = R[..., 0, 0], R[..., 0, 1], R[..., 0, 2]
+    m10, m11, m12 = R[..., 1, 0], R[..., 1, 1], R[..., 1, 2]
+    m20, m21, m22 = R[..., 2, 0], R[..., 2, 1], R[..., 2, 2]
+    # each candidate is the quaternion scaled by 4 * (w, x, y, z)[k], the one with the largest scale is used
+    candidates = torch.stack([
+        torch.stack([1 + m00 + m11 + m22, m21 - m12, m02 - m20, m10 - m01], dim=-1),
+        torch.stack([m21 - m12, 1 + m00 - m11 - m22, m01 + m10, m02 + m20], dim=-1),
+        torch.stack([m02 - m20, m01 + m10, 1 - m00 + m11 - m22, m12 + m21], dim=-1),
+        torch.stack([m10 - m01, m02 + m20, m12 + m21, 1 - m00 - m11 + m22], dim=-1),
+    ], dim=-2)
+    k = torch.diagonal(candidates, dim1=-2, dim2=-1).argmax(dim=-1)
+    q = torch.gather(candidates, -2, k[..., None, None].expand(k.shape + (1, 4))).squeeze(-2)
+    q = normalized(q)
+    return torch.where(q[..., :1] < 0, -q, q)
+
+
+def halton_sequence(n, dim, skip=1):
+    """
+    Returns the first n points of the Halton low-discrepancy sequence in the unit hypercube.
+
+    Parameters:
+    - n: Number of points.
+    - dim: Dimension of the points, the radical inverses in the bases of the first dim primes.
+    - skip: Number of the skipped initial points (the first one is the origin).
+
+    Returns:
+    - Points (n, dim) in [0, 1).
+    """
+    primes = []
+    p = 2
+    while len(primes) < dim:
+        if all(p % q for q in primes):
+            primes.append(p)
+        p += 1
+    ids = torch.arange(skip, skip + n, dtype=torch.float64)
+    points = torch.zeros((n, dim), dtype=torch.float64)
+    for d, base in enumerate(primes):
+        i, f = ids.clone(), 1.0
+        while torch.any(i > 0):
+            f /= base
+            points[:, d] += f * (i % base)
+            i = torch.div(i, base, rounding_mode='floor')
+    return points.float()
+
+
+def unit_samples(n, dim, sampling='random', seed=None):
+    """
+    Samples n points in the unit hypercube [0, 1)^dim.
+
+    Parameters:
+    - n: Number of points.
+    - dim: Dimension of the points.
+    - sampling: 'random' (uniform), 'sobol' or 'halton' (low-discrepancy sequences).
+    - seed: Random seed of the scrambled Sobol sequence or of the Halton sequence random shift, deterministic if None.
+
+    Returns:
+    - Points (n, dim).
+    """
+    if sampling == 'random':
+        return torch.rand(dim, n).t()  # the dimensions drawn one after another
+    if sampling == 'sobol':
+        engine = torch.quasirandom.SobolEngine(dimension=dim, scramble=seed is not None, seed=seed)
+        return engine.draw(n)
+    if sampling == 'halton':
+        points = halton_sequence(n, dim)
+        if seed is not None:
+            # random shift modulo 1 (Cranley-Patterson rotation) keeps the low discrepancy
+            shift = torch.rand(dim, generator=torch.Generator().manual_seed(seed))
+            points = (points + shift) % 1.0
+        return points
+    raise ValueError(f'Unknown sampling: {sampling}')
+
+
+def lattice_controls(n_trajs, v_range, w_range):
+    """
+    Deterministic lattice of constant control inputs (motion primitives): about sqrt(n_trajs) forward speeds,
+    each of them with evenly spaced rotational speeds, at the centers of the cells of the control ranges.
+
+    Returns:
+    - Linear and angular velocities (n_trajs, 2).
+    """
+    centers = lambda n, lo, hi: lo + (torch.arange(n) + 0.5) * (hi - lo) / n
+    n_v = max(int(round(n_trajs ** 0.5)), 1)
+    controls = []
+    for i, v in enumerate(centers(n_v, *v_range)):
+        n_w = n_trajs // n_v + (1 if i < n_trajs % n_v else 0)
+        w = centers(n_w, *w_range)
+        controls.append(torch.stack([torch.full_like(w, v.item()), w], dim=-1))
+    return torch.cat(controls, dim=0)
+
+
+def bspline_controls(knots, N):
+    """
+    Evaluates the uniform cubic B-splines of the control inputs knots at N evenly spaced time steps.
+    The splines are smooth and stay within the range of the knots (the end knots are repeated).
+
+    Parameters:
+    - knots: Control inputs knots (B, K, D), evenly spaced over the time horizon.
+    - N: Number of time steps.
+
+    Returns:
+    - Control inputs for each time step (B, N, D).
+    """
+    K = knots.shape[1]
+    P = torch.cat([knots[:, :1], knots, knots[:, -1:]], dim=1)  # (B, K + 2, D)
+    u = torch.linspace(0, K - 1, N)
+    i = torch.clamp(u.floor().long(), max=max(K - 2, 0))
+    t = (u - i).view(1, N, 1)
+    b0 = (1 - t) ** 3 / 6
+    b1 = (3 * t ** 3 - 6 * t ** 2 + 4) / 6
+    b2 = (-3 * t ** 3 + 3 * t ** 2 + 3 * t + 1) / 6
+    b3 = t ** 3 / 6
+    return b0 * P[:, i] + b1 * P[:, i + 1] + b2 * P[:, i + 2] + b3 * P[:, i + 3]
+
+
 def generate_controls(n_trajs=10,
                       time_horizon=5.0, dt=0.01,
-                      v_range=(-1.0, 1.0), w_range=(-1.0, 1.0)):
+                      v_range=(-1.0, 1.0), w_range=(-1.0, 1.0),
+                      per_step=True, sampling='random', n_knots=1, seed=None):
     """
     Generates control inputs for the robot trajectories.
 
@@ -51,16 +216,40 @@ def generate_controls(n_trajs=10,
     - dt: Time step.
     - v_range: Range of the forward speed.
     - w_range: Range of the rotational speed.
+    - per_step: Whether to repeat the constant control inputs for each time step.
+    - sampling: Sampling of the control space, 'random' (uniform), 'sobol' or 'halton' (low-discrepancy sequences
+                covering the control space evenly with few trajectories) or 'lattice' (deterministic grid of constant
+                control inputs, motion primitives).
+    - n_knots: Number of the (v, w) knots of the time-varying control inputs (cubic B-splines over the time horizon),
+               constant control inputs if 1.
+    - seed: Random seed of the 'sobol' and 'halton' sampling (randomized sequences), deterministic if None.
 
     Returns:
-    - Linear and angular velocities for the robot trajectories: (n_trajs, time_steps, 2).
+    - Linear and angular velocities for the robot trajectories: (n_trajs, time_steps, 2),
+      or (n_trajs, 2) if per_step is False.
     - Time stamps for the trajectories.
     """
     N = int(time_horizon / dt)
     time_stamps = torch.linspace(0, time_horizon, N)
 
-    v = torch.rand(n_trajs) * (v_range[1] - v_range[0]) + v_range[0]  # Forward speed
-    w = torch.rand(n_trajs) * (w_range[1] - w_range[0]) + w_range[0]  # Rotational speed
+    if sampling == 'lattice':
+        assert n_knots == 1, 'Lattice sampling generates constant control inputs only'
+        v, w = lattice_controls(n_trajs, v_range, w_range).unbind(dim=-1)
+    else:
+        # the knots are the dimensions of the sampled points: (v_1, w_1, ..., v_K, w_K)
+        u = unit_samples(n_trajs, 2 * n_knots, sampling=sampling, seed=seed).view(n_trajs, n_knots, 2)
+        v = u[..., 0] * (v_range[1] - v_range[0]) + v_range[0]  # Forward speed
+        w = u[..., 1] * (w_range[1] - w_range[0]) + w_range[0]  # Rotational speed
+        if n_knots == 1:
+            v, w = v.squeeze(1), w.squeeze(1)
+        else:
+            # time-varying control inputs: splines through the knots
+            assert per_step, 'Time-varying control inputs are generated for each time step'
+            return bspline_controls(torch.stack([v, w], dim=-1), N), time_stamps
+
+    # constant control inputs: the rollout holds them for the whole time horizon
+    if not per_step:
+        return torch.stack([v, w], dim=-1), time_stamps
 
     # repeat the control inputs for each time step
     v = v.unsqueeze(1).repeat(1, N)
@@ -141,35 +330,313 @@ def inertia_tensor(mass, points):
     return I
 
 
-class DPhysics(torch.nn.Module):
-    def __init__(self, dphys_cfg=DPhysConfig(), device='cpu'):
-        super(DPhysics, self).__init__()
-        self.dphys_cfg = dphys_cfg
-        self.device = device
-        self.x_points = self.dphys_cfg.robot_points.to(self.device).unsqueeze(0)  # robot body points, (1, N, 3)
+# reasons of the early termination of the trajectories, see DPhysics.termination_reasons
+TERMINATION_REASONS = ('none', 'off_map', 'rollover', 'stuck', 'cost')
 
-        # 1x3x3 inertia tensor, kg*m^2
-        self.I = inertia_tensor(mass=self.dphys_cfg.robot_mass, points=self.x_points).to(self.device)
-        self.I_inv = torch.linalg.inv(self.I)  # inverse of the inertia tensor
 
-        # terrain properties: heightmap, stiffness, damping, friction
+class RunningStats:
+    """
+    Running (Welford) statistics of per-trajectory values accumulated over the time steps of a rollout.
+    """
+    def __init__(self):
+        self.n = None
+        self.mean = None
+        self.m2 = None
+        self.max = None
+
+    def update(self, x, ids=None):
+        """
+        Adds the values of the current time step, (B,), or of the active trajectories ids only.
+        """
+        if self.n is None:
+            self.n = torch.ones_like(x)
+            self.mean = x
+            self.m2 = torch.zeros_like(x)
+            self.max = x
+            return
+        n = rows(self.n, ids) + 1
+        mean = rows(self.mean, ids)
+        delta = x - mean
+        mean = mean + delta / n
+        m2 = rows(self.m2, ids) + delta * (x - mean)
+        self.n = set_rows(self.n, n, ids)
+        self.mean = set_rows(self.mean, mean, ids)
+        self.m2 = set_rows(self.m2, m2, ids)
+        self.max = set_rows(self.max, torch.maximum(rows(self.max, ids), x), ids)
+
+    def result(self):
+        """
+        Returns the mean, (unbiased) standard deviation and maximum over the time steps, (B, 3).
+        """
+        std = torch.sqrt(self.m2 / torch.clamp(self.n - 1, min=1))
+        return torch.stack([self.mean, std, self.max], dim=-1)
+
+
+class RolloutState(threading.local):
+    """
+    Per-call state of the rollouts of a DPhysics module: terrain, control inputs schedule, time stamps and
+    trajectory indices. The values are separate for each thread, so that concurrent callers share one module.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Sets the values of the module before any rollout.
+        """
+        # simulation config of the current call (see DPhysics.rollout), the module config if None
+        self.dphys_cfg = None
+        # robot index of each trajectory, (B,), None if all of them are of the first robot,
+        # robot_ids of the active trajectories during the rollout (see dynamics_iter), rollout_robot_ids of all of them
+        self.robot_ids = None
+        self.rollout_robot_ids = None
+
+        # terrain properties: heightmap, friction
         self.z_grid = None
         self.friction = None
-        self.stiffness = dphys_cfg.stiffness
-        self.damping = dphys_cfg.damping
-
-        # control inputs and joint angles
+        self.terrain_ids = None  # terrain index of each trajectory, (B,), None if the terrains match the trajectories
+        # ensemble of the terrain parameters hypotheses {name: (K,)} (see expand_ensemble),
+        # hypothesis index of each trajectory, (B,), None without the ensemble
+        self.ensemble = None
+        self.ensemble_ids = None
+        self.terrain = None  # packed terrain grid: height, friction and surface normal, (G, H, W, 5)
+
+        # control inputs and joint angles: samples (B, K, D) and the sample index of each time step (N_ts,)
         self.controls = None
+        self.control_ids = None
         self.joint_angles = None
+        self.joint_ids = None
+        self.joints_static = True
+        self.rollout_status = None  # early termination status of the last rollout
+
+        # time stamps of the rollout and their spacing
+        self.ts = None
+        self.ts_step = None
+        # multi-rate rollout: end time step index (in the time steps of dt) of each schedule step (N_steps,),
+        # None for the uniform steps, and the duration of the current step (DPhysConfig.dt if None)
+        self.step_ends = None
+        self.step_dt = None
+
+    def __reduce__(self):
+        # copies (and pickles) of the module start without any per-call state
+        return RolloutState, ()
+
+
+class RolloutAttribute:
+    """
+    Attribute of a DPhysics module stored in its per-call rollout state (see RolloutState).
+    """
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return getattr(obj.rollout_state, self.name)
+
+    def __set__(self, obj, value):
+        setattr(obj.rollout_state, self.name, value)
+
+
+class DPhysics(torch.nn.Module):
+    # per-call state of the rollouts, separate for each thread
+    robot_ids = RolloutAttribute()
+    rollout_robot_ids = RolloutAttribute()
+    z_grid = RolloutAttribute()
+    friction = RolloutAttribute()
+    terrain_ids = RolloutAttribute()
+    ensemble = RolloutAttribute()
+    ensemble_ids = RolloutAttribute()
+    terrain = RolloutAttribute()
+    controls = RolloutAttribute()
+    control_ids = RolloutAttribute()
+    joint_angles = RolloutAttribute()
+    joint_ids = RolloutAttribute()
+    joints_static = RolloutAttribute()
+    rollout_status = RolloutAttribute()
+    ts = RolloutAttribute()
+    ts_step = RolloutAttribute()
+    step_ends = RolloutAttribute()
+    step_dt = RolloutAttribute()
+
+    @property
+    def dphys_cfg(self):
+        """
+        Simulation config of the current call (see rollout), the module config otherwise.
+        """
+        cfg = self.rollout_state.dphys_cfg
+        return self.module_cfg if cfg is None else cfg
+
+    @dphys_cfg.setter
+    def dphys_cfg(self, cfg):
+        self.module_cfg = cfg
+
+    @property
+    def stiffness(self):
+        """
+        Terrain stiffness [N/m] of the current call, see dphys_cfg.
+        """
+        return self.dphys_cfg.stiffness
+
+    @property
+    def damping(self):
+        """
+        Contact damping [N*s/m] of the current call (see dphys_cfg), the robots of a heterogeneous batch
+        use their own damping (robot_cfgs).
+        """
+        return self.dphys_cfg.damping
+
+    def __init__(self, dphys_cfg=None, device='cpu', robot_cfgs=None):
+        """
+        Parameters:
+        - dphys_cfg: Configuration of the robot and of the simulation.
+        - device: Device of the simulation.
+        - robot_cfgs: Configurations of the robots of a heterogeneous batch (their geometry, mass and damping),
+                      the simulation parameters are given by dphys_cfg. The robot of each trajectory is selected
+                      by the robot_ids of the rollout. If None, all the trajectories are of the dphys_cfg robot.
+        """
+        super(DPhysics, self).__init__()
+        # per-call state of the rollouts (terrain, control inputs, time stamps, ...), see RolloutState
+        self.rollout_state = RolloutState()
+        self.dphys_cfg = dphys_cfg if dphys_cfg is not None else DPhysConfig()
+        self.device = device
+        self.robot_cfgs = robot_cfgs if robot_cfgs is not None else [self.dphys_cfg]
+        self.init_robots()
+
+        # orientation state of the fixed-step rollout: unit quaternion (w, x, y, z) or rotation matrix
+        self.quaternion_state = self.dphys_cfg.quaternion_state and not self.dphys_cfg.use_odeint
+        self.contact_dtype = getattr(torch, self.dphys_cfg.contact_precision)  # precision of the per-point contact math
 
         # simulation (prediction) parameters: time horizon and step size
-        T, dt = self.dphys_cfg.traj_sim_time, self.dphys_cfg.dt
-        self.ts = torch.linspace(0, T, int(T / dt)).to(self.device)
+        self.set_time_horizon()
 
         # integration method: odeint or custom
         self.integrator = self.dynamics_odeint if self.dphys_cfg.use_odeint else self.dynamics
 
-    def forward_kinematics(self, t, state):
+        # fused (forward kinematics + integration) step of the fixed-step rollout, optionally compiled
+        self.step = self.dynamics_step
+        if self.dphys_cfg.compile_dynamics:
+            if hasattr(torch, 'compile'):
+                self.step = torch.compile(self.dynamics_step)
+            else:
+                print('torch.compile is not available (torch < 2.0), using eager rollout step')
+
+    def set_time_horizon(self, traj_sim_time=None, dt=None):
+        """
+        Sets the time horizon and the step size of the following rollouts (the config values if None)
+        and the corresponding time stamps.
+
+        Parameters:
+        - traj_sim_time: Time horizon [sec].
+        - dt: Time step [sec].
+        """
+        if traj_sim_time is not None:
+            self.dphys_cfg.traj_sim_time = traj_sim_time
+        if dt is not None:
+            self.dphys_cfg.dt = dt
+        T, dt = self.dphys_cfg.traj_sim_time, self.dphys_cfg.dt
+        self.ts = torch.linspace(0, T, int(T / dt)).to(self.device)
+        self.ts_step = T / max(len(self.ts) - 1, 1)  # spacing of the time stamps
+
+    def init_robots(self):
+        """
+        Precomputes the geometry and mass properties of the robots. The per-robot tensors have the leading robot
+        dimension R. The robot points are padded to the largest number of points N (see point_mask)
+        and the driving parts to the largest number of parts P.
+        """
+        cfgs = self.robot_cfgs
+        N = max(len(cfg.robot_points) for cfg in cfgs)
+        self.n_parts = max(len(cfg.driving_parts) for cfg in cfgs)  # number of the driving parts P
+        P = self.n_parts
+
+        x_points, point_mask, part_ids, joint_positions, I, joint_moments = [], [], [], [], [], []
+        for cfg in cfgs:
+            n_pts = len(cfg.robot_points)
+            # robot body points, (N, 3), and the mask of the robot points (False for the padding), (N,)
+            x_points.append(torch.nn.functional.pad(cfg.robot_points, (0, 0, 0, N - n_pts)))
+            point_mask.append(torch.arange(N) < n_pts)
+            # driving part index of each point, (N,), P for the points not belonging to any driving part
+            ids = cfg.driving_part_ids
+            part_ids.append(torch.nn.functional.pad(torch.where(ids == len(cfg.driving_parts), P, ids),
+                                                    (0, N - n_pts), value=P))
+            # joint positions of the driving parts, (P, 3)
+            xyz = torch.as_tensor(list(cfg.joint_positions.values())[:len(cfg.driving_parts)],
+                                  dtype=cfg.robot_points.dtype)
+            joint_positions.append(torch.nn.functional.pad(xyz, (0, 0, 0, P - len(xyz))))
+            # 3x3 inertia tensor of the inertia points: (coarse) points of the whole robot body, kg*m^2
+            I.append(inertia_tensor(mass=cfg.robot_mass, points=cfg.inertia_points.unsqueeze(0))[0])
+            # moments of the robot body points used to update the inertia tensor for the moving joints
+            joint_moments.append(self.driving_parts_moments(cfg.inertia_points, cfg.inertia_parts, xyz, P))
+
+        self.x_points = torch.stack(x_points).to(self.device)  # robot body points, (R, N, 3)
+        point_mask = torch.stack(point_mask)
+        self.point_mask = point_mask.to(self.device) if not point_mask.all() else None  # (R, N), None if no padding
+        self.part_ids = torch.stack(part_ids).to(self.device)  # driving part index of each point, (R, N)
+        self.joint_positions = torch.stack(joint_positions).to(self.device)  # (R, P, 3)
+        # joint position of the driving part of each point (zero for the static points), (R, N, 3)
+        self.point_joint_positions = torch.stack([torch.nn.functional.pad(p, (0, 0, 0, 1))[ids]
+                                                  for p, ids in zip(self.joint_positions, self.part_ids)])
+        self.I = torch.stack(I).to(self.device)  # inertia tensors, (R, 3, 3)
+        self.I_inv = torch.linalg.inv(self.I)  # inverse of the inertia tensors
+        self.joint_moments = tuple(torch.stack(m).to(self.device) for m in zip(*joint_moments))
+        # mass of an inertia point, (R,)
+        self.inertia_point_masses = torch.as_tensor([cfg.robot_mass / len(cfg.inertia_points) for cfg in cfgs],
+                                                    dtype=self.x_points.dtype, device=self.device)
+        # the flippers of marv are the only moving joints, (R,)
+        self.movable_joints = torch.as_tensor(['marv' in cfg.robot for cfg in cfgs], device=self.device)
+
+        # mass, damping (critical damping depends on the mass) and size of the robots, (R,), (R,) and (R, 2)
+        self.robot_masses = torch.as_tensor([cfg.robot_mass for cfg in cfgs], dtype=self.x_points.dtype,
+                                            device=self.device)
+        self.robot_dampings = torch.as_tensor([cfg.damping for cfg in cfgs], dtype=self.x_points.dtype,
+                                              device=self.device)
+        self.robot_sizes = torch.as_tensor([[float(s) for s in cfg.robot_size] for cfg in cfgs],
+                                           dtype=self.x_points.dtype, device=self.device)
+
+        # gravity force acting on the cog: F_grav = [0, 0, -m * g], (R, 3)
+        self.F_grav = torch.cat([cfg.robot_mass * self.dphys_cfg.gravity *
+                                 torch.as_tensor(self.dphys_cfg.gravity_direction, device=self.device).unsqueeze(0)
+                                 for cfg in cfgs])
+
+    def robot_rows(self, x):
+        """
+        Selects the per-robot tensor x, (R, ...), for the trajectories: (B, ...) indexed by self.robot_ids,
+        or (1, ...) if all the trajectories are of the first robot.
+        """
+        return x[:1] if self.robot_ids is None else x[self.robot_ids]
+
+    def robot_point_mask(self):
+        """
+        Returns the mask of the robot points without the padding of the trajectories, (B, N) or (1, N),
+        None if the robots are not padded (see point_mask).
+        """
+        return None if self.point_mask is None else self.robot_rows(self.point_mask)
+
+    def trajectory_ids(self):
+        """
+        Returns the indices of the shared terrain, robot and ensemble hypothesis of each trajectory, (B,) or None.
+        """
+        return self.terrain_ids, self.robot_ids, self.ensemble_ids
+
+    def set_trajectory_ids(self, terrain_ids, robot_ids, ensemble_ids):
+        """
+        Sets the indices of the shared terrain, robot and ensemble hypothesis of each trajectory, see trajectory_ids.
+        """
+        self.terrain_ids, self.robot_ids, self.ensemble_ids = terrain_ids, robot_ids, ensemble_ids
+
+    def forward_kinematics(self, t, state, controls_t=None, joint_angles_t=None):
+        """
+        Computes the state derivative and the robot-terrain interaction forces.
+
+        Parameters:
+        - t: Time of the state, used to look up the control inputs if they are not provided.
+        - state: Tuple of the robot state (x, xd, R, omega).
+        - controls_t: Control inputs at time t (B, 2).
+        - joint_angles_t: Joint angles at time t (B, 4).
+
+        Returns:
+        - State derivative (xd, xdd, dR, omega_d) and forces (F_spring, F_friction).
+        """
         # unpack state
         x, xd, R, omega = state
         B = x.shape[0]
@@ -180,100 +647,157 @@ class DPhysics(torch.nn.Module):
         assert omega.shape == (B, 3)
 
         # closest time step in the control inputs
-        t_id = torch.argmin(torch.abs(t - self.ts))
-        controls_t = self.controls[:, t_id]
+        if controls_t is None:
+            t_id = torch.clamp(torch.round(t / self.ts_step).long(), 0, len(self.ts) - 1)
+            controls_t = self.controls[:, self.control_ids[t_id]]
+            joint_angles_t = self.joint_angles[:, self.joint_ids[t_id]]
         assert controls_t.shape == (B, 2)
         assert controls_t.shape[1] == 2  # linear and angular velocities
-        joint_angles_t = self.joint_angles[:, t_id]
         assert joint_angles_t.shape == (B, 4)
-        assert self.z_grid.dim() == 3  # (B, H, W)
-
-        # update the robot body points based on the joint angles
-        x_points = self.update_joints(joint_angles_t)
-        assert x_points.shape == (B, N_pts, 3)
-
-        # update the inertia tensor based on the new robot body points configuration
-        I = inertia_tensor(mass=self.dphys_cfg.robot_mass, points=x_points)
-        self.I_inv = torch.linalg.inv(I)  # inverse of the inertia tensor
+        assert self.terrain.dim() == 4  # (G, H, W, 5)
 
-        # motion of point composed of cog motion and rotation of the rigid body
-        x_points = x_points @ R.transpose(1, 2) + x.unsqueeze(1)
+        # inverse of the inertia tensor for the current joints configuration
+        I_inv = self.inertia_inv(joint_angles_t)
 
-        # motion of point composed of cog motion and rotation of the rigid body
-        # Koenig's theorem in mechanics: v_i = v_cog + omega x (r_i - r_cog)
-        xd_points = xd.unsqueeze(1) + torch.linalg.cross(omega.unsqueeze(1), x_points - x.unsqueeze(1))
+        # positions and velocities of the robot body points
+        x_points, xd_points = self.points_motion(state, joint_angles_t)
+        assert x_points.shape == (B, N_pts, 3)
         assert xd_points.shape == (B, N_pts, 3)
 
-        for p in self.dphys_cfg.driving_parts:
-            assert p.dim() == 1 and p.shape[0] == x_points.shape[1]  # (N,)
-
         # compute the terrain properties at the robot points
-        z_points, n = self.interpolate_grid(self.z_grid, x_points[..., 0], x_points[..., 1], return_normals=True)
-        z_points = z_points.unsqueeze(-1)
+        z_points, friction_ceofs, n = self.query_terrain(self.terrain, x_points[..., 0], x_points[..., 1],
+                                                         terrain_ids=self.terrain_ids)
         assert z_points.shape == (B, N_pts, 1)
-        assert n.shape == (B, N_pts, 3)
-
-        friction_ceofs = self.interpolate_grid(self.friction, x_points[..., 0], x_points[..., 1]).unsqueeze(-1)
         assert friction_ceofs.shape == (B, N_pts, 1)
+        assert n.shape == (B, N_pts, 3)
 
         # check if the rigid body is in contact with the terrain
         dh_points = x_points[..., 2:3] - z_points
+
+        # precision policy: the per-point contact math runs in DPhysConfig.contact_precision,
+        # positions and heights are computed and the sums over the points are accumulated in float32
+        dtype = self.contact_dtype
+        r_points = (x_points - x.unsqueeze(1)).to(dtype)
+        dh_points, xd_points, n = dh_points.to(dtype), xd_points.to(dtype), n.to(dtype)
+        friction_ceofs = friction_ceofs.to(dtype)
+
         # in_contact = dh_points < 0.
         # soft contact model
         in_contact = torch.sigmoid(-10. * dh_points)
+        if self.point_mask is not None:
+            in_contact = in_contact * self.robot_rows(self.point_mask).unsqueeze(2)  # no forces at the padding points
         assert in_contact.shape == (B, N_pts, 1)
 
+        # mass and damping of the robot: scalars for a single robot, per trajectory (B, 1, 1) for a robots batch
+        g = self.dphys_cfg.gravity
+        if self.robot_ids is None:
+            m, damping = self.robot_cfgs[0].robot_mass, self.damping
+            F_max = m * g
+        else:
+            m = self.robot_rows(self.robot_masses).view(B, 1, 1)
+            damping = self.robot_rows(self.robot_dampings).view(B, 1, 1).to(dtype)
+            F_max = (m * g).to(dtype)
+
+        # terrain parameters hypotheses of the ensemble rollout, per trajectory (B, 1, 1)
+        stiffness = self.stiffness
+        if self.ensemble_ids is not None:
+            hypotheses = {k: v[self.ensemble_ids].view(B, 1, 1).to(dtype) for k, v in self.ensemble.items()}
+            stiffness = hypotheses.get('stiffness', stiffness)
+            damping = hypotheses.get('damping', damping)
+            if 'friction_scale' in hypotheses:
+                friction_ceofs = friction_ceofs * hypotheses['friction_scale']
+
         # reaction at the contact points as spring-damper forces
-        m, g = self.dphys_cfg.robot_mass, self.dphys_cfg.gravity
         xd_points_n = (xd_points * n).sum(dim=2).unsqueeze(2)  # normal velocity
         assert xd_points_n.shape == (B, N_pts, 1)
-        F_reaction = -torch.mul((self.stiffness * dh_points + self.damping * xd_points_n), n)  # F_s = -k * dh - b * v_n
-        n_contact_pts = torch.sum(in_contact, dim=1, keepdim=True)
+        F_reaction = -torch.mul((stiffness * dh_points + damping * xd_points_n), n)  # F_s = -k * dh - b * v_n
+        n_contact_pts = torch.sum(in_contact, dim=1, keepdim=True, dtype=torch.float32).to(dtype)
         F_reaction = torch.mul(F_reaction, in_contact) / n_contact_pts  # apply forces only at the contact points
-        F_reaction = torch.clamp(F_reaction, min=-m*g, max=m*g)
+        F_reaction = torch.clamp(F_reaction, min=-F_max, max=F_max)
         assert F_reaction.shape == (B, N_pts, 3)
 
         # static and dynamic friction forces: https://en.wikipedia.org/wiki/Friction
-        thrust_dir = normalized(R[..., 0])  # direction of the thrust
         N = torch.norm(F_reaction, dim=2)  # normal force magnitude at the contact points
-        track_vels = vw_to_track_vels(v=controls_t[:, 0], w=controls_t[:, 1],
-                                      robot_size=self.dphys_cfg.robot_size, n_tracks=len(self.dphys_cfg.driving_parts))
-        assert track_vels.shape == (B, len(self.dphys_cfg.driving_parts))
-        cmd_vels = torch.zeros_like(xd_points)
-        for i in range(len(self.dphys_cfg.driving_parts)):
-            mask = self.dphys_cfg.driving_parts[i]
-            u = track_vels[:, i].unsqueeze(1) * thrust_dir
-            cmd_vels[:, mask] = u.unsqueeze(1)
+        cmd_vels = self.commanded_velocities(R, controls_t).to(dtype)
+        assert cmd_vels.shape == (B, N_pts, 3)
         slip_vel = friction_ceofs * (cmd_vels - xd_points)
         slip_vel_n = (slip_vel * n).sum(dim=2).unsqueeze(2)  # normal velocity difference
         slip_vel_tau = slip_vel - slip_vel_n * n  # tangential velocity difference
         F_friction = N.unsqueeze(2) * slip_vel_tau  # F_f = mu * N * v_slip
-        F_friction = torch.clamp(F_friction, min=-m*g, max=m*g)
+        F_friction = torch.clamp(F_friction, min=-F_max, max=F_max)
         assert F_friction.shape == (B, N_pts, 3)
 
         # rigid body rotation: M = sum(r_i x F_i)
-        torque = torch.sum(torch.linalg.cross(x_points - x.unsqueeze(1), F_reaction + F_friction), dim=1)
-        omega_d = (self.I_inv @ torque.unsqueeze(2)).squeeze(2)  # omega_d = I^(-1) M
+        torque = torch.sum(torch.linalg.cross(r_points, F_reaction + F_friction), dim=1, dtype=torch.float32)
+        omega_d = (I_inv @ torque.unsqueeze(2)).squeeze(2)  # omega_d = I^(-1) M
         omega_d = torch.clamp(omega_d, min=-self.dphys_cfg.omega_max, max=self.dphys_cfg.omega_max)
-        Omega_skew = skew_symmetric(omega)  # Omega_skew = [omega]_x
-        dR = Omega_skew @ R  # dR = [omega]_x R
         assert omega_d.shape == (B, 3)
-        assert dR.shape == (B, 3, 3)
+        if self.quaternion_state:
+            dR = None  # the quaternion integration uses the angular velocity directly
+        else:
+            Omega_skew = skew_symmetric(omega)  # Omega_skew = [omega]_x
+            dR = Omega_skew @ R  # dR = [omega]_x R
+            assert dR.shape == (B, 3, 3)
 
         # motion of the cog
-        F_grav = m * g * torch.as_tensor(self.dphys_cfg.gravity_direction, device=self.device).unsqueeze(0)  # F_grav = [0, 0, -m * g]
-        F_cog = F_grav + F_reaction.sum(dim=1) + F_friction.sum(dim=1)  # ma = sum(F_i)
-        xdd = F_cog / m  # a = F / m
+        F_cog = (self.robot_rows(self.F_grav) + F_reaction.sum(dim=1, dtype=torch.float32)
+                 + F_friction.sum(dim=1, dtype=torch.float32))  # ma = sum(F_i)
+        xdd = F_cog / (m if self.robot_ids is None else m.view(B, 1))  # a = F / m
         assert xdd.shape == (B, 3)
 
         dstate = (xd, xdd, dR, omega_d)
-        forces = (F_reaction, F_friction)
+        forces = (F_reaction.to(x.dtype), F_friction.to(x.dtype))
 
         return dstate, forces
 
+    def points_motion(self, state, joint_angles_t):
+        """
+        Computes the positions and velocities of the robot body points in the world frame.
+
+        Parameters:
+        - state: Tuple of the robot state (x, xd, R, omega).
+        - joint_angles_t: Joint angles (B, 4).
+
+        Returns:
+        - Positions (B, N_pts, 3) and velocities (B, N_pts, 3) of the robot points.
+        """
+        x, xd, R, omega = state
+        # update the robot body points based on the joint angles
+        x_points = self.update_joints(joint_angles_t)
+
+        # motion of point composed of cog motion and rotation of the rigid body
+        x_points = x_points @ R.transpose(1, 2) + x.unsqueeze(1)
+
+        # Koenig's theorem in mechanics: v_i = v_cog + omega x (r_i - r_cog)
+        xd_points = xd.unsqueeze(1) + torch.linalg.cross(omega.unsqueeze(1), x_points - x.unsqueeze(1))
+        return x_points, xd_points
+
+    def commanded_velocities(self, R, controls_t):
+        """
+        Computes the commanded velocity of each robot point: velocity of its driving part
+        (zero for the other points) in the thrust direction.
+
+        Parameters:
+        - R: Robot orientation (B, 3, 3).
+        - controls_t: Control inputs (B, 2), linear and angular velocities.
+
+        Returns:
+        - Commanded velocities of the robot points (B, N_pts, 3).
+        """
+        B = R.shape[0]
+        thrust_dir = normalized(R[..., 0])  # direction of the thrust
+        # the tracks are ordered left, right (, left, right) for both 2 and 4 driving parts
+        robot_size = self.robot_cfgs[0].robot_size if self.robot_ids is None else self.robot_rows(self.robot_sizes).T
+        track_vels = vw_to_track_vels(v=controls_t[:, 0], w=controls_t[:, 1],
+                                      robot_size=robot_size, n_tracks=self.n_parts)
+        track_vels = torch.nn.functional.pad(track_vels, (0, 1))  # (B, P + 1)
+        part_ids = self.robot_rows(self.part_ids).expand(B, -1)  # (B, N)
+        return track_vels.gather(1, part_ids).unsqueeze(2) * thrust_dir.unsqueeze(1)
+
     def update_state(self, state, dstate, dt):
         """
         Integrates the states of the rigid body for the next time step.
+        The orientation is a rotation matrix (B, 3, 3), or a unit quaternion (B, 4) if self.quaternion_state.
         """
         x, xd, R, omega = state
         _, xdd, dR, omega_d = dstate
@@ -281,7 +805,10 @@ class DPhysics(torch.nn.Module):
         xd = self.integration_step(xd, xdd, dt, mode=self.dphys_cfg.integration_mode)
         x = self.integration_step(x, xd, dt, mode=self.dphys_cfg.integration_mode)
         omega = self.integration_step(omega, omega_d, dt, mode=self.dphys_cfg.integration_mode)
-        R = self.integrate_rotation(R, omega, dt)
+        if self.quaternion_state:
+            R = self.integrate_quaternion(R, omega, dt)
+        else:
+            R = self.integrate_rotation(R, omega, dt)
 
         state = (x, xd, R, omega)
 
@@ -318,11 +845,47 @@ class DPhysics(torch.nn.Module):
         Omega_x_norm = Omega_x / torch.clamp(theta, min=eps)
 
         # Rodrigues' formula: R_new = R * (I + Omega_x * sin(theta * dt) + Omega_x^2 * (1 - cos(theta * dt)))
-        I = torch.eye(3).to(R.device)
+        I = torch.eye(3, dtype=R.dtype, device=R.device)
         R_new = R @ (I + Omega_x_norm * torch.sin(theta * dt) + Omega_x_norm @ Omega_x_norm * (1 - torch.cos(theta * dt)))
 
         return R_new
 
+    @staticmethod
+    def integrate_quaternion(q, omega, dt, eps=1e-6):
+        """
+        Integrates the orientation quaternion for the next time step, same rotation update as integrate_rotation:
+        q_new = q * dq, where dq is the rotation by the angle |omega| * dt around omega.
+
+        Parameters:
+        - q: Tensor of unit quaternions (w, x, y, z), (B, 4).
+        - omega: Tensor of angular velocities (B, 3).
+        - dt: Time step.
+        - eps: Small value to avoid division by zero.
+
+        Returns:
+        - Updated (normalized) quaternions.
+        """
+        assert q.dim() == 2 and q.shape[1] == 4
+        assert omega.dim() == 2 and omega.shape[1] == 3
+        assert dt > 0
+
+        theta = torch.norm(omega, dim=-1, keepdim=True)
+        axis = omega / torch.clamp(theta, min=eps)
+        dq = torch.cat([torch.cos(theta * dt / 2), axis * torch.sin(theta * dt / 2)], dim=-1)
+
+        # normalization keeps the quaternion on the unit sphere (no drift of the rotation)
+        return normalized(quaternion_multiply(q, dq))
+
+    def matrix_state(self, state):
+        """
+        Returns the robot state with the orientation as a rotation matrix (B, 3, 3),
+        converted from the quaternion if self.quaternion_state.
+        """
+        if not self.quaternion_state:
+            return state
+        x, xd, q, omega = state
+        return x, xd, quaternion_to_rotation(q), omega
+
     def update_joints(self, joint_angles):
         """
         Rotate the driving parts according to the joint angles
@@ -334,29 +897,128 @@ class DPhysics(torch.nn.Module):
         - driving_parts: List of driving parts, [[fl], [fr], [rr], [rl]].
         """
         B = joint_angles.shape[0]
-        x_points = self.x_points.repeat(B, 1, 1)  # (B, N, 3)
+        x_points = self.robot_rows(self.x_points).expand(B, -1, -1)  # (B, N, 3)
 
-        # TODO: add support for other robots, not only marv
-        if self.dphys_cfg.robot != 'marv' or torch.allclose(joint_angles, torch.zeros_like(joint_angles)):
+        # the joints are checked once per rollout (see dphysics) to keep the rollout step free of host synchronization
+        if self.joints_static:
             return x_points
 
-        driving_parts = self.dphys_cfg.driving_parts
-        joint_positions = list(self.dphys_cfg.joint_positions.values())
-        for i in range(len(driving_parts)):
-            # rotate around y-axis of the joint position
-            xyz = torch.as_tensor(joint_positions[i], dtype=x_points.dtype, device=self.device).unsqueeze(0)
-            angle = joint_angles[:, i]
-            R = torch.stack([torch.cos(angle), torch.zeros_like(angle), torch.sin(angle),
-                            torch.zeros_like(angle), torch.ones_like(angle), torch.zeros_like(angle),
-                            -torch.sin(angle), torch.zeros_like(angle), torch.cos(angle)], dim=1).view(B, 3, 3)
-            mask = driving_parts[i]
-            points = x_points[:, mask]
-            points = points - xyz.unsqueeze(1)
-            points = points @ R.transpose(1, 2)
-            points = points + xyz.unsqueeze(1)
-            x_points[:, mask] = points
+        # rotate the points around y-axis of the joint position of their driving part (zero angle for the other points)
+        part_ids = self.robot_rows(self.part_ids).expand(B, -1)  # (B, N)
+        angles = torch.nn.functional.pad(joint_angles[:, :self.n_parts], (0, 1)).gather(1, part_ids)  # (B, N)
+        c, s = torch.cos(angles), torch.sin(angles)
+        point_joint_positions = self.robot_rows(self.point_joint_positions)
+        q = x_points - point_joint_positions
+        x_points = torch.stack([c * q[..., 0] + s * q[..., 2],
+                                q[..., 1].expand_as(c),
+                                -s * q[..., 0] + c * q[..., 2]], dim=-1) + point_joint_positions
         return x_points
 
+    def joint_rotations(self, joint_angles):
+        """
+        Rotation matrices of the driving parts around the y-axis of their joints.
+
+        Parameters:
+        - joint_angles: Joint angles, (B, 4).
+
+        Returns:
+        - Rotation matrices, (B, P, 3, 3), P is the number of driving parts.
+        """
+        angle = joint_angles[:, :self.n_parts]
+        c, s = torch.cos(angle), torch.sin(angle)
+        o, l = torch.zeros_like(angle), torch.ones_like(angle)
+        R = torch.stack([c, o, s,
+                         o, l, o,
+                         -s, o, c], dim=-1).view(*angle.shape, 3, 3)
+        return R
+
+    @staticmethod
+    def driving_parts_moments(points, parts, joint_positions, n_parts=None):
+        """
+        Precomputes the moments of the robot inertia points, so that the inertia tensor can be updated for any joints
+        configuration without recomputing it from all the points. For a driving part rotated by R around its joint
+        at position p, the points are r = p + R q, where q are the points relative to the joint, and their second
+        moment is sum(r r^T) = n p p^T + p (R sum(q))^T + (R sum(q)) p^T + R sum(q q^T) R^T.
+
+        Parameters:
+        - points: Inertia points of the robot, (N_I, 3).
+        - parts: Driving parts masks of the inertia points, [(N_I,), ...].
+        - joint_positions: Joint positions of the driving parts, (P, 3).
+        - n_parts: Number of the driving parts the moments are padded to (with zeros), P if None.
+
+        Returns:
+        - Second moment of the static body points, (3, 3).
+        - Number of points, (P,), first moments, (P, 3), and second moments, (P, 3, 3), of the driving parts
+          relative to their joints.
+        """
+        masks = torch.stack(parts)  # (P, N_I)
+        assert (masks.sum(dim=0) <= 1).all(), 'Driving parts must not overlap'
+
+        static = ~masks.any(dim=0)
+        S_static = points[static].T @ points[static]
+
+        n, s1, S2 = [], [], []
+        for mask, xyz in zip(parts, joint_positions):
+            q = points[mask] - xyz
+            n.append(q.shape[0])
+            s1.append(q.sum(dim=0))
+            S2.append(q.T @ q)
+        n = torch.as_tensor(n, dtype=points.dtype, device=points.device)
+        s1, S2 = torch.stack(s1), torch.stack(S2)
+
+        # padding of the missing driving parts
+        pad = (n_parts or len(parts)) - len(parts)
+        n = torch.nn.functional.pad(n, (0, pad))
+        s1 = torch.nn.functional.pad(s1, (0, 0, 0, pad))
+        S2 = torch.nn.functional.pad(S2, (0, 0, 0, 0, 0, pad))
+
+        return S_static, n, s1, S2
+
+    def inertia_inv(self, joint_angles):
+        """
+        Inverse of the inertia tensor for the given joints configuration.
+
+        Parameters:
+        - joint_angles: Joint angles, (B, 4).
+
+        Returns:
+        - Inverse of the inertia tensor, (1, 3, 3) for the static joints, (B, 3, 3) otherwise.
+        """
+        # static joints: the inertia tensor of the initial configuration
+        if self.joints_static:
+            return self.robot_rows(self.I_inv)
+
+        # update the second moment of the points with the rotated driving parts,
+        # the moments of the robots are (1, ...) for a single robot, (B, ...) for a robots batch
+        S_static, n, s1, S2 = [self.robot_rows(m) for m in self.joint_moments]
+        p = self.robot_rows(self.joint_positions)  # (B, P, 3)
+        R = self.joint_rotations(joint_angles)  # (B, P, 3, 3)
+        Rs1 = (R @ s1.unsqueeze(-1)).squeeze(-1)  # (B, P, 3)
+        S_pp = (n.unsqueeze(-1).unsqueeze(-1) * p.unsqueeze(-1) * p.unsqueeze(-2)).sum(dim=1)  # (B, 3, 3)
+        S_pq = p.unsqueeze(-1) * Rs1.unsqueeze(-2)  # (B, P, 3, 3)
+        S_qq = R @ S2 @ R.transpose(-1, -2)  # (B, P, 3, 3)
+        S = S_static + S_pp + (S_pq + S_pq.transpose(-1, -2) + S_qq).sum(dim=1)  # (B, 3, 3)
+
+        # inertia tensor of the point masses: I = m_i * (tr(S) * E - S)
+        mass_per_point = self.robot_rows(self.inertia_point_masses).view(-1, 1, 1)
+        E = torch.eye(3, dtype=S.dtype, device=S.device)
+        I = mass_per_point * (S.diagonal(dim1=-2, dim2=-1).sum(dim=-1).view(-1, 1, 1) * E - S)
+
+        return torch.linalg.inv(I)
+
+    def joints_are_static(self, joint_angles):
+        """
+        Checks whether the joint angles change the robot body geometry.
+
+        Parameters:
+        - joint_angles: Joint angles, (B, N, 4), zero for the robots without the movable joints (see init_rollout).
+
+        Returns:
+        - True if the robot body points are not moved by the joints.
+        """
+        # TODO: add support for other robots, not only marv
+        return not self.movable_joints.any() or torch.allclose(joint_angles, torch.zeros_like(joint_angles))
+
     @staticmethod
     def integration_step(x, xd, dt, mode='euler'):
         """
@@ -382,22 +1044,24 @@ class DPhysics(torch.nn.Module):
             raise ValueError(f'Unknown integration mode: {mode}')
         return x
 
-    def interpolate_grid(self, grid, x_query, y_query, return_normals=False):
+    def interpolate_grid(self, grid, x_query, y_query, return_normals=False, terrain_ids=None):
         """
         Interpolates the height at the desired (x_query, y_query) coordinates.
 
         Parameters:
-        - grid: Tensor of grid values corresponding to the x and y coordinates (3D array), (B, H, W).
+        - grid: Tensor of grid values corresponding to the x and y coordinates (3D array), (B, H, W),
+                or grids shared by the queries, (G, H, W).
         - x_query: Tensor of desired x coordinates for interpolation (2D array), (B, N).
         - y_query: Tensor of desired y coordinates for interpolation (2D array), (B, N).
         - return_normals: Bool to return the surface normals at the queried coordinates or not.
+        - terrain_ids: Index of the grid used by each query batch element, (B,).
+                       If None, the grid is either per batch element (G = B) or shared by all of them (G = 1).
 
         Returns:
         - Interpolated grid values at the queried coordinates, (B, N).
         - Surface normals at the queried coordinates (if return_normals=True), (B, N, 3).
         """
         # unpack config
-        d_max = self.dphys_cfg.d_max
         grid_res = self.dphys_cfg.grid_res
 
         # Ensure inputs are tensors
@@ -406,22 +1070,66 @@ class DPhysics(torch.nn.Module):
         y_query = torch.as_tensor(y_query)
 
         # Get the grid dimensions
-        B, H, W = grid.shape
+        G, H, W = grid.shape
+        B = x_query.shape[0]
+
+        # Compute the indices of the grid points surrounding the query points and the fractional parts
+        (i_c, i_f, i_l, i_fl), x_frac, y_frac = self.grid_indices(x_query.reshape(B, -1), y_query.reshape(B, -1), H, W)
+
+        # Look up the grid values: shared grids are read in place instead of being replicated for each query
+        if terrain_ids is None:
+            assert G in (1, B), f'Grid batch size {G} must be 1 or {B} if terrain_ids are not provided'
+            z_grid_flat = grid.reshape(G, -1).expand(B, -1)
+            lookup = lambda i: z_grid_flat.gather(1, i)
+        else:
+            assert terrain_ids.shape == (B,)
+            offsets = (terrain_ids * (H * W)).unsqueeze(1)
+            lookup = lambda i: torch.take(grid, i + offsets)
+
+        # Interpolate the z values (linear interpolation)
+        z_center = lookup(i_c)
+        z_front = lookup(i_f)
+        z_left = lookup(i_l)
+        z_front_left = lookup(i_fl)
+        z_query = (1 - x_frac) * (1 - y_frac) * z_center + \
+                  (1 - x_frac) * y_frac * z_front + \
+                  x_frac * (1 - y_frac) * z_left + \
+                  x_frac * y_frac * z_front_left
+
+        if return_normals:
+            # Estimate normals using the height map
+            dz_dx = (z_front - z_center) / grid_res
+            dz_dy = (z_left - z_center) / grid_res
+            n = torch.stack([-dz_dx, -dz_dy, torch.ones_like(dz_dx)], dim=-1)
+            n = normalized(n)
+            return z_query, n
 
-        # Flatten the grid coordinates
-        z_grid_flat = grid.reshape(B, -1)
+        return z_query
 
-        # Flatten the query coordinates
-        x_query_flat = x_query.reshape(B, -1)
-        y_query_flat = y_query.reshape(B, -1)
+    def grid_indices(self, x_query, y_query, H, W):
+        """
+        Computes the flat indices of the grid cells surrounding the query points.
+
+        Parameters:
+        - x_query: Tensor of x coordinates (B, N).
+        - y_query: Tensor of y coordinates (B, N).
+        - H, W: Grid dimensions.
+
+        Returns:
+        - Flat indices of the (center, front, left, front-left) grid points, 4 x (B, N).
+        - Fractional parts of the x and y indices, (B, N).
+        """
+        # unpack config
+        d_max = self.dphys_cfg.d_max
+        grid_res = self.dphys_cfg.grid_res
 
         # Compute the indices of the grid points surrounding the query points
-        x_i = ((x_query_flat + d_max) / grid_res).long()
-        y_i = ((y_query_flat + d_max) / grid_res).long()
+        x_i = ((x_query + d_max) / grid_res).long()
+        y_i = ((y_query + d_max) / grid_res).long()
 
         # Compute the fractional part of the indices
-        x_frac = (x_query_flat + d_max) / grid_res - x_i.float()
-        y_frac = (y_query_flat + d_max) / grid_res - y_i.float()
+        x_frac = (x_query + d_max) / grid_res - x_i.float()
+        y_frac = (y_query + d_max) / grid_res - y_i.float()
 
         # Compute the indices of the grid points
         i_c = y_i + H * x_i
@@ -434,25 +1142,67 @@ class DPhysics(torch.nn.Module):
         i_l = torch.clamp(i_l, 0, H * W - 1)
         i_fl = torch.clamp(i_fl, 0, H * W - 1)
 
-        # Interpolate the z values (linear interpolation)
-        z_center = z_grid_flat.gather(1, i_c)
-        z_front = z_grid_flat.gather(1, i_f)
-        z_left = z_grid_flat.gather(1, i_l)
-        z_front_left = z_grid_flat.gather(1, i_fl)
-        z_query = (1 - x_frac) * (1 - y_frac) * z_center + \
-                  (1 - x_frac) * y_frac * z_front + \
-                  x_frac * (1 - y_frac) * z_left + \
-                  x_frac * y_frac * z_front_left
+        return (i_c, i_f, i_l, i_fl), x_frac, y_frac
 
-        if return_normals:
-            # Estimate normals using the height map
-            dz_dx = (z_front - z_center) / grid_res
-            dz_dy = (z_left - z_center) / grid_res
-            n = torch.stack([-dz_dx, -dz_dy, torch.ones_like(dz_dx)], dim=-1)
-            n = normalized(n)
-            return z_query, n
+    def prepare_terrain(self, z_grid, friction):
+        """
+        Precomputes the terrain properties queried during the rollout. The terrain does not change during the rollout,
+        so the surface normals are estimated only once per grid cell.
 
-        return z_query
+        Parameters:
+        - z_grid: Tensor of the height maps (G, H, W).
+        - friction: Tensor of the friction maps (G, H, W).
+
+        Returns:
+        - Packed terrain grid with the channels (height, friction, nx, ny, nz), (G, H, W, 5).
+        """
+        assert z_grid.dim() == 3 and friction.shape == z_grid.shape
+        grid_res = self.dphys_cfg.grid_res
+
+        # Estimate normals using the height map: forward differences (zero at the last row and column)
+        dz_dx = torch.nn.functional.pad(z_grid[:, 1:] - z_grid[:, :-1], (0, 0, 0, 1)) / grid_res
+        dz_dy = torch.nn.functional.pad(z_grid[:, :, 1:] - z_grid[:, :, :-1], (0, 1)) / grid_res
+        n = torch.stack([-dz_dx, -dz_dy, torch.ones_like(dz_dx)], dim=-1)
+        n = normalized(n)
+
+        terrain = torch.cat([z_grid.unsqueeze(-1), friction.unsqueeze(-1), n], dim=-1)
+
+        return terrain
+
+    def query_terrain(self, terrain, x_query, y_query, terrain_ids):
+        """
+        Interpolates the packed terrain properties at the desired (x_query, y_query) coordinates
+        with a single gather of all the channels.
+
+        Parameters:
+        - terrain: Packed terrain grid (G, H, W, 5), see prepare_terrain.
+        - x_query: Tensor of desired x coordinates for interpolation (2D array), (B, N).
+        - y_query: Tensor of desired y coordinates for interpolation (2D array), (B, N).
+        - terrain_ids: Index of the terrain used by each query batch element, (B,).
+
+        Returns:
+        - Interpolated heights, (B, N, 1).
+        - Interpolated friction coefficients, (B, N, 1).
+        - Surface normals at the queried coordinates, (B, N, 3).
+        """
+        G, H, W, C = terrain.shape
+        B, N = x_query.shape
+
+        idx, x_frac, y_frac = self.grid_indices(x_query, y_query, H, W)
+        idx = torch.stack(idx, dim=-1) + (terrain_ids * H * W).view(B, 1, 1)  # (B, N, 4)
+        values = terrain.reshape(G * H * W, C)[idx]  # (B, N, 4, C)
+
+        # bilinear interpolation of the height and friction channels
+        weights = torch.stack([(1 - x_frac) * (1 - y_frac),
+                               (1 - x_frac) * y_frac,
+                               x_frac * (1 - y_frac),
+                               x_frac * y_frac], dim=-1).unsqueeze(-1)  # (B, N, 4, 1)
+        z_f = (weights * values[..., :2]).sum(dim=2)
+        z_query, friction_query = z_f[..., :1], z_f[..., 1:]
+        # surface normal of the grid cell
+        n = values[:, :, 0, 2:]
+
+        return z_query, friction_query, n
 
     def forward_kinematics_extended_state(self, t, state_extended):
         """
@@ -464,42 +1214,423 @@ class DPhysics(torch.nn.Module):
         dstate = dstate + forces
         return dstate
 
-    def dynamics(self, state):
-        Xs, Xds, Rs, Omegas, F_springs, F_frictions = [], [], [], [], [], []
-        for t in self.ts:
-            # forward kinematics
-            dstate, forces = self.forward_kinematics(t=t, state=state)
-            # update state: integration steps
-            state = self.update_state(state, dstate, self.dphys_cfg.dt)
+    def forward_kinematics_context(self, context, t, state_extended):
+        """
+        forward_kinematics_extended_state with the per-call state of the context (see step_context), the adjoint
+        method evaluates it in the backward pass after the rollout (see dynamics_odeint).
+        """
+        with self.rollout_context(context):
+            return self.forward_kinematics_extended_state(t, state_extended)
+
+    def dynamics_step(self, state, controls_t, joint_angles_t, dt=None):
+        """
+        Fused step of the fixed-step rollout: forward kinematics followed by the state integration.
+
+        Parameters:
+        - state: Tuple of the robot state (x, xd, R, omega), R is a quaternion (B, 4) if self.quaternion_state.
+        - controls_t: Control inputs at the current time step (B, 2).
+        - joint_angles_t: Joint angles at the current time step (B, 4).
+        - dt: Step size [sec], DPhysConfig.dt if None.
+
+        Returns:
+        - Updated state and the forces (F_spring, F_friction) acting at the robot points.
+        """
+        dstate, forces = self.forward_kinematics(t=None, state=self.matrix_state(state),
+                                                 controls_t=controls_t, joint_angles_t=joint_angles_t)
+        state = self.update_state(state, dstate, self.dphys_cfg.dt if dt is None else dt)
+        return state, forces
+
+    def multirate_schedule(self, N_ts):
+        """
+        Steps of the multi-rate rollout following DPhysConfig.dt_schedule over N_ts time steps of dt:
+        each step covers step_dt / dt time steps, the steps are cut at the ends of the schedule segments.
+
+        Parameters:
+        - N_ts: Number of the time steps of dt.
+
+        Returns:
+        - End time step index of each step (N_steps,), None without the schedule.
+        """
+        cfg = self.dphys_cfg
+        if cfg.dt_schedule is None:
+            return None
+        segments = sorted(cfg.dt_schedule)
+        step_ends = []
+        t_id = 0
+        for i, (t_end, step_dt) in enumerate(segments):
+            n = int(round(step_dt / cfg.dt))
+            assert n >= 1 and abs(n * cfg.dt - step_dt) < 1e-6, f'Step size {step_dt} is not a multiple of dt {cfg.dt}'
+            # the last step size holds until the end of the time horizon
+            seg_end = N_ts if i == len(segments) - 1 else min(int(round(t_end / cfg.dt)), N_ts)
+            while t_id < seg_end:
+                t_id = min(t_id + n, seg_end)
+                step_ends.append(t_id)
+        return step_ends
+
+    def rollout_steps(self):
+        """
+        Steps of the fixed-step rollout: start time step index and number of the time steps of dt of each step,
+        [(t_id, n), ...], one time step each without DPhysConfig.dt_schedule.
+        """
+        if self.step_ends is None:
+            return [(t_id, 1) for t_id in range(len(self.ts))]
+        return [(t_start, t_end - t_start) for t_start, t_end in zip([0] + self.step_ends[:-1], self.step_ends)]
+
+    def multirate_step(self, state, controls_t, joint_angles_t, n=1):
+        """
+        Step of n time steps of dt of the multi-rate rollout, split into the substeps of at most
+        DPhysConfig.substep_dt_max. The inputs and outputs are the same as for dynamics_step.
+        """
+        if n == 1:
+            return self.step(state, controls_t, joint_angles_t)
+        dt = n * self.dphys_cfg.dt
+        substep_dt_max = self.dphys_cfg.substep_dt_max
+        n_sub = max(int(np.ceil(dt / substep_dt_max - 1e-6)), 1) if substep_dt_max is not None else 1
+        for _ in range(n_sub):
+            state, forces = self.step(state, controls_t, joint_angles_t, dt / n_sub)
+        return state, forces
+
+    def resample_multirate(self, state, outputs):
+        """
+        Resamples the states and forces recorded at the steps of the multi-rate rollout to the time steps of dt
+        recorded every DPhysConfig.record_every time step (the outputs of the uniform rollout): linear interpolation
+        of the positions, velocities and forces, normalized linear interpolation of the orientation quaternions.
+
+        Parameters:
+        - state: Tuple of the initial robot state (x, xd, R, omega), the interpolation start before the first step.
+        - outputs: Tuple of the recorded (Xs, Xds, Rs, Omegas, F_springs, F_frictions) at the steps.
+
+        Returns:
+        - Tuple of the resampled (Xs, Xds, Rs, Omegas, F_springs, F_frictions).
+        """
+        # time stamps in the time steps of dt: the state after the time step t_id is recorded at t_id - 1
+        # (as in the uniform rollout), the initial state at -1
+        t_src = torch.as_tensor([-1] + [t_end - 1 for t_end in self.step_ends], dtype=torch.float32,
+                                device=self.device)
+        t_dst = torch.arange(0, self.step_ends[-1], self.dphys_cfg.record_every, dtype=torch.float32,
+                             device=self.device)
+        i = torch.clamp(torch.searchsorted(t_src, t_dst, right=True), 1, len(t_src) - 1)
+        w = (t_dst - t_src[i - 1]) / (t_src[i] - t_src[i - 1])
+
+        def lerp(X, X0):
+            # the forces are extrapolated before the first step
+            X = torch.cat([X0.unsqueeze(1) if X0 is not None else X[:, :1], X], dim=1)
+            w_X = w.view((1, -1) + (1,) * (X.dim() - 2))
+            return X[:, i - 1] * (1 - w_X) + X[:, i] * w_X
+
+        Xs, Xds, Rs, Omegas, F_springs, F_frictions = outputs
+        x0, xd0, R0, omega0 = state
+        Xs, Xds, Omegas = lerp(Xs, x0), lerp(Xds, xd0), lerp(Omegas, omega0)
+        qs = torch.cat([rotation_to_quaternion(R0).unsqueeze(1), rotation_to_quaternion(Rs)], dim=1)
+        # the quaternions of the consecutive steps in the same hemisphere
+        q0, q1 = qs[:, i - 1], qs[:, i]
+        q1 = torch.where((q0 * q1).sum(dim=-1, keepdim=True) < 0, -q1, q1)
+        Rs = quaternion_to_rotation(normalized(q0 * (1 - w.view(1, -1, 1)) + q1 * w.view(1, -1, 1)))
+        if self.dphys_cfg.record_forces == 'points':
+            F_springs, F_frictions = lerp(F_springs, None), lerp(F_frictions, None)
+        return Xs, Xds, Rs, Omegas, F_springs, F_frictions
+
+    def control_schedule(self, inputs, N_ts, control_dt=None):
+        """
+        Precomputes the index of the control input (or joint angles) sample used at each time step.
+
+        Parameters:
+        - inputs: Constant inputs (B, D), inputs for each time step (B, N_ts, D),
+                  or piecewise-constant inputs (B, K, D), each sample held for control_dt.
+        - N_ts: Number of time steps.
+        - control_dt: Duration of the piecewise-constant input samples [sec].
+
+        Returns:
+        - Input samples (B, K, D).
+        - Sample index for each time step (N_ts,).
+        """
+        if inputs.dim() == 2:
+            inputs = inputs.unsqueeze(1)
+            ids = torch.zeros(N_ts, dtype=torch.long)
+        elif control_dt is None:
+            assert inputs.shape[1] >= N_ts, f'Inputs for {inputs.shape[1]} time steps < {N_ts}'
+            ids = torch.arange(N_ts)
+        else:
+            ts = torch.arange(N_ts, dtype=torch.float64) * self.dphys_cfg.dt
+            ids = torch.clamp(torch.floor(ts / control_dt + 1e-6).long(), max=inputs.shape[1] - 1)
+        return inputs.to(self.device), ids.to(self.device)
+
+    def termination_reasons(self, state, x_ref=None, cost=None):
+        """
+        Evaluates the early termination conditions of the trajectories: off-map, rollover, stuck and path cost.
+
+        Parameters:
+        - state: Tuple of the robot state (x, xd, R, omega).
+        - x_ref: Robot positions DPhysConfig.stuck_time ago (B, 3), the stuck condition is not checked if None.
+        - cost: Accumulated path costs (B,), the cost condition is not checked if None.
+
+        Returns:
+        - Index of the termination reason in TERMINATION_REASONS for each trajectory, 0 if not terminated (B,).
+        """
+        x, xd, R, omega = state
+        cfg = self.dphys_cfg
+        conditions = {
+            'off_map': (x[:, :2].abs() > cfg.d_max).any(dim=1),
+            'rollover': R[:, 2, 2] < np.cos(cfg.rollover_angle),  # tilt of the robot z-axis from the vertical
+        }
+        if x_ref is not None:
+            conditions['stuck'] = torch.norm(x - x_ref, dim=1) < cfg.stuck_dist
+        if cost is not None:
+            conditions['cost'] = cost > cfg.max_cost
+        reasons = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+        # the first condition met is the reason of the termination
+        for name in reversed(list(conditions.keys())):
+            reasons = torch.where(conditions[name], TERMINATION_REASONS.index(name), reasons)
+        return reasons
+
+    def dynamics_iter(self, state, chunk_size=None, costs=None):
+        """
+        Fixed-step rollout yielding the recorded states and forces in chunks of time steps.
+        The states are recorded every DPhysConfig.record_every time step (the time steps ts[::record_every]),
+        the forces according to DPhysConfig.record_forces:
+        - 'points': forces at the robot points, (B, T_chunk, N_pts, 3),
+        - 'stats': running statistics of the contact forces spread over the robot points (see contact_force_spread)
+                   over the time steps so far: mean, std and max, (B, 3),
+        - None: the forces are not recorded.
+        With DPhysConfig.checkpoint_steps, the steps are computed in checkpointed segments (see checkpointed_segment).
+        With DPhysConfig.dt_schedule, the steps follow the multi-rate schedule (see multirate_schedule) and the states
+        are recorded at every step (resampled to the time steps of dt in dynamics).
+        With DPhysConfig.early_termination, the terminated trajectories are removed from the batch and only
+        the active ones are simulated further (see termination_reasons). Their recorded states are padded
+        with the last state and the forces with zeros, the termination status is kept in self.rollout_status.
+
+        Parameters:
+        - state: Tuple of the initial robot state (x, xd, R, omega).
+        - chunk_size: Maximum number of recorded time steps in a chunk, all of them in one chunk if None.
+        - costs: Dictionary of the path cost terms {name: PathCost} accumulated at each time step (see costs.py).
 
-            # unpack state, its differential, and forces
+        Yields:
+        - Tuple of the recorded (Xs, Xds, Rs, Omegas, F_springs, F_frictions).
+        """
+        # the multi-rate rollout records all its steps
+        record_every = self.dphys_cfg.record_every if self.step_ends is None else 1
+        record_forces = self.dphys_cfg.record_forces
+        assert record_forces in ('points', 'stats', None), f'Unknown forces recording mode: {record_forces}'
+        stats = (RunningStats(), RunningStats()) if record_forces == 'stats' else None
+
+        def stack_chunk(chunk):
+            states = [torch.stack(s, dim=1) for s in zip(*[c[0] for c in chunk])]
+            if self.quaternion_state:
+                states[2] = quaternion_to_rotation(states[2])
+            if record_forces == 'points':
+                forces = [torch.stack(f, dim=1) for f in zip(*[c[1] for c in chunk])]
+            elif record_forces == 'stats':
+                forces = [s.result() for s in stats]
+            else:
+                forces = [None, None]
+            return tuple(states) + tuple(forces)
+
+        def pad_forces(forces, ids):
+            return tuple(torch.zeros((B,) + F.shape[1:], dtype=F.dtype, device=F.device).index_copy(0, ids, F)
+                         for F in forces)
+
+        # orientation propagated as a quaternion
+        if self.quaternion_state:
             x, xd, R, omega = state
-            F_spring, F_friction = forces
-
-            # save states
-            Xs.append(x)
-            Xds.append(xd)
-            Rs.append(R)
-            Omegas.append(omega)
-
-            # save forces
-            F_springs.append(F_spring)
-            F_frictions.append(F_friction)
-
-        # stack the states and forces
-        Xs = torch.stack(Xs, dim=1)
-        Xds = torch.stack(Xds, dim=1)
-        Rs = torch.stack(Rs, dim=1)
-        Omegas = torch.stack(Omegas, dim=1)
-        F_springs = torch.stack(F_springs, dim=1)
-        F_frictions = torch.stack(F_frictions, dim=1)
+            state = (x, xd, rotation_to_quaternion(R), omega)
+
+        # early termination: indices of the active trajectories (all of them if None) and the termination status
+        terminate = self.dphys_cfg.early_termination
+        B = state[0].shape[0]
+        steps = self.rollout_steps()
+        N_ts = steps[-1][0] + steps[-1][1]
+        ids = None
+        controls, joint_angles = self.controls, self.joint_angles
+        traj_ids = self.trajectory_ids()
+        if terminate:
+            check_every = self.dphys_cfg.termination_check_every
+            stuck_steps = max(int(round(self.dphys_cfg.stuck_time / self.dphys_cfg.dt)), 1)
+            check_cost = self.dphys_cfg.max_cost is not None and costs is not None
+            x_ref = state[0]
+            state_last = state
+            self.rollout_status = {
+                'termination_reason': torch.zeros(B, dtype=torch.long, device=self.device),
+                'n_steps': torch.full((B,), N_ts, dtype=torch.long, device=self.device),
+            }
+
+        # gradient checkpointing: steps of the current segment (state, forces) and the rows of its active trajectories
+        seg_steps = self.dphys_cfg.checkpoint_steps
+        checkpointing = seg_steps is not None and torch.is_grad_enabled()
+        segment = []
+        seg_keep = None
+
+        chunk = []
+        control_ids, joint_ids = self.control_ids.tolist(), self.joint_ids.tolist()
+        try:
+            for t_id, (t_start, n) in enumerate(steps):
+                t_end = t_start + n
+                forces_rec = None
+                if ids is None or len(ids) > 0:
+                    # forward kinematics and integration step (of n time steps of dt in the multi-rate rollout)
+                    controls_t = controls[:, control_ids[t_start]]
+                    joint_angles_t = joint_angles[:, joint_ids[t_start]]
+                    if self.step_ends is not None:
+                        self.step_dt = n * self.dphys_cfg.dt
+                    if checkpointing:
+                        # the steps are computed by checkpointed segments, recomputed in the backward pass
+                        if not segment:
+                            segment = self.checkpointed_segment(steps[t_id:t_id + seg_steps], state, controls,
+                                                                joint_angles)
+                            seg_keep = None
+                        state, forces = segment.pop(0)
+                        if seg_keep is not None:
+                            state = tuple(s[seg_keep] for s in state)
+                            forces = tuple(F[seg_keep] for F in forces)
+                    else:
+                        state, forces = self.multirate_step(state, controls_t, joint_angles_t, n)
+
+                    # running reductions of the forces and path costs
+                    if stats is not None:
+                        for s, F in zip(stats, forces):
+                            s.update(contact_force_spread(F, self.robot_point_mask()), ids)
+                    if costs is not None:
+                        state_m = self.matrix_state(state)
+                        for c in costs.values():
+                            c.update(self, state_m, forces, controls_t, joint_angles_t, ids=ids)
+
+                    # termination conditions, checked at the first step reaching every check_every (stuck_steps)
+                    # time steps of dt
+                    check_stuck = terminate and t_end // stuck_steps > t_start // stuck_steps
+                    if terminate and (t_end // check_every > t_start // check_every or check_stuck):
+                        cost = rows(total_cost(costs), ids) if check_cost else None
+                        reasons = self.termination_reasons(self.matrix_state(state), x_ref=x_ref if check_stuck else None, cost=cost)
+                        if check_stuck:
+                            x_ref = state[0]
+                        dead = reasons > 0
+                        if dead.any():
+                            active_ids = torch.arange(B, device=self.device) if ids is None else ids
+                            state_last = tuple(set_rows(l, s, ids) for l, s in zip(state_last, state))
+                            if record_forces == 'points':
+                                forces_rec = pad_forces(forces, active_ids)
+                            self.rollout_status['termination_reason'][active_ids[dead]] = reasons[dead]
+                            self.rollout_status['n_steps'][active_ids[dead]] = t_end
+                            # compaction: only the active trajectories are simulated further
+                            keep = torch.nonzero(~dead).squeeze(1)
+                            ids = active_ids[keep]
+                            state = tuple(s[keep] for s in state)
+                            forces = tuple(F[keep] for F in forces)
+                            x_ref = x_ref[keep]
+                            controls, joint_angles = controls[keep], joint_angles[keep]
+                            self.set_trajectory_ids(*[i[ids] if i is not None else None for i in traj_ids])
+                            seg_keep = keep if seg_keep is None else seg_keep[keep]
+
+                # save states and forces, a full chunk is yielded only when there are more steps to record,
+                # so the last chunk is yielded after the whole rollout
+                if t_id % record_every == 0:
+                    if chunk_size is not None and len(chunk) == chunk_size:
+                        yield stack_chunk(chunk)
+                        chunk = []
+                    state_rec = state
+                    if ids is not None:
+                        # padding of the terminated trajectories (their forces are kept at the termination step)
+                        state_last = tuple(set_rows(l, s, ids) for l, s in zip(state_last, state))
+                        state_rec = state_last
+                        if record_forces == 'points' and forces_rec is None:
+                            forces_rec = pad_forces(forces, ids)
+                    elif forces_rec is None:
+                        forces_rec = forces
+                    chunk.append((state_rec, forces_rec if record_forces == 'points' else None))
+
+            yield stack_chunk(chunk)
+        finally:
+            self.set_trajectory_ids(*traj_ids)
+            self.step_dt = None
+
+    def step_context(self):
+        """
+        Per-call state read by the rollout steps: config, terrain, trajectory indices, ensemble hypotheses
+        and the static joints flag. The steps recomputed in the backward pass (see checkpointed_segment) get it
+        explicitly, as the backward pass runs after the call (see rollout) and possibly in another thread.
+
+        Returns:
+        - Dictionary of the RolloutState values {name: value}.
+        """
+        return {
+            'dphys_cfg': self.dphys_cfg,
+            'terrain': self.terrain,
+            'terrain_ids': self.terrain_ids,
+            'robot_ids': self.robot_ids,
+            'ensemble': self.ensemble,
+            'ensemble_ids': self.ensemble_ids,
+            'joints_static': self.joints_static,
+        }
+
+    @contextlib.contextmanager
+    def rollout_context(self, context):
+        """
+        Sets the per-call state values of the context (see step_context), the previous values are restored on exit.
+        """
+        state_prev = {name: getattr(self.rollout_state, name) for name in context}
+        for name, value in context.items():
+            setattr(self.rollout_state, name, value)
+        try:
+            yield
+        finally:
+            for name, value in state_prev.items():
+                setattr(self.rollout_state, name, value)
+
+    def rollout_segment(self, sample_ids, context, controls, joint_angles, *state):
+        """
+        Fixed-step rollout over a segment of time steps.
 
+        Parameters:
+        - sample_ids: Indices of the control inputs and joint angles samples and the number of the time steps of dt
+                      (control_id, joint_id, n) of the steps of the segment, see multirate_step.
+        - context: Per-call state of the steps, see step_context.
+        - controls: Control inputs samples (B, K, 2).
+        - joint_angles: Joint angles samples (B, K, 4).
+        - state: Robot state x, xd, R, omega at the segment start.
+
+        Returns:
+        - Tuple of the states and forces at the segment time steps (Xs, Xds, Rs, Omegas, F_springs, F_frictions),
+          each of shape (B, len(sample_ids), ...).
+        """
+        # the per-call state is set explicitly, the segment is recomputed in the backward pass after the rollout
+        with self.rollout_context(context):
+            outputs = []
+            for control_id, joint_id, n in sample_ids:
+                controls_t = controls[:, control_id]
+                joint_angles_t = joint_angles[:, joint_id]
+                state, forces = self.multirate_step(state, controls_t, joint_angles_t, n)
+                outputs.append(tuple(state) + tuple(forces))
+        return tuple(torch.stack(o, dim=1) for o in zip(*outputs))
+
+    def checkpointed_segment(self, steps, state, controls, joint_angles):
+        """
+        Runs rollout_segment with gradient checkpointing: only the segment inputs and outputs are stored
+        for the backward pass, the intermediate results of the steps are recomputed.
+
+        Parameters:
+        - steps: Start time step index and number of the time steps of dt of the segment steps, see rollout_steps.
+
+        Returns:
+        - List of the (state, forces) tuples at the segment steps.
+        """
+        sample_ids = [(self.control_ids[t_id].item(), self.joint_ids[t_id].item(), n) for t_id, n in steps]
+        outputs = checkpoint(self.rollout_segment, sample_ids, self.step_context(), controls, joint_angles, *state,
+                             use_reentrant=False)
+        return [(tuple(o[:, j] for o in outputs[:4]), tuple(o[:, j] for o in outputs[4:]))
+                for j in range(len(steps))]
+
+    def dynamics(self, state, costs=None):
+        Xs, Xds, Rs, Omegas, F_springs, F_frictions = next(self.dynamics_iter(state, costs=costs))
+        if self.step_ends is not None and self.dphys_cfg.resample_outputs:
+            Xs, Xds, Rs, Omegas, F_springs, F_frictions = self.resample_multirate(
+                state, (Xs, Xds, Rs, Omegas, F_springs, F_frictions))
         return Xs, Xds, Rs, Omegas, F_springs, F_frictions
 
-    def dynamics_odeint(self, state):
+    def dynamics_odeint(self, state, costs=None):
         """
         Simulates the dynamics of the robot using ODE solver.
+        The path costs are accumulated over the solution time steps after the integration.
         """
+        assert not self.dphys_cfg.early_termination, 'Early termination is supported by the fixed-step rollout only'
+        assert self.dphys_cfg.dt_schedule is None, 'The multi-rate schedule is supported by the fixed-step rollout only'
         B = state[0].shape[0]
         N_pts = self.x_points.shape[1]
         N_ts = len(self.ts)
@@ -507,8 +1638,20 @@ class DPhysics(torch.nn.Module):
         f_friction = torch.zeros(B, N_pts, 3, device=self.device)
         forces = (f_spring, f_friction)
         state_extended = tuple(state) + tuple(forces)
-        state_extended = odeint(self.forward_kinematics_extended_state, state_extended, self.ts,
-                                method=self.dphys_cfg.integration_mode, rtol=1e-3, atol=1e-3)
+        # the ODE function looks up the control inputs by the time stamps
+        context = dict(self.step_context(), controls=self.controls, control_ids=self.control_ids,
+                       joint_angles=self.joint_angles, joint_ids=self.joint_ids, ts=self.ts, ts_step=self.ts_step)
+        func = functools.partial(self.forward_kinematics_context, context)
+        if self.dphys_cfg.use_adjoint:
+            # adjoint method: the gradients are computed by solving the adjoint ODE backwards in time,
+            # w.r.t. the tensors the dynamics depend on (terrain, control inputs)
+            adjoint_params = tuple(p for p in (self.terrain, self.controls, self.joint_angles) if p.requires_grad)
+            state_extended = odeint_adjoint(func, state_extended, self.ts,
+                                            method=self.dphys_cfg.integration_mode, rtol=1e-3, atol=1e-3,
+                                            adjoint_params=adjoint_params)
+        else:
+            state_extended = odeint(func, state_extended, self.ts,
+                                    method=self.dphys_cfg.integration_mode, rtol=1e-3, atol=1e-3)
         Xs, Xds, Rs, Omegas, F_springs, F_frictions = state_extended
 
         # transpose the states and forces to (B, N, D)
@@ -525,94 +1668,354 @@ class DPhysics(torch.nn.Module):
         F_frictions = F_frictions.permute(1, 0, 2, 3)
         assert F_frictions.shape == (B, N_ts, N_pts, 3)
 
+        # path costs
+        if costs is not None:
+            for t_id in range(N_ts):
+                state_t = (Xs[:, t_id], Xds[:, t_id], Rs[:, t_id], Omegas[:, t_id])
+                forces_t = (F_springs[:, t_id], F_frictions[:, t_id])
+                controls_t = self.controls[:, self.control_ids[t_id]]
+                joint_angles_t = self.joint_angles[:, self.joint_ids[t_id]]
+                for c in costs.values():
+                    c.update(self, state_t, forces_t, controls_t, joint_angles_t)
+
+        # recorded states and forces, see dynamics_iter
+        k = self.dphys_cfg.record_every
+        Xs, Xds, Rs, Omegas = Xs[:, ::k], Xds[:, ::k], Rs[:, ::k], Omegas[:, ::k]
+        if self.dphys_cfg.record_forces == 'points':
+            F_springs, F_frictions = F_springs[:, ::k], F_frictions[:, ::k]
+        elif self.dphys_cfg.record_forces == 'stats':
+            mask = self.robot_point_mask()
+            mask = mask.unsqueeze(1) if mask is not None else None  # (B, 1, N) over the time steps
+            F_springs, F_frictions = [torch.stack([s.mean(dim=1), s.std(dim=1), s.amax(dim=1)], dim=-1)
+                                      for s in (contact_force_spread(F_springs, mask),
+                                                contact_force_spread(F_frictions, mask))]
+        else:
+            F_springs, F_frictions = None, None
+
         return Xs, Xds, Rs, Omegas, F_springs, F_frictions
 
-    def dphysics(self, z_grid, controls, joint_angles=None, state=None, friction=None):
+    def expand_ensemble(self, ensemble, z_grid, controls, joint_angles=None, state=None, terrain_ids=None,
+                        robot_ids=None):
         """
-        Simulates the dynamics of the robot moving on the terrain.
+        Expands the rollout inputs of B trajectories to the B * K trajectories of the ensemble rollout
+        (trajectory-major: trajectory b under hypothesis k is b * K + k) and sets the ensemble hypotheses.
+        The terrains are shared by the K hypotheses of a trajectory through the terrain ids, so the height maps
+        are not replicated and the terrain properties are prepared once per height map. The states of the
+        hypotheses diverge, so the forward kinematics runs for each of the B * K trajectories.
 
         Parameters:
-        - z_grid: Tensor of the height map (B, H, W).
-        - controls: Tensor of control inputs (B, N, 2).
-        - joint_angles: Tensor of joint angles (B, N, 4).
-        - state: Tuple of the robot state (x, xd, R, omega).
-        - stiffness: scalar or Tensor of the stiffness values at the robot points (B, H, W).
-        - damping: scalar or Tensor of the damping values at the robot points (B, H, W).
-        - friction: scalar or Tensor of the friction values at the robot points (B, H, W).
+        - ensemble: Dictionary of the terrain parameters hypotheses, tensors (K,): 'friction_scale' (scale of the
+                    friction maps), 'stiffness' [N/m], 'damping' [N*s/m]. The missing parameters are the nominal ones.
+        - The other parameters are the same as for dphysics.
 
         Returns:
-        - Tuple of the robot states and forces:
-            - states: Tuple of the robot states (x, xd, R, omega).
-            - forces: Tuple of the forces (F_springs, F_frictions).
+        - Expanded controls, joint angles, state, terrain ids and robot ids.
+        """
+        assert set(ensemble.keys()) <= {'friction_scale', 'stiffness', 'damping'}, \
+            f'Unknown ensemble parameters: {set(ensemble.keys())}'
+        self.ensemble = {k: torch.as_tensor(v, dtype=torch.float32, device=self.device).view(-1)
+                         for k, v in ensemble.items()}
+        K = len(next(iter(self.ensemble.values())))
+        assert all(len(v) == K for v in self.ensemble.values()), 'All the ensemble parameters must have K values'
+        B = controls.shape[0]
+
+        if terrain_ids is None:
+            G = z_grid.shape[0]
+            assert G in (1, B), f'Height map batch size {G} must be 1 or {B} without terrain_ids'
+            terrain_ids = torch.arange(B) if G == B else torch.zeros(B, dtype=torch.long)
+        expand = lambda x: x.repeat_interleave(K, dim=0) if x is not None else None
+        controls, joint_angles, terrain_ids, robot_ids = [expand(x) for x in (controls, joint_angles,
+                                                                              terrain_ids, robot_ids)]
+        if state is not None:
+            state = tuple(expand(x) for x in state)
+        self.ensemble_ids = torch.arange(K, device=self.device).repeat(B)
+
+        return controls, joint_angles, state, terrain_ids, robot_ids
+
+    def ensemble_size(self):
+        """
+        Returns the number of the ensemble hypotheses K, 1 without the ensemble.
+        """
+        return 1 if self.ensemble is None else len(next(iter(self.ensemble.values())))
+
+    def init_rollout(self, z_grid, controls, joint_angles=None, state=None, friction=None, terrain_ids=None,
+                     control_dt=None, robot_ids=None, ensemble=None):
         """
+        Prepares the control inputs schedule and the terrain for a rollout and returns its initial state.
+        The parameters are the same as for dphysics.
+
+        Returns:
+        - Tuple of the initial robot state (x, xd, R, omega).
+        """
+        # ensemble of the terrain parameters hypotheses, see expand_ensemble
+        self.ensemble, self.ensemble_ids = None, None
+        if ensemble is not None:
+            controls, joint_angles, state, terrain_ids, robot_ids = self.expand_ensemble(
+                ensemble, z_grid, controls, joint_angles=joint_angles, state=state,
+                terrain_ids=terrain_ids, robot_ids=robot_ids)
+
         # unpack config
         dt = self.dphys_cfg.dt
         T = self.dphys_cfg.traj_sim_time
-        batch_size = z_grid.shape[0]
+        batch_size = controls.shape[0]
+
+        # control inputs schedule
+        N_ts = int(T / dt)
+        if controls.dim() == 3 and control_dt is None:
+            N_ts = min(N_ts, controls.shape[1])
+            assert controls.shape == (batch_size, N_ts, 2), \
+                f'Controls shape {controls.shape} != {(batch_size, N_ts, 2)}'  # (B, N, 2), v, w
+        assert controls.shape[0] == batch_size and controls.shape[-1] == 2
+        self.controls, self.control_ids = self.control_schedule(controls, N_ts, control_dt)
+
+        # robot of each trajectory
+        if robot_ids is None:
+            assert len(self.robot_cfgs) == 1, 'robot_ids are required for a batch of several robots'
+        else:
+            assert robot_ids.shape == (batch_size,), f'Robot ids shape {robot_ids.shape} != {(batch_size,)}'
+            robot_ids = torch.as_tensor(robot_ids, dtype=torch.long, device=self.device)
+        self.robot_ids = self.rollout_robot_ids = robot_ids
+
+        if joint_angles is None:
+            joint_angles = torch.zeros((batch_size, 4), device=self.device)
+        assert joint_angles.shape[0] == batch_size and joint_angles.shape[-1] == 4  # [fr, fl, rr, rl]
+        self.joint_angles, self.joint_ids = self.control_schedule(joint_angles, N_ts, control_dt)
+        if robot_ids is not None:
+            # the joint angles of the robots without the movable joints are ignored
+            self.joint_angles = self.joint_angles * self.movable_joints[robot_ids].view(batch_size, 1, 1)
+        self.joints_static = self.joints_are_static(self.joint_angles)
+        # time stamps from the config, fewer if the control inputs are given for fewer time steps
+        self.set_time_horizon()
+        self.ts = self.ts[:N_ts]
+        self.rollout_status = None
+        # multi-rate rollout steps, the time stamps of the steps if the outputs are not resampled
+        self.step_ends = self.multirate_schedule(N_ts)
+        if self.step_ends is not None and not self.dphys_cfg.resample_outputs:
+            self.ts = self.ts[torch.as_tensor(self.step_ends, device=self.device) - 1]
 
         # initial state
         if state is None:
             x = torch.tensor([0.0, 0.0, 0.0]).to(self.device).repeat(batch_size, 1)
-            xd = torch.zeros_like(x); xd[:, 0] = controls[:, 0, 0]  # initial forward speed
+            xd = torch.zeros_like(x); xd[:, 0] = self.controls[:, 0, 0]  # initial forward speed
             R = torch.eye(3).to(self.device).repeat(batch_size, 1, 1)
-            omega = torch.zeros_like(x); omega[:, 2] = controls[:, 0, 1]  # initial rotational speed
+            omega = torch.zeros_like(x); omega[:, 2] = self.controls[:, 0, 1]  # initial rotational speed
             state = (x, xd, R, omega)
 
-        # terrain properties
-        friction = self.dphys_cfg.friction.repeat(batch_size, 1, 1) if friction is None else friction
+        # terrain properties: shared by the trajectories according to terrain_ids
+        friction = self.dphys_cfg.friction.expand_as(z_grid) if friction is None else friction
+        assert friction.shape == z_grid.shape, f'Friction shape {friction.shape} != height map shape {z_grid.shape}'
         self.z_grid = z_grid.to(self.device)
         self.friction = friction.to(self.device)
+        if terrain_ids is None:
+            G = z_grid.shape[0]
+            assert G in (1, batch_size), f'Height map batch size {G} must be 1 or {batch_size} without terrain_ids'
+            terrain_ids = torch.arange(batch_size) if G == batch_size else torch.zeros(batch_size, dtype=torch.long)
+        self.terrain_ids = terrain_ids.to(self.device)
+        # precompute the terrain properties queried at each step: height, friction and normals
+        self.terrain = self.prepare_terrain(self.z_grid, self.friction)
 
         # start robot at the terrain height (not under or above the terrain)
+        return self.place_on_terrain(state)
+
+    def place_on_terrain(self, state):
+        """
+        Sets the height of the robot (in place) to the mean terrain height under its points,
+        the terrain and robot of each trajectory are given by self.z_grid, self.terrain_ids and self.robot_ids.
+
+        Parameters:
+        - state: Tuple of the robot state (x, xd, R, omega).
+
+        Returns:
+        - The state with the updated position.
+        """
         x = state[0]
-        x_points = self.x_points.repeat(batch_size, 1, 1)
+        batch_size = x.shape[0]
+        x_points = self.robot_rows(self.x_points).expand(batch_size, -1, -1)
         x_points = x_points @ state[2].transpose(1, 2) + x.unsqueeze(1)
-        z_interp = self.interpolate_grid(self.z_grid, x_points[..., 0], x_points[..., 1]).mean(dim=1, keepdim=True)
+        z_interp = self.interpolate_grid(self.z_grid, x_points[..., 0], x_points[..., 1], terrain_ids=self.terrain_ids)
+        if self.point_mask is None:
+            z_interp = z_interp.mean(dim=1, keepdim=True)
+        else:
+            # mean over the robot points without the padding
+            mask = self.robot_rows(self.point_mask)
+            z_interp = (z_interp * mask).sum(dim=1, keepdim=True) / mask.sum(dim=1, keepdim=True)
         x[..., 2:3] = z_interp
 
-        N_ts = min(int(T / dt), controls.shape[1])
-        B = state[0].shape[0]
-        assert controls.shape == (B, N_ts, 2), f'Controls shape {controls.shape} != {(B, N_ts, 2)}'  # (B, N, 2), v, w
-        self.controls = controls
-        if joint_angles is None:
-            joint_angles = torch.zeros((B, N_ts, 4), device=self.device)
-        assert joint_angles.shape == (B, N_ts, 4), f'Joint angles shape {joint_angles.shape} != {(B, N_ts, 4)}'  # (B, N, 4), [fr, fl, rr, rl]
-        self.joint_angles = joint_angles
-        self.ts = self.ts[:N_ts]
-
-        # dynamics of the rigid body
-        Xs, Xds, Rs, Omegas, F_springs, F_frictions = self.integrator(state)
+        return state
 
+    def rollout_outputs(self, Xs, Xds, Rs, Omegas, F_springs, F_frictions, costs=None, return_info=False):
+        """
+        Packs the recorded states and forces of a rollout, shifting the robot positions to the equilibrium height.
+        With return_info, the rollout information is returned as well, see dphysics.
+        """
         # mg = k * delta_h, at equilibrium, delta_h = mg / k
-        delta_h = self.dphys_cfg.robot_mass * self.dphys_cfg.gravity / (self.stiffness + 1e-6)
+        if self.rollout_robot_ids is None:
+            m = self.robot_cfgs[0].robot_mass
+        else:
+            m = self.robot_masses[self.rollout_robot_ids].view(-1, 1, 1)
+        K = self.ensemble_size()
+        stiffness = self.stiffness
+        if self.ensemble is not None and 'stiffness' in self.ensemble:
+            stiffness = self.ensemble['stiffness'].repeat(Xs.shape[0] // K).view(-1, 1, 1)
+        delta_h = m * self.dphys_cfg.gravity / (stiffness + 1e-6)
         # add the equilibrium height to the robot points along the z-axis of the robot
         Xs = Xs + Rs[:, :, :3, 2] * delta_h
 
-        States = Xs, Xds, Rs, Omegas
-        Forces = F_springs, F_frictions
+        # ensemble rollout: the outputs are reshaped to (B, K, ...)
+        ensemble_view = lambda x: x.view(-1, K, *x.shape[1:]) if self.ensemble is not None and x is not None else x
+        States = tuple(ensemble_view(x) for x in (Xs, Xds, Rs, Omegas))
+        Forces = tuple(ensemble_view(F) for F in (F_springs, F_frictions))
+
+        if not return_info:
+            return States, Forces
+        info = {}
+        if costs is not None:
+            info['costs'] = {name: ensemble_view(c.result()) for name, c in costs.items()}
+            info['cost'] = ensemble_view(total_cost(costs))
+            if self.ensemble is not None:
+                # risk of the trajectories: mean and variance of the path cost over the hypotheses
+                info['cost_mean'] = info['cost'].mean(dim=1)
+                info['cost_var'] = info['cost'].var(dim=1, unbiased=False)
+        if self.rollout_status is not None:
+            info['terminated'] = ensemble_view(self.rollout_status['termination_reason'] > 0)
+            info.update({k: ensemble_view(v) for k, v in self.rollout_status.items()})
+        return States, Forces, info
+
+    def dphysics(self, z_grid, controls, joint_angles=None, state=None, friction=None, terrain_ids=None,
+                 control_dt=None, costs=None, return_info=False, robot_ids=None, ensemble=None):
+        """
+        Simulates the dynamics of the robot moving on the terrain.
+        The recorded time steps and forces are set by DPhysConfig.record_every and DPhysConfig.record_forces
+        (see dynamics_iter). With DPhysConfig.dt_schedule, the fixed-step rollout takes the steps of the multi-rate
+        schedule and the outputs are resampled to the time steps of dt (see resample_multirate), or recorded
+        at the steps (self.ts) if not DPhysConfig.resample_outputs.
+
+        Parameters:
+        - z_grid: Tensor of the height map (B, H, W), or height maps shared by the trajectories (G, H, W).
+        - controls: Tensor of control inputs for each time step (B, N, 2), constant control inputs (B, 2),
+                    or piecewise-constant control inputs (B, K, 2) if control_dt is given.
+        - joint_angles: Tensor of joint angles in the same form as the controls: (B, N, 4), (B, 4) or (B, K, 4).
+        - state: Tuple of the robot state (x, xd, R, omega).
+        - friction: scalar or Tensor of the friction values at the robot points, same shape as z_grid.
+        - terrain_ids: Index of the height map (and friction) used by each trajectory (B,).
+                       If None, z_grid is either per trajectory (G = B) or shared by all of them (G = 1).
+        - control_dt: Duration [sec] of the piecewise-constant control inputs (and joint angles) samples.
+        - costs: Dictionary of the path cost terms {name: PathCost} accumulated during the rollout (see costs.py).
+        - return_info: Whether to return the rollout information as well.
+        - robot_ids: Index of the robot (in robot_cfgs) of each trajectory (B,), required for a batch of several robots.
+                     The forces are returned for the padded robot points, zero at the padding points.
+        - ensemble: Dictionary of K terrain parameters hypotheses each trajectory is simulated under,
+                    see expand_ensemble. The outputs then have the shape (B, K, ...).
+
+        Returns:
+        - Tuple of the robot states and forces:
+            - states: Tuple of the robot states (x, xd, R, omega).
+            - forces: Tuple of the forces (F_springs, F_frictions).
+        - info: Dictionary of the rollout information (if return_info):
+            - costs: Dictionary of the accumulated cost terms {name: (B,)}.
+            - cost: Total (weighted) path cost (B,).
+            - cost_mean, cost_var: Mean and variance of the path cost over the ensemble hypotheses (B,),
+              if ensemble.
+            - terminated, termination_reason, n_steps: Early termination flags (B,), reasons
+              (indices in TERMINATION_REASONS, (B,)) and numbers of simulated time steps (B,),
+              if DPhysConfig.early_termination.
+        """
+        if costs is not None:
+            for c in costs.values():
+                c.reset()
+        state = self.init_rollout(z_grid=z_grid, controls=controls, joint_angles=joint_angles, state=state,
+                                  friction=friction, terrain_ids=terrain_ids, control_dt=control_dt,
+                                  robot_ids=robot_ids, ensemble=ensemble)
+
+        # dynamics of the rigid body
+        Xs, Xds, Rs, Omegas, F_springs, F_frictions = self.integrator(state, costs=costs)
 
-        return States, Forces
+        return self.rollout_outputs(Xs, Xds, Rs, Omegas, F_springs, F_frictions,
+                                    costs=costs, return_info=return_info)
+
+    def dphysics_iter(self, z_grid, controls, joint_angles=None, state=None, friction=None, terrain_ids=None,
+                      control_dt=None, chunk_size=None, costs=None, return_info=False, robot_ids=None,
+                      ensemble=None):
+        """
+        Simulates the dynamics of the robot moving on the terrain with the fixed-step integrator,
+        yielding the recorded states in chunks of time steps as the rollout proceeds.
+        The parameters are the same as for dphysics.
+
+        Parameters:
+        - chunk_size: Maximum number of recorded time steps in a chunk, all of them in one chunk if None.
+
+        Yields:
+        - Tuple of the robot states and forces of the chunk, see dphysics. With DPhysConfig.record_forces='stats',
+          the forces are the running statistics over the time steps simulated so far.
+          With return_info, also the rollout information with the path costs accumulated so far.
+        """
+        if costs is not None:
+            for c in costs.values():
+                c.reset()
+        state = self.init_rollout(z_grid=z_grid, controls=controls, joint_angles=joint_angles, state=state,
+                                  friction=friction, terrain_ids=terrain_ids, control_dt=control_dt,
+                                  robot_ids=robot_ids, ensemble=ensemble)
+        resample = self.step_ends is not None and self.dphys_cfg.resample_outputs
+        assert not resample or chunk_size is None, 'The multi-rate rollout outputs are resampled in one chunk'
+        for outputs in self.dynamics_iter(state, chunk_size=chunk_size, costs=costs):
+            if resample:
+                outputs = self.resample_multirate(state, outputs)
+            yield self.rollout_outputs(*outputs, costs=costs, return_info=return_info)
+
+    def rollout(self, z_grid, controls, dphys_cfg=None, **kwargs):
+        """
+        Re-entrant rollout for concurrent callers (threads) sharing the module: the per-call state
+        (see RolloutState) is separate for each thread and reset to the module config after the call.
+        The path costs accumulate their values, so each caller passes its own cost terms.
+
+        Parameters:
+        - z_grid: Height maps, see dphysics.
+        - controls: Control inputs, see dphysics.
+        - dphys_cfg: Simulation config of the call (time horizon, step size, terrain stiffness, damping and friction,
+                     termination and recording parameters), the module config if None. The robot geometry and mass
+                     (and the damping of the robots of a heterogeneous batch, see robot_cfgs), the integration method,
+                     the orientation state and the contact precision are those of the module.
+        - kwargs: Other arguments of dphysics.
+
+        Returns:
+        - See dphysics.
+        """
+        self.rollout_state.reset()
+        self.rollout_state.dphys_cfg = dphys_cfg
+        try:
+            return self.dphysics(z_grid=z_grid, controls=controls, **kwargs)
+        finally:
+            # the state of the module config for the following calls of the thread
+            self.rollout_state.reset()
+            self.set_time_horizon()
 
     def forward(self, z_grid,
                 controls, joint_angles=None,
-                state=None, vis=False, friction=None):
-        states, forces = self.dphysics(z_grid=z_grid,
-                                       controls=controls, joint_angles=joint_angles, state=state,
-                                       friction=friction)
+                state=None, vis=False, friction=None, terrain_ids=None, control_dt=None,
+                costs=None, return_info=False, robot_ids=None, ensemble=None):
+        outputs = self.dphysics(z_grid=z_grid,
+                                controls=controls, joint_angles=joint_angles, state=state,
+                                friction=friction, terrain_ids=terrain_ids, control_dt=control_dt,
+                                costs=costs, return_info=return_info, robot_ids=robot_ids, ensemble=ensemble)
         if vis:
             with torch.no_grad():
-                self.visualize(states=states, z_grid=z_grid)  #, forces=forces)
-        return states, forces
+                self.visualize(states=outputs[0], z_grid=z_grid)  #, forces=forces)
+        return outputs
 
     def visualize(self, states, z_grid, forces=None, states_gt=None, friction=None):
         # visualize using mayavi
         from mayavi import mlab
         import os
 
-        batch_i = np.random.choice(z_grid.shape[0])
+        batch_i = np.random.choice(states[0].shape[0])
         Xs, Xds, Rs, Omegas = [s.cpu().numpy() for s in states]
         x_grid_np, y_grid_np = self.dphys_cfg.x_grid.cpu().numpy(), self.dphys_cfg.y_grid.cpu().numpy()
-        z_grid_np = z_grid[batch_i].cpu().numpy()
+        # height map used by the visualized trajectory
+        if self.terrain_ids is not None:
+            grid_i = self.terrain_ids[batch_i].item()
+        else:
+            grid_i = batch_i if z_grid.shape[0] > 1 else 0
+        z_grid_np = z_grid[grid_i].cpu().numpy()
         x_points = self.dphys_cfg.robot_points.cpu().numpy()
 
         # set up the visualization
@@ -623,7 +2026,7 @@ class DPhysics(torch.nn.Module):
             mlab.plot3d(Xs_gt[batch_i, :, 0], Xs_gt[batch_i, :, 1], Xs_gt[batch_i, :, 2], color=(0, 0, 1), line_width=2.0)
         # colorize the heightmap with friction values
         if friction is not None:
-            friction_np = friction[batch_i].cpu().numpy()
+            friction_np = friction[grid_i].cpu().numpy()
             mlab.mesh(x_grid_np, y_grid_np, z_grid_np, scalars=friction_np, colormap='terrain', opacity=0.5)
             mlab.colorbar(orientation='horizontal', label_fmt='%.1f', nb_labels=5)
         else:
@@ -651,7 +2054,7 @@ class DPhysics(torch.nn.Module):
         os.makedirs(path, exist_ok=True)
         for t in range(0, N_ts, 10):
             # update the robot body points based on the joint angles
-            joint_angles_t = self.joint_angles[batch_i, t][np.newaxis]
+            joint_angles_t = self.joint_angles[batch_i, self.joint_ids[t]][np.newaxis]
             x_points = self.update_joints(joint_angles_t).squeeze(0).cpu().numpy()
             # motion of point composed of cog motion and rotation of the rigid body
             x_points_t = x_points @ Rs[batch_i, t].T + Xs[batch_i, t][np.newaxis]
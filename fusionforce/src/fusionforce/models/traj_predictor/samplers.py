@@ -0,0 +1,131 @@
+import torch
+
+
+class ControlSampler:
+    """
+    Receding-horizon sampling distribution of the piecewise-constant control inputs (MPPI or CEM).
+    The control sequences are sampled around the mean sequence with time-correlated noise, the distribution is
+    updated from the rollout costs and shifted by the elapsed time in the next planning cycle (warm start).
+    A fraction of the samples are constant control inputs drawn uniformly from the velocity limits (exploration),
+    all of them in the first cycle (cold start).
+
+    Parameters:
+    - dphys_cfg: DPhysConfig with the time horizon and the velocity limits.
+    - n_samples: Number of the sampled control sequences per cycle.
+    - control_dt: Duration of the piecewise-constant control inputs [sec].
+    - method: Update of the sampling distribution, 'mppi' (cost-weighted mean) or 'cem' (elites mean and std).
+    - noise_std: Standard deviation of the (v, w) noise, half of the velocity limits if None.
+    - noise_corr: Correlation coefficient of the noise between the consecutive control inputs, [0, 1).
+    - temperature: MPPI temperature of the exponential cost weights.
+    - elite_ratio: CEM fraction of the lowest-cost samples used for the update.
+    - smoothing: Weight of the new distribution in the update, 1.0 replaces the previous one.
+    - explore_ratio: Fraction of the uniformly sampled constant control inputs.
+    - device: Device of the sampled control inputs.
+    """
+    def __init__(self, dphys_cfg, n_samples=32, control_dt=0.5, method='mppi', noise_std=None, noise_corr=0.5,
+                 temperature=0.1, elite_ratio=0.1, smoothing=0.8, explore_ratio=0.1, device='cpu'):
+        assert method in ('mppi', 'cem'), f'Unknown sampler method: {method}'
+        assert 0.0 <= noise_corr < 1.0
+        self.dphys_cfg = dphys_cfg
+        self.n_samples = n_samples
+        self.control_dt = control_dt
+        self.method = method
+        self.noise_corr = noise_corr
+        self.temperature = temperature
+        self.n_elites = max(int(elite_ratio * n_samples), 2)
+        self.smoothing = smoothing
+        self.n_explore = int(explore_ratio * n_samples)
+        self.device = device
+        self.n_controls = int(round(dphys_cfg.traj_sim_time / control_dt))
+        self.control_max = torch.tensor([dphys_cfg.vel_max, dphys_cfg.omega_max], device=device)
+        if noise_std is None:
+            noise_std = 0.5 * self.control_max
+        self.noise_std = torch.as_tensor(noise_std, dtype=torch.float32, device=device)
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the sampling distribution: zero mean control inputs and the initial noise.
+        """
+        self.mean = torch.zeros((self.n_controls, 2), device=self.device)
+        self.std = self.noise_std.repeat(self.n_controls, 1)
+        self.best_controls = None
+        self.best_cost = None
+        self.t_last = None
+
+    def shift(self, t):
+        """
+        Shifts the sampling distribution by the time elapsed since the previous cycle,
+        the last control input is repeated at the end of the horizon.
+
+        Parameters:
+        - t: Time stamp of the current planning cycle [sec].
+        """
+        if self.t_last is not None:
+            n = min(int((t - self.t_last) / self.control_dt), self.n_controls)
+            if n > 0:
+                self.mean = torch.cat([self.mean[n:], self.mean[-1:].repeat(n, 1)], dim=0)
+                self.std = torch.cat([self.std[n:], self.noise_std.repeat(n, 1)], dim=0)
+                if self.best_controls is not None:
+                    self.best_controls = torch.cat([self.best_controls[n:], self.best_controls[-1:].repeat(n, 1)])
+                # the shifted time is consumed, the remainder carries over to the next cycle
+                t = self.t_last + n * self.control_dt
+            else:
+                t = self.t_last
+        self.t_last = t
+
+    def sample(self):
+        """
+        Samples the control sequences around the mean,
+        the first ones are the mean itself and the (shifted) lowest-cost control inputs of the previous cycle.
+
+        Returns:
+        - Piecewise-constant control inputs (n_samples, n_controls, 2) held for control_dt.
+        """
+        n_noisy = self.n_samples - self.n_explore if self.best_controls is not None else 0
+        # time-correlated (first-order autoregressive) noise with the stationary std
+        white = torch.randn((n_noisy, self.n_controls, 2), device=self.device)
+        noise = torch.empty_like(white)
+        noise[:, 0] = white[:, 0]
+        for k in range(1, self.n_controls):
+            noise[:, k] = self.noise_corr * noise[:, k - 1] + (1.0 - self.noise_corr ** 2) ** 0.5 * white[:, k]
+        controls = self.mean + self.std * noise
+        if n_noisy > 1:
+            controls[0] = self.mean
+            controls[1] = self.best_controls
+
+        # exploration: uniformly sampled constant control inputs
+        n_explore = self.n_samples - n_noisy
+        explore = (2 * torch.rand((n_explore, 1, 2), device=self.device) - 1) * self.control_max
+        controls = torch.cat([controls, explore.repeat(1, self.n_controls, 1)], dim=0)
+        return torch.max(torch.min(controls, self.control_max), -self.control_max)
+
+    def update(self, controls, costs):
+        """
+        Updates the sampling distribution from the path costs of the sampled control sequences.
+
+        Parameters:
+        - controls: Sampled control inputs (n_samples, n_controls, 2).
+        - costs: Path costs of the sampled control inputs (n_samples,).
+
+        Returns:
+        - Lowest-cost control inputs (n_controls, 2).
+        """
+        costs = torch.nan_to_num(costs.to(self.device), nan=float('inf'), posinf=float('inf'))
+        if not torch.isfinite(costs.min()):
+            return self.best_controls
+        if self.method == 'mppi':
+            weights = torch.softmax(-(costs - costs.min()) / self.temperature, dim=0)
+            mean = (weights.view(-1, 1, 1) * controls).sum(dim=0)
+            std = self.std
+        else:
+            elites = controls[torch.argsort(costs)[:self.n_elites]]
+            mean = elites.mean(dim=0)
+            # keep a minimal noise for the next cycles
+            std = torch.max(elites.std(dim=0), 0.1 * self.noise_std)
+        self.mean = (1.0 - self.smoothing) * self.mean + self.smoothing * mean
+        self.std = (1.0 - self.smoothing) * self.std + self.smoothing * std
+
+        i = torch.argmin(costs)
+        self.best_controls, self.best_cost = controls[i], costs[i]
+        return self.best_controls
@@ -0,0 +1,143 @@
+import copy
+from time import time
+import torch
+from .dphysics import halton_sequence
+
+
+def spread_order(n):
+    """
+    Returns the permutation of n items ordered by the van der Corput sequence:
+    any prefix of the permuted items is spread evenly over the original order.
+    """
+    return torch.argsort(halton_sequence(n, 1, skip=0)[:, 0])
+
+
+class RolloutScheduler:
+    """
+    Anytime rollouts within a latency budget (deadline). The number of trajectories, the time horizon and the
+    step size are chosen from the recent rollout timings to meet the deadline, and the trajectories are evaluated
+    in chunks: when the deadline would be exceeded by the next chunk, the trajectories evaluated so far are returned.
+
+    The rollout time is modeled as n_chunks * n_steps * step_time, the time of a rollout step of a chunk
+    (smoothed over the recent chunks). The nominal horizon and step size are kept as long as at least the minimal
+    number of trajectories fits the deadline, then the horizon is shortened and then the step size increased.
+
+    Parameters:
+    - dphysics: DPhysics module running the rollouts.
+    - deadline: Latency budget of the rollouts [sec].
+    - n_trajs_range: Minimal and maximal number of trajectories.
+    - horizons: Time horizons [sec] from the preferred one (DPhysConfig.traj_sim_time if None).
+    - dts: Step sizes [sec] from the preferred one (DPhysConfig.dt if None).
+    - chunk_size: Number of trajectories evaluated at once.
+    - smoothing: Weight of the latest chunk timing in the step time estimate.
+    - margin: Fraction of the deadline kept as a reserve for the timing variations.
+    """
+    def __init__(self, dphysics, deadline=0.5, n_trajs_range=(8, 64), horizons=None, dts=None, chunk_size=16,
+                 smoothing=0.5, margin=0.1):
+        cfg = dphysics.dphys_cfg
+        self.dphysics = dphysics
+        self.deadline = deadline
+        self.n_trajs_range = n_trajs_range
+        self.horizons = list(horizons) if horizons is not None else [cfg.traj_sim_time]
+        self.dts = list(dts) if dts is not None else [cfg.dt]
+        self.chunk_size = chunk_size
+        self.smoothing = smoothing
+        self.margin = margin
+        self.step_time = None  # time of a rollout step of a chunk [sec]
+
+    def plan(self, budget):
+        """
+        Chooses the number of trajectories, the time horizon and the step size fitting the time budget [sec].
+
+        Returns:
+        - Number of trajectories, time horizon [sec] and step size [sec].
+        """
+        n_min, n_max = self.n_trajs_range
+        if self.step_time is None:
+            # no timings yet: the cheapest horizon and step size, the anytime evaluation bounds the latency
+            return n_max, self.horizons[-1], self.dts[-1]
+        for dt in self.dts:
+            for T in self.horizons:
+                n_chunks = int(budget / (int(T / dt) * self.step_time))
+                n_trajs = min(n_chunks * self.chunk_size, n_max)
+                if n_trajs >= n_min:
+                    return n_trajs, T, dt
+        return n_min, self.horizons[-1], self.dts[-1]
+
+    def update_timing(self, t, n_steps):
+        """
+        Updates the step time estimate with the time t [sec] of a chunk rollout of n_steps steps.
+        """
+        step_time = t / n_steps
+        if self.step_time is None:
+            self.step_time = step_time
+        else:
+            self.step_time = (1.0 - self.smoothing) * self.step_time + self.smoothing * step_time
+
+    def run(self, z_grid, controls, state, friction=None, costs=None, t_start=None, **kwargs):
+        """
+        Simulates the trajectories within the deadline.
+
+        Parameters:
+        - z_grid: Height maps (G, H, W) shared by the trajectories, see DPhysics.dphysics.
+        - controls: Control inputs of the candidate trajectories (B, ...), the evaluated ones are spread evenly
+                    over them (see spread_order).
+        - state: Initial robot states (x, xd, R, omega) of the candidate trajectories, (B, ...) each.
+        - friction: Friction maps, same shape as z_grid.
+        - costs: Dictionary of the path cost terms {name: PathCost}.
+        - t_start: Start time of the deadline [sec] (now if None).
+        - kwargs: Other arguments of DPhysics.rollout (control_dt).
+
+        Returns:
+        - States (x, xd, R, omega) of the evaluated trajectories, (n, N_ts, ...) each.
+        - Path costs of the evaluated trajectories (n,), None without the costs.
+        - Dictionary of the scheduling information:
+            - ids: Indices of the evaluated trajectories in the candidates (n,).
+            - n_planned: Number of the planned trajectories.
+            - traj_sim_time, dt: Time horizon and step size [sec].
+            - time: Duration [sec].
+            - deadline_hit: Whether the evaluation stopped at the deadline before all the planned trajectories.
+        """
+        t_start = time() if t_start is None else t_start
+        assert z_grid.shape[0] == 1, 'The height map is shared by the trajectories'
+        deadline = (1.0 - self.margin) * self.deadline
+        n_trajs, T, dt = self.plan(deadline - (time() - t_start))
+        n_trajs = min(n_trajs, controls.shape[0])
+        # the chosen horizon and step size are per call (see DPhysics.rollout), the module config is kept
+        dphys_cfg = copy.copy(self.dphysics.dphys_cfg)
+        dphys_cfg.traj_sim_time, dphys_cfg.dt = T, dt
+        n_steps = int(T / dt)
+        ids = spread_order(controls.shape[0])[:n_trajs].to(controls.device)
+
+        states, path_costs = [], []
+        n_done = 0
+        while n_done < n_trajs:
+            # the next chunk is started only if it is expected to finish before the deadline
+            elapsed = time() - t_start
+            if n_done > 0 and elapsed + n_steps * self.step_time > deadline:
+                break
+            chunk_ids = ids[n_done:n_done + self.chunk_size]
+            chunk_state = tuple(s[chunk_ids.to(s.device)].clone() for s in state)
+            t0 = time()
+            chunk_states, _, info = self.dphysics.rollout(z_grid=z_grid, controls=controls[chunk_ids],
+                                                          dphys_cfg=dphys_cfg, state=chunk_state, friction=friction,
+                                                          costs=costs, return_info=True, **kwargs)
+            if str(self.dphysics.device).startswith('cuda'):
+                torch.cuda.synchronize()
+            self.update_timing(time() - t0, n_steps)
+            states.append(chunk_states)
+            if costs is not None:
+                path_costs.append(info['cost'])
+            n_done += len(chunk_ids)
+
+        states = tuple(torch.cat(s, dim=0) for s in zip(*states))
+        path_costs = torch.cat(path_costs, dim=0) if costs is not None else None
+        info = {
+            'ids': ids[:n_done],
+            'n_planned': n_trajs,
+            'traj_sim_time': T,
+            'dt': dt,
+            'time': time() - t_start,
+            'deadline_hit': n_done < n_trajs,
+        }
+        return states, path_costs, info
@@ -0,0 +1,235 @@
+import queue
+import threading
+from concurrent.futures import Future
+from time import time
+import torch
+
+
+class RolloutRequest:
+    """
+    Rollout request of a caller of RolloutServer: the arguments of DPhysics.dphysics and the future of its results.
+    """
+    def __init__(self, z_grid, controls, state=None, friction=None, terrain_ids=None, joint_angles=None,
+                 robot_ids=None, control_dt=None, dphys_cfg=None):
+        self.z_grid = z_grid
+        self.controls = controls
+        self.state = state
+        self.friction = friction
+        self.terrain_ids = terrain_ids
+        self.joint_angles = joint_angles
+        self.robot_ids = robot_ids
+        self.control_dt = control_dt
+        self.dphys_cfg = dphys_cfg
+        self.future = Future()
+        self.t_submit = time()
+
+    @property
+    def batch_size(self):
+        return self.controls.shape[0]
+
+    def key(self):
+        """
+        Requests with the same key are merged into one rollout: the same config, control inputs and joint angles
+        forms and the initial states either all given or all default.
+        """
+        joint_shape = None if self.joint_angles is None else tuple(self.joint_angles.shape[1:])
+        return (id(self.dphys_cfg), tuple(self.controls.shape[1:]), self.control_dt, joint_shape,
+                self.state is None)
+
+
+class RolloutServer:
+    """
+    In-process rollout service shared by several callers (planners, robots, tools) of one DPhysics module.
+    The requests are queued and, from the first queued one, collected for up to max_delay [sec] (or until
+    max_batch_size trajectories), merged into one batch, simulated by a single rollout and the results are
+    scattered back to the callers. Small per-caller batches thus make one efficiently batched call.
+
+    The height maps of the merged requests are stacked and indexed by the terrain ids of the trajectories,
+    the robot ids, joint angles and initial states are concatenated. The path cost terms are those of the server
+    (the cost terms accumulate their values, see costs.py). The rollouts are run without gradients.
+
+    Parameters:
+    - dphysics: DPhysics module running the rollouts.
+    - costs: Dictionary of the path cost terms {name: PathCost} evaluated for all the requests.
+    - max_batch_size: Maximal number of trajectories of a merged rollout (a larger request runs alone).
+    - max_delay: Maximal waiting time [sec] for more requests after the first queued one.
+    """
+    def __init__(self, dphysics, costs=None, max_batch_size=256, max_delay=0.01):
+        self.dphysics = dphysics
+        self.costs = costs
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.requests = queue.Queue()
+        self.thread = None
+        self.n_requests = 0  # number of the served requests
+        self.n_rollouts = 0  # number of the merged rollouts
+
+    def start(self):
+        """
+        Starts the thread serving the requests.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.serve, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the serving thread after the queued requests.
+        """
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def submit(self, z_grid, controls, state=None, friction=None, terrain_ids=None, joint_angles=None,
+               robot_ids=None, control_dt=None, dphys_cfg=None):
+        """
+        Queues a rollout request, the parameters are the same as for DPhysics.dphysics (dphys_cfg as for
+        DPhysics.rollout; the requests of different configs are not merged).
+
+        Returns:
+        - Future of the results: states, forces and rollout information of the request (see DPhysics.dphysics),
+          the information includes the size of the merged batch (batch_size) and the latency [sec].
+        """
+        assert self.thread is not None, 'The server is not running'
+        request = RolloutRequest(z_grid, controls, state=state, friction=friction, terrain_ids=terrain_ids,
+                                 joint_angles=joint_angles, robot_ids=robot_ids, control_dt=control_dt,
+                                 dphys_cfg=dphys_cfg)
+        self.requests.put(request)
+        return request.future
+
+    def rollout(self, z_grid, controls, **kwargs):
+        """
+        Queues a rollout request and waits for its results, see submit.
+        """
+        return self.submit(z_grid, controls, **kwargs).result()
+
+    def collect(self, first):
+        """
+        Collects the queued requests following the first one within max_delay.
+
+        Returns:
+        - List of the requests and whether the server is stopping.
+        """
+        requests = [first]
+        n_trajs = first.batch_size
+        t_end = time() + self.max_delay
+        while n_trajs < self.max_batch_size:
+            try:
+                request = self.requests.get(timeout=max(t_end - time(), 0.0))
+            except queue.Empty:
+                break
+            if request is None:
+                return requests, True
+            requests.append(request)
+            n_trajs += request.batch_size
+        return requests, False
+
+    def serve(self):
+        """
+        Serving loop: merges the collected requests by their keys (see RolloutRequest.key) into the batches
+        of at most max_batch_size trajectories and runs them.
+        """
+        stopping = False
+        while not stopping:
+            first = self.requests.get()
+            if first is None:
+                break
+            requests, stopping = self.collect(first)
+            groups = {}
+            for request in requests:
+                groups.setdefault(request.key(), []).append(request)
+            for group in groups.values():
+                batch, n_trajs = [], 0
+                for request in group:
+                    if batch and n_trajs + request.batch_size > self.max_batch_size:
+                        self.run(batch)
+                        batch, n_trajs = [], 0
+                    batch.append(request)
+                    n_trajs += request.batch_size
+                self.run(batch)
+
+    def merge(self, requests):
+        """
+        Merges the requests into the arguments of one rollout.
+        """
+        device = self.dphysics.device
+        cfg = requests[0].dphys_cfg if requests[0].dphys_cfg is not None else self.dphysics.dphys_cfg
+        z_grids, frictions, terrain_ids, robot_ids, joint_angles = [], [], [], [], []
+        G = 0
+        for r in requests:
+            B = r.batch_size
+            z_grid = r.z_grid.to(device)
+            friction = cfg.friction.expand_as(r.z_grid) if r.friction is None else r.friction
+            z_grids.append(z_grid)
+            frictions.append(friction.to(device))
+            # terrain of each trajectory, see DPhysics.init_rollout
+            if r.terrain_ids is not None:
+                ids = torch.as_tensor(r.terrain_ids, dtype=torch.long, device=device)
+            elif z_grid.shape[0] == B:
+                ids = torch.arange(B, device=device)
+            else:
+                assert z_grid.shape[0] == 1, f'Height map batch size {z_grid.shape[0]} must be 1 or {B}'
+                ids = torch.zeros(B, dtype=torch.long, device=device)
+            terrain_ids.append(ids + G)
+            G += z_grid.shape[0]
+            robot_ids.append(torch.zeros(B, dtype=torch.long, device=device) if r.robot_ids is None
+                             else torch.as_tensor(r.robot_ids, dtype=torch.long, device=device))
+            joint_angles.append(r.joint_angles)
+
+        kwargs = dict(
+            z_grid=torch.cat(z_grids, dim=0),
+            controls=torch.cat([r.controls.to(device) for r in requests], dim=0),
+            friction=torch.cat(frictions, dim=0),
+            terrain_ids=torch.cat(terrain_ids, dim=0),
+            control_dt=requests[0].control_dt,
+            dphys_cfg=requests[0].dphys_cfg,
+        )
+        if any(r.robot_ids is not None for r in requests):
+            kwargs['robot_ids'] = torch.cat(robot_ids, dim=0)
+        if requests[0].joint_angles is not None:
+            kwargs['joint_angles'] = torch.cat([j.to(device) for j in joint_angles], dim=0)
+        if requests[0].state is not None:
+            kwargs['state'] = tuple(torch.cat([r.state[i].to(device) for r in requests], dim=0) for i in range(4))
+        return kwargs
+
+    def run(self, requests):
+        """
+        Runs one rollout of the merged requests and scatters the results to their futures.
+        """
+        try:
+            kwargs = self.merge(requests)
+            B = kwargs['controls'].shape[0]
+            with torch.no_grad():
+                states, forces, info = self.dphysics.rollout(costs=self.costs, return_info=True, **kwargs)
+        except Exception as e:
+            for r in requests:
+                r.future.set_exception(e)
+            return
+        self.n_requests += len(requests)
+        self.n_rollouts += 1
+
+        def split(x, i, j):
+            if isinstance(x, dict):
+                return {k: split(v, i, j) for k, v in x.items()}
+            if isinstance(x, tuple):
+                return tuple(split(v, i, j) for v in x)
+            if isinstance(x, torch.Tensor) and x.dim() > 0 and x.shape[0] == B:
+                return x[i:j]
+            return x
+
+        i = 0
+        t = time()
+        for r in requests:
+            j = i + r.batch_size
+            r_info = split(info, i, j)
+            r_info.update(batch_size=B, latency=t - r.t_submit)
+            r.future.set_result((split(states, i, j), split(forces, i, j), r_info))
+            i = j
@@ -0,0 +1,319 @@
+import torch
+import torch.nn as nn
+from .dphysics import DPhysics
+from .costs import total_cost
+
+
+def sample_grid(z_grid, xy, grid_res, d_max, terrain_ids=None):
+    """
+    Bilinear interpolation of the height maps at the query points, the shared height maps are read in place.
+
+    Parameters:
+    - z_grid: Height maps (G, H, W), the x coordinate along H and y along W (see DPhysConfig.x_grid).
+    - xy: Query points (B, M, 2) in the height map frame.
+    - grid_res: Grid resolution [m].
+    - d_max: Half-size of the height maps [m].
+    - terrain_ids: Height map index of each batch element (B,), all of them use the first one if None and G = 1,
+                   or their own one if G = B.
+
+    Returns:
+    - Heights at the query points (B, M).
+    """
+    G, H, W = z_grid.shape
+    B = xy.shape[0]
+    if terrain_ids is None:
+        assert G in (1, B), f'Height map batch size {G} must be 1 or {B} without terrain_ids'
+        terrain_ids = torch.arange(B, device=xy.device) if G == B else torch.zeros(B, dtype=torch.long,
+                                                                                    device=xy.device)
+    # continuous grid indices clamped to the height map
+    u = torch.clamp((xy[..., 0] + d_max) / grid_res, 0, H - 1)
+    v = torch.clamp((xy[..., 1] + d_max) / grid_res, 0, W - 1)
+    u0, v0 = u.floor().long(), v.floor().long()
+    u1, v1 = torch.clamp(u0 + 1, max=H - 1), torch.clamp(v0 + 1, max=W - 1)
+    du, dv = u - u0, v - v0
+    offsets = (terrain_ids * H * W).view(B, 1)
+    lookup = lambda i, j: torch.take(z_grid, offsets + i * W + j)
+    return ((1 - du) * (1 - dv) * lookup(u0, v0) + (1 - du) * dv * lookup(u0, v1) +
+            du * (1 - dv) * lookup(u1, v0) + du * dv * lookup(u1, v1))
+
+
+class SurrogateStep(nn.Module):
+    """
+    Learned step model of the robot dynamics: from the robot state, the control inputs and the terrain patch
+    around the robot it predicts the change of the linear and angular velocities in the robot frame
+    over step_dt (several DPhysics time steps).
+
+    Parameters:
+    - patch_size: Number of the patch cells along each side.
+    - hidden: Size of the hidden layers.
+    """
+    n_inputs = 12  # robot frame velocities (3 + 3), gravity direction (3), height above terrain, control inputs (2)
+    n_outputs = 6  # robot frame velocity changes (3 + 3)
+
+    def __init__(self, patch_size=16, hidden=128):
+        super().__init__()
+        self.patch_encoder = nn.Sequential(
+            nn.Conv2d(1, 8, kernel_size=3, stride=2, padding=1), nn.ReLU(),
+            nn.Conv2d(8, 16, kernel_size=3, stride=2, padding=1), nn.ReLU(),
+            nn.Flatten(),
+            nn.Linear(16 * ((patch_size + 3) // 4) ** 2, 64), nn.ReLU(),
+        )
+        self.mlp = nn.Sequential(
+            nn.Linear(64 + self.n_inputs, hidden), nn.ReLU(),
+            nn.Linear(hidden, hidden), nn.ReLU(),
+            nn.Linear(hidden, self.n_outputs),
+        )
+        # normalization of the inputs and outputs, set from the training data (see set_normalization)
+        self.register_buffer('in_mean', torch.zeros(self.n_inputs))
+        self.register_buffer('in_std', torch.ones(self.n_inputs))
+        self.register_buffer('out_std', torch.ones(self.n_outputs))
+
+    def set_normalization(self, inputs, outputs):
+        """
+        Sets the normalization from the training inputs (N, n_inputs) and outputs (N, n_outputs).
+        """
+        self.in_mean.copy_(inputs.mean(dim=0))
+        self.in_std.copy_(inputs.std(dim=0).clamp(min=1e-3))
+        self.out_std.copy_(outputs.std(dim=0).clamp(min=1e-4))
+
+    def forward(self, features, patch):
+        """
+        Parameters:
+        - features: Robot state and control inputs features (B, n_inputs), see SurrogateDynamics.features.
+        - patch: Terrain heights around the robot relative to the robot height (B, P, P).
+
+        Returns:
+        - Normalized velocity changes (B, n_outputs), multiply by out_std for the robot frame values.
+        """
+        h = self.patch_encoder(patch.unsqueeze(1))
+        x = (features - self.in_mean) / self.in_std
+        return self.mlp(torch.cat([h, x], dim=-1))
+
+
+class SurrogateDynamics(nn.Module):
+    """
+    Distilled surrogate of DPhysics for cheap trajectory scoring of large candidate sets: the learned step model
+    (SurrogateStep) advances the robot by step_dt, several DPhysics time steps at once, from a terrain patch
+    around the robot instead of the contacts of all the robot points. The positions and orientations are
+    integrated from the predicted velocities as in DPhysics.
+
+    The interface follows DPhysics.forward, the states are returned at the surrogate steps (every step_dt)
+    and no forces are predicted, so only the path cost terms of the states and control inputs apply
+    (e.g. InclinationCost, GoalDistanceCost).
+
+    Parameters:
+    - dphys_cfg: DPhysConfig of the height maps and the simulated robot.
+    - step_dt: Time step of the surrogate [sec].
+    - patch_size: Number of the terrain patch cells along each side.
+    - patch_res: Resolution of the terrain patch [m].
+    - hidden: Size of the hidden layers of the step model.
+    - device: Device of the model.
+    """
+    def __init__(self, dphys_cfg, step_dt=0.05, patch_size=16, patch_res=0.2, hidden=128, device='cpu'):
+        super().__init__()
+        self.dphys_cfg = dphys_cfg
+        self.step_dt = step_dt
+        self.patch_size = patch_size
+        self.patch_res = patch_res
+        self.device = device
+        self.step_model = SurrogateStep(patch_size=patch_size, hidden=hidden)
+        # height of the robot above the terrain at the start of the rollouts, set from the training data
+        self.register_buffer('init_height', torch.zeros(()))
+        # patch cells offsets in the robot heading frame (P * P, 2) and the robot center (1, 2)
+        r = (torch.arange(patch_size, dtype=torch.float32) - (patch_size - 1) / 2) * patch_res
+        offsets = torch.stack(torch.meshgrid(r, r, indexing='ij'), dim=-1).view(-1, 2)
+        self.register_buffer('patch_offsets', torch.cat([offsets, torch.zeros(1, 2)], dim=0))
+        self.to(device)
+
+    def from_pretrained(self, modelf):
+        if not modelf:
+            return self
+        print(f'Loading pretrained {self.__class__.__name__} model from', modelf)
+        self.load_state_dict(torch.load(modelf, map_location=self.device))
+        return self
+
+    def terrain_patch(self, z_grid, state, terrain_ids=None):
+        """
+        Terrain heights around the robot in the heading (gravity-aligned) frame relative to the robot height.
+
+        Returns:
+        - Terrain patch (B, P, P) and the robot height above the terrain (B,).
+        """
+        x, _, R, _ = state
+        B = x.shape[0]
+        yaw = torch.atan2(R[:, 1, 0], R[:, 0, 0])
+        c, s = torch.cos(yaw).view(B, 1), torch.sin(yaw).view(B, 1)
+        a, b = self.patch_offsets[:, 0], self.patch_offsets[:, 1]
+        xy = torch.stack([x[:, :1] + c * a - s * b, x[:, 1:2] + s * a + c * b], dim=-1)  # (B, P * P + 1, 2)
+        z = sample_grid(z_grid, xy, self.dphys_cfg.grid_res, self.dphys_cfg.d_max, terrain_ids=terrain_ids)
+        z = z - x[:, 2:3]
+        P = self.patch_size
+        return z[:, :-1].view(B, P, P), -z[:, -1]
+
+    @staticmethod
+    def features(state, controls_t, height):
+        """
+        Step model inputs: velocities and gravity direction in the robot frame, height above terrain and controls.
+        """
+        _, xd, R, omega = state
+        Rt = R.transpose(1, 2)
+        v = (Rt @ xd.unsqueeze(2)).squeeze(2)
+        w = (Rt @ omega.unsqueeze(2)).squeeze(2)
+        return torch.cat([v, w, R[:, 2, :], height.unsqueeze(1), controls_t], dim=-1)
+
+    def velocity_changes(self, state, next_state):
+        """
+        Step model targets: changes of the robot frame velocities from state to next_state (B, 6).
+        """
+        _, xd, R, omega = state
+        Rt = R.transpose(1, 2)
+        dxd = (Rt @ (next_state[1] - xd).unsqueeze(2)).squeeze(2)
+        domega = (Rt @ (next_state[3] - omega).unsqueeze(2)).squeeze(2)
+        return torch.cat([dxd, domega], dim=-1)
+
+    def integrate(self, state, dv):
+        """
+        Integrates the robot state over step_dt with the robot frame velocity changes dv (B, 6).
+        """
+        x, xd, R, omega = state
+        xd = xd + (R @ dv[:, :3].unsqueeze(2)).squeeze(2)
+        omega = omega + (R @ dv[:, 3:].unsqueeze(2)).squeeze(2)
+        x = x + xd * self.step_dt
+        R = DPhysics.integrate_rotation(R, omega, self.step_dt)
+        return x, xd, R, omega
+
+    def step(self, z_grid, state, controls_t, terrain_ids=None):
+        """
+        Advances the robot state by step_dt.
+
+        Returns:
+        - Updated state (x, xd, R, omega) and the normalized velocity changes predicted by the step model (B, 6).
+        """
+        patch, height = self.terrain_patch(z_grid, state, terrain_ids=terrain_ids)
+        dv = self.step_model(self.features(state, controls_t, height), patch)
+        return self.integrate(state, dv * self.step_model.out_std), dv
+
+    def initial_state(self, z_grid, controls, terrain_ids=None):
+        """
+        Default initial state as in DPhysics: at the origin on the terrain, moving with the first control inputs.
+        """
+        B = controls.shape[0]
+        controls_0 = controls if controls.dim() == 2 else controls[:, 0]
+        x = torch.zeros((B, 3), device=self.device)
+        xd = torch.zeros_like(x); xd[:, 0] = controls_0[:, 0]
+        omega = torch.zeros_like(x); omega[:, 2] = controls_0[:, 1]
+        R = torch.eye(3, device=self.device).repeat(B, 1, 1)
+        z = sample_grid(z_grid, x[:, None, :2], self.dphys_cfg.grid_res, self.dphys_cfg.d_max, terrain_ids=terrain_ids)
+        x[:, 2] = z[:, 0] + self.init_height
+        return x, xd, R, omega
+
+    def forward(self, z_grid, controls, joint_angles=None, state=None, friction=None, terrain_ids=None,
+                control_dt=None, costs=None, return_info=False):
+        """
+        Simulates the trajectories over DPhysConfig.traj_sim_time, the parameters are the same as for
+        DPhysics.dphysics; the joint angles and friction are not modeled by the surrogate.
+        The control inputs for each DPhysics time step (B, N, 2) are sampled every step_dt.
+
+        Returns:
+        - Tuple of the robot states (x, xd, R, omega) at the surrogate steps, (B, N_s, ...) each.
+        - Tuple of the forces, None.
+        - info: Dictionary of the accumulated cost terms (costs) and the total path cost (cost), if return_info.
+        """
+        z_grid = z_grid.to(self.device)
+        controls = controls.to(self.device)
+        terrain_ids = terrain_ids.to(self.device) if terrain_ids is not None else None
+        if state is None:
+            state = self.initial_state(z_grid, controls, terrain_ids=terrain_ids)
+        state = tuple(s.to(self.device) for s in state)
+        if costs is not None:
+            for c in costs.values():
+                c.reset()
+
+        # control inputs at the surrogate steps
+        N_s = int(self.dphys_cfg.traj_sim_time / self.step_dt)
+        ts = torch.arange(N_s, device=self.device) * self.step_dt
+        if controls.dim() == 2:
+            control_ids = torch.zeros(N_s, dtype=torch.long, device=self.device)
+            controls = controls.unsqueeze(1)
+        elif control_dt is None:
+            control_ids = torch.clamp(torch.round(ts / self.dphys_cfg.dt).long(), max=controls.shape[1] - 1)
+        else:
+            control_ids = torch.clamp(torch.floor(ts / control_dt + 1e-6).long(), max=controls.shape[1] - 1)
+
+        states = []
+        no_forces = (None, None)
+        joint_angles_t = torch.zeros((controls.shape[0], 4), device=self.device)
+        for t_id in control_ids.tolist():
+            controls_t = controls[:, t_id]
+            state, _ = self.step(z_grid, state, controls_t, terrain_ids=terrain_ids)
+            states.append(state)
+            if costs is not None:
+                for c in costs.values():
+                    c.update(self, state, no_forces, controls_t, joint_angles_t)
+        states = tuple(torch.stack(s, dim=1) for s in zip(*states))
+        if not return_info:
+            return states, no_forces
+        info = {}
+        if costs is not None:
+            info['costs'] = {name: c.result() for name, c in costs.items()}
+            info['cost'] = total_cost(costs)
+        return states, no_forces, info
+
+
+def random_terrains(dphys_cfg, n, max_height=1.0, generator=None):
+    """
+    Random height maps for the training and evaluation rollouts: Gaussian hills and pits of random
+    sizes and smoothed random roughness of random amplitudes.
+
+    Parameters:
+    - dphys_cfg: DPhysConfig of the height maps.
+    - n: Number of the height maps.
+    - max_height: Maximal height of the hills [m].
+    - generator: Random number generator (torch.Generator).
+
+    Returns:
+    - Height maps (n, H, W).
+    """
+    x_grid, y_grid = dphys_cfg.x_grid, dphys_cfg.y_grid
+    d_max = dphys_cfg.d_max
+    rand = lambda *shape: torch.rand(*shape, generator=generator)
+    z_grid = torch.zeros((n,) + x_grid.shape)
+    n_hills = 4
+    centers = (2 * rand(n, n_hills, 2, 1, 1) - 1) * d_max
+    heights = (2 * rand(n, n_hills, 1, 1) - 0.5) * max_height  # mostly hills, some pits
+    widths = 0.5 + 2.5 * rand(n, n_hills, 1, 1)
+    for k in range(n_hills):
+        dist2 = (x_grid - centers[:, k, 0]) ** 2 + (y_grid - centers[:, k, 1]) ** 2
+        z_grid += heights[:, k] * torch.exp(-dist2 / (2 * widths[:, k] ** 2))
+    # roughness: white noise smoothed over a few grid cells
+    noise = (2 * rand(n, 1, *x_grid.shape) - 1) * 0.3 * rand(n, 1, 1, 1)
+    z_grid += torch.nn.functional.avg_pool2d(noise, kernel_size=5, stride=1, padding=2).squeeze(1)
+    return z_grid
+
+
+def rollout_trajectories(dphysics, z_grid, controls, state=None, terrain_ids=None, control_dt=None):
+    """
+    Simulates DPhysics rollouts for the training of SurrogateDynamics, the transitions over its step_dt
+    are taken between the states step_dt / DPhysConfig.dt time steps apart.
+
+    Parameters:
+    - dphysics: DPhysics module recording every time step (DPhysConfig.record_every = 1).
+    - z_grid, controls, state, terrain_ids, control_dt: see DPhysics.dphysics.
+
+    Returns:
+    - Dictionary of the trajectories: states (x, xd, R, omega), (B, N_ts, ...) each, control inputs applied
+      at each time step (B, N_ts, 2), terrain ids (B,) and the initial heights of the robots above the terrain (B,).
+    """
+    assert dphysics.dphys_cfg.record_every == 1
+    with torch.no_grad():
+        states, _ = dphysics(z_grid=z_grid, controls=controls, state=state, terrain_ids=terrain_ids,
+                             control_dt=control_dt)
+        x0 = states[0][:, :1, :2]
+        z0 = sample_grid(z_grid.to(x0.device), x0, dphysics.dphys_cfg.grid_res, dphysics.dphys_cfg.d_max,
+                         terrain_ids=dphysics.terrain_ids)
+        return {
+            'states': states,
+            'controls': dphysics.controls[:, dphysics.control_ids],
+            'terrain_ids': dphysics.terrain_ids,
+            'init_height': states[0][:, 0, 2] - z0[:, 0],
+        }
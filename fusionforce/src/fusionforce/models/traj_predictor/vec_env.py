@@ -0,0 +1,222 @@
+import torch
+from .dphysics import TERMINATION_REASONS, rotation_to_quaternion
+
+
+class DPhysVecEnv:
+    """
+    Vectorized (gym-style) environment of n_envs robots simulated by DPhysics in lockstep, one time step
+    (DPhysConfig.dt) per step call. Each environment has its own terrain and is reset individually
+    (masked reset) when its episode ends. The states, costs and done flags stay torch tensors on the device.
+
+    An episode ends when the robot leaves the map, rolls over or gets stuck (see DPhysics.termination_reasons)
+    or after max_steps steps (truncation). The done environments are not reset automatically.
+    The returned states are the simulated ones (without the equilibrium height shift of the rollout outputs).
+
+    Parameters:
+    - dphysics: DPhysics module simulating the robots.
+    - n_envs: Number of environments.
+    - z_grid: Height maps of the environments (n_envs, H, W), or height maps (G, H, W) indexed by terrain_ids
+              (shared by all the environments if G = 1).
+    - friction: Friction maps, same shape as z_grid (DPhysConfig.friction if None).
+    - terrain_ids: Height map index of each environment (n_envs,).
+    - robot_ids: Robot index (in robot_cfgs) of each environment (n_envs,), required for several robots.
+    - costs: Dictionary of the path cost terms {name: PathCost}, their step costs are returned by step.
+    - max_steps: Maximal number of steps of an episode (DPhysConfig.traj_sim_time / dt if None).
+    - terminate: Whether the episodes end at the termination conditions.
+    """
+    def __init__(self, dphysics, n_envs, z_grid, friction=None, terrain_ids=None, robot_ids=None, costs=None,
+                 max_steps=None, terminate=True):
+        cfg = dphysics.dphys_cfg
+        self.dphysics = dphysics
+        self.device = dphysics.device
+        self.n_envs = n_envs
+        self.costs = costs
+        self.max_steps = max_steps if max_steps is not None else int(cfg.traj_sim_time / cfg.dt)
+        self.terminate = terminate
+        self.stuck_steps = max(int(round(cfg.stuck_time / cfg.dt)), 1)
+        if robot_ids is None:
+            assert len(dphysics.robot_cfgs) == 1, 'robot_ids are required for several robots'
+        else:
+            robot_ids = torch.as_tensor(robot_ids, dtype=torch.long, device=self.device)
+            assert robot_ids.shape == (n_envs,), f'Robot ids shape {robot_ids.shape} != {(n_envs,)}'
+        self.robot_ids = robot_ids
+        self.set_terrain(z_grid, friction=friction, terrain_ids=terrain_ids)
+
+        # episode state: robot state (orientation as a quaternion if dphysics.quaternion_state),
+        # position at the last stuck check and number of steps
+        self.state = None
+        self.x_ref = None
+        self.n_steps = torch.zeros(n_envs, dtype=torch.long, device=self.device)
+        # joint angles of the steps (the given and the applied ones) and whether they move the robot body points,
+        # checked (a host synchronization) only when new joint angles are given, static for the zero joint angles
+        self.zero_joint_angles = torch.zeros((n_envs, 4), device=self.device)
+        self.joint_angles_input = None
+        self.joint_angles = self.zero_joint_angles
+        self.joints_static = True
+
+    def set_terrain(self, z_grid, friction=None, terrain_ids=None):
+        """
+        Sets the terrains of all the environments, see the constructor parameters.
+        """
+        friction = self.dphysics.dphys_cfg.friction.expand_as(z_grid) if friction is None else friction
+        assert friction.shape == z_grid.shape, f'Friction shape {friction.shape} != height map shape {z_grid.shape}'
+        G = z_grid.shape[0]
+        if terrain_ids is None:
+            assert G in (1, self.n_envs), f'Height map batch size {G} must be 1 or {self.n_envs} without terrain_ids'
+            terrain_ids = torch.arange(self.n_envs) if G == self.n_envs else torch.zeros(self.n_envs, dtype=torch.long)
+        self.z_grid = z_grid.to(self.device)
+        self.friction = friction.to(self.device)
+        self.terrain_ids = torch.as_tensor(terrain_ids, dtype=torch.long, device=self.device)
+        self.terrain = self.dphysics.prepare_terrain(self.z_grid, self.friction)
+
+    def activate(self, ids=None):
+        """
+        Sets the per-call state of the DPhysics module (see RolloutState) to the environments ids (all if None).
+        """
+        dphysics = self.dphysics
+        dphysics.z_grid, dphysics.friction, dphysics.terrain = self.z_grid, self.friction, self.terrain
+        robot_ids = self.robot_ids if self.robot_ids is None or ids is None else self.robot_ids[ids]
+        terrain_ids = self.terrain_ids if ids is None else self.terrain_ids[ids]
+        dphysics.set_trajectory_ids(terrain_ids, robot_ids, None)
+        dphysics.rollout_robot_ids = robot_ids
+        dphysics.ensemble = None
+
+    def reset(self, ids=None, state=None, z_grid=None, friction=None):
+        """
+        Resets the environments ids (all if None), placing the robots on the terrain.
+
+        Parameters:
+        - ids: Indices (n,) or mask (n_envs,) of the environments to reset.
+        - state: Initial robot states (x, xd, R, omega) of the environments, (n, ...) each;
+                 at the origin with zero velocities if None. The height is set to the terrain height.
+        - z_grid: New height maps of the environments (n, H, W), the environments must have their own
+                  height maps (see the constructor).
+        - friction: New friction maps of the environments, same shape as z_grid.
+
+        Returns:
+        - Robot states (x, xd, R, omega) of all the environments, (n_envs, ...) each.
+        """
+        dphysics = self.dphysics
+        if ids is None:
+            ids = torch.arange(self.n_envs, device=self.device)
+        elif ids.dtype == torch.bool:
+            ids = torch.nonzero(ids).squeeze(1)
+        ids = ids.to(self.device)
+        n = len(ids)
+
+        if z_grid is not None:
+            assert self.z_grid.shape[0] == self.n_envs and torch.equal(
+                self.terrain_ids, torch.arange(self.n_envs, device=self.device)), \
+                'The environments must have their own height maps to change them'
+            friction = dphysics.dphys_cfg.friction.expand_as(z_grid) if friction is None else friction
+            z_grid, friction = z_grid.to(self.device), friction.to(self.device)
+            self.z_grid = self.z_grid.index_copy(0, ids, z_grid)
+            self.friction = self.friction.index_copy(0, ids, friction)
+            self.terrain = self.terrain.index_copy(0, ids, dphysics.prepare_terrain(z_grid, friction))
+
+        if state is None:
+            x = torch.zeros((n, 3), device=self.device)
+            R = torch.eye(3, device=self.device).repeat(n, 1, 1)
+            state = (x, torch.zeros_like(x), R, torch.zeros_like(x))
+        state = tuple(s.to(self.device).clone() for s in state)
+        self.activate(ids)
+        state = dphysics.place_on_terrain(state)
+        if dphysics.quaternion_state:
+            state = (state[0], state[1], rotation_to_quaternion(state[2]), state[3])
+
+        if self.state is None:
+            assert n == self.n_envs, 'All the environments are reset first'
+            self.state = state
+            self.x_ref = state[0]
+        else:
+            self.state = tuple(s.index_copy(0, ids, s_new) for s, s_new in zip(self.state, state))
+            self.x_ref = self.x_ref.index_copy(0, ids, state[0])
+        self.n_steps = self.n_steps.index_fill(0, ids, 0)
+        return self.states()
+
+    def set_joint_angles(self, joint_angles=None):
+        """
+        Sets the joint angles of the steps (n_envs, 4), zero if None. Whether they move the robot body points
+        (see DPhysics.joints_are_static) is checked only if they differ from the joint angles of the last step.
+        """
+        if joint_angles is None:
+            self.joint_angles_input, self.joint_angles, self.joints_static = None, self.zero_joint_angles, True
+            return
+        if joint_angles is self.joint_angles_input:
+            return
+        self.joint_angles_input = joint_angles
+        B = self.n_envs
+        assert joint_angles.shape == (B, 4), f'Joint angles shape {joint_angles.shape} != {(B, 4)}'
+        joint_angles = joint_angles.to(self.device)
+        if self.robot_ids is not None:
+            # the joint angles of the robots without the movable joints are ignored
+            joint_angles = joint_angles * self.dphysics.movable_joints[self.robot_ids].view(B, 1)
+        self.joint_angles = joint_angles
+        self.joints_static = self.dphysics.joints_are_static(joint_angles)
+
+    def states(self):
+        """
+        Returns the robot states (x, xd, R, omega) of all the environments, the orientation as a rotation matrix.
+        """
+        return self.dphysics.matrix_state(self.state)
+
+    def step(self, controls, joint_angles=None):
+        """
+        Simulates one time step of all the environments.
+
+        Parameters:
+        - controls: Control inputs (n_envs, 2).
+        - joint_angles: Joint angles (n_envs, 4), zero if None. Passing the same tensor again skips
+                        the static joints check (see set_joint_angles).
+
+        Returns:
+        - Robot states (x, xd, R, omega) after the step, (n_envs, ...) each.
+        - Weighted sum of the step costs of the cost terms (n_envs,), zero without the costs.
+        - Done flags (n_envs,): the episode terminated or truncated.
+        - Dictionary of the step information:
+            - forces: Forces (F_spring, F_friction) at the robot points, (n_envs, N_pts, 3) each.
+            - costs: Step costs of the cost terms {name: (n_envs,)}.
+            - termination_reason: Index of the termination reason in TERMINATION_REASONS (n_envs,), 0 if none.
+            - truncated: Whether the episode reached max_steps (n_envs,).
+            - n_steps: Number of the steps of the episodes (n_envs,).
+        """
+        assert self.state is not None, 'The environments are not reset'
+        dphysics = self.dphysics
+        B = self.n_envs
+        assert controls.shape == (B, 2), f'Controls shape {controls.shape} != {(B, 2)}'
+        controls = controls.to(self.device)
+        self.set_joint_angles(joint_angles)
+        joint_angles = self.joint_angles
+        self.activate()
+        dphysics.joints_static = self.joints_static
+
+        self.state, forces = dphysics.step(self.state, controls, joint_angles)
+        self.n_steps = self.n_steps + 1
+        state = self.states()
+
+        step_costs = {}
+        if self.costs is not None:
+            step_costs = {name: c.step_cost(dphysics, state, forces, controls, joint_angles)
+                          for name, c in self.costs.items()}
+        cost = sum((self.costs[name].weight * c for name, c in step_costs.items()),
+                   torch.zeros(B, device=self.device))
+
+        reasons = torch.zeros(B, dtype=torch.long, device=self.device)
+        if self.terminate:
+            # the stuck condition is checked every DPhysConfig.stuck_time of the episode
+            check_stuck = self.n_steps % self.stuck_steps == 0
+            reasons = dphysics.termination_reasons(state, x_ref=self.x_ref)
+            stuck = reasons == TERMINATION_REASONS.index('stuck')
+            reasons = torch.where(stuck & ~check_stuck, torch.zeros_like(reasons), reasons)
+            self.x_ref = torch.where(check_stuck.unsqueeze(1), state[0], self.x_ref)
+        truncated = self.n_steps >= self.max_steps
+        done = (reasons > 0) | truncated
+
+        info = {
+            'forces': forces,
+            'costs': step_costs,
+            'termination_reason': reasons,
+            'truncated': truncated,
+            'n_steps': self.n_steps,
+        }
+        return state, cost, done, info
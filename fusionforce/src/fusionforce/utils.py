@@ -1,6 +1,5 @@
 import os
 import numpy as np
-from matplotlib import pyplot as plt
 from numpy.lib.recfunctions import structured_to_unstructured
 from timeit import default_timer as timer
 import torch
@@ -190,6 +189,7 @@ def compile_data(val_fraction=0.1, small_data=False, vis=False, Data=None, dphys
 
 def explore_data(ds, sample_range='random', save=False):
     from tqdm import tqdm
+    from matplotlib import pyplot as plt
     from fusionforce.models.terrain_encoder.lss import LiftSplatShoot
     from fusionforce.models.terrain_encoder.utils import ego_to_cam, get_only_in_img_mask, denormalize_img
 
@@ -1,6 +1,4 @@
-from matplotlib import pyplot as plt
 import numpy as np
-from mayavi import mlab
 
 
 __all__ = [
@@ -11,6 +9,8 @@ __all__ = [
 ]
 
 def visualize_imgs(images, names=None):
+    from matplotlib import pyplot as plt
+
     n = len(images)
     figsize = (n * 5, 5)
     plt.figure(figsize=figsize)
@@ -58,6 +58,8 @@ def set_axes_equal(ax):
 
 
 def draw_coord_frame(pose, scale=0.5):
+    from mayavi import mlab
+
     t, R = pose[:3, 3], pose[:3, :3]
     # draw coordinate frame
     x_axis = np.array([1, 0, 0])
@@ -80,6 +82,7 @@ def draw_coord_frames(poses, scale=0.1):
 
 if __name__ == '__main__':
     from scipy.spatial.transform import Rotation
+    from mayavi import mlab
 
     T0 = np.eye(4)
     T1 = np.eye(4)
@@ -13,6 +13,10 @@ from fusionforce.ros import height_map_to_gridmap_msg, poses_to_path, poses_to_m
 from fusionforce.utils import read_yaml, timing
 from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
 from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import ContactForceCost
+from fusionforce.models.traj_predictor.control_optimizer import ControlOptimizer
+from fusionforce.models.traj_predictor.samplers import ControlSampler
+from fusionforce.models.traj_predictor.scheduler import RolloutScheduler
 from terrain_encoder import TerrainEncoder
 import rospkg
 
@@ -26,10 +30,40 @@ class FusionForce(TerrainEncoder):
         # differentiable physics configs
         self.robot = rospy.get_param('~robot', 'robot')
         self.allow_backward = rospy.get_param('~allow_backward', True)
+        # sampling of the control inputs: 'random', 'sobol', 'halton' or 'lattice', see generate_controls
+        self.control_sampling = rospy.get_param('~control_sampling', 'random')
         self.dphys_cfg = DPhysConfig(robot=self.robot)
+        self.dphys_cfg.record_forces = None  # the path costs are accumulated during the rollout
+        self.control_dt = rospy.get_param('~control_dt', 0.5)  # piecewise-constant control inputs duration [sec]
+        # optional receding-horizon sampler ('mppi' or 'cem') warm-started from the previous cycle
+        self.sampler = None
+        sampler = rospy.get_param('~sampler', '')
+        if sampler:
+            self.dphys_cfg.n_sim_trajs = rospy.get_param('~n_samples', self.dphys_cfg.n_sim_trajs // 4)
+            self.sampler = ControlSampler(self.dphys_cfg, n_samples=self.dphys_cfg.n_sim_trajs,
+                                          control_dt=self.control_dt, method=sampler, device=self.device)
         self.physics_engine = DPhysics(self.dphys_cfg, device=self.device)
-        self.controls = self.init_controls()
+        self.path_costs = {'contact_forces': ContactForceCost()}
+        self.controls = self.init_controls() if self.sampler is None else self.sampler.sample()
         rospy.loginfo('Control inputs are set up. Shape: %s' % str(self.controls.shape))
+        # optional gradient-based refinement of the sampled control inputs on the path costs
+        self.control_optimizer = None
+        if rospy.get_param('~optimize_controls', False):
+            self.control_optimizer = ControlOptimizer(self.physics_engine, self.path_costs,
+                                                      n_iters=rospy.get_param('~control_opt_iters', 5),
+                                                      lr=rospy.get_param('~control_opt_lr', 0.1),
+                                                      time_budget=rospy.get_param('~control_opt_time_budget', None),
+                                                      control_dt=self.control_dt)
+        # optional anytime rollouts within the latency budget ~deadline [sec]: the number of trajectories,
+        # the time horizon and the step size adapt to the recent rollout timings
+        self.scheduler = None
+        if rospy.get_param('~deadline', None) is not None:
+            self.scheduler = RolloutScheduler(self.physics_engine, deadline=rospy.get_param('~deadline'),
+                                              n_trajs_range=(rospy.get_param('~n_trajs_min', 8),
+                                                             self.dphys_cfg.n_sim_trajs),
+                                              horizons=rospy.get_param('~horizons', None),
+                                              dts=rospy.get_param('~dts', None),
+                                              chunk_size=rospy.get_param('~chunk_size', 16))
         self.path_cost_min = np.inf
         self.path_cost_max = -np.inf
         self.pose_step = int(0.5 / self.dphys_cfg.dt)  # publish poses with 0.2 [sec] step
@@ -43,25 +77,25 @@ class FusionForce(TerrainEncoder):
         controls_front, _ = generate_controls(n_trajs=self.dphys_cfg.n_sim_trajs // 2,
                                               v_range=(self.dphys_cfg.vel_max / 2, self.dphys_cfg.vel_max),
                                               w_range=(-self.dphys_cfg.omega_max, self.dphys_cfg.omega_max),
-                                              time_horizon=self.dphys_cfg.traj_sim_time, dt=self.dphys_cfg.dt)
+                                              time_horizon=self.dphys_cfg.traj_sim_time, dt=self.dphys_cfg.dt,
+                                              per_step=False, sampling=self.control_sampling)
         controls_back, _ = generate_controls(n_trajs=self.dphys_cfg.n_sim_trajs // 2,
                                              v_range=(-self.dphys_cfg.vel_max, -self.dphys_cfg.vel_max / 2),
                                              w_range=(-self.dphys_cfg.omega_max, self.dphys_cfg.omega_max),
-                                             time_horizon=self.dphys_cfg.traj_sim_time, dt=self.dphys_cfg.dt)
+                                             time_horizon=self.dphys_cfg.traj_sim_time, dt=self.dphys_cfg.dt,
+                                             per_step=False, sampling=self.control_sampling)
         controls = torch.cat([controls_front, controls_back], dim=0)
         return controls
 
     @timing
     def predict_paths(self, grid_maps, xyz_qs_init, frictions=None):
-        assert len(grid_maps) == len(xyz_qs_init) == self.dphys_cfg.n_sim_trajs
-        # for grid_map in grid_maps:
-        #     assert isinstance(grid_map, np.ndarray)
-        #     assert grid_map.shape[0] == grid_map.shape[1]
+        assert len(xyz_qs_init) == self.dphys_cfg.n_sim_trajs
+        # a single grid map (and friction map) is shared by all the sampled trajectories
         grid_maps = torch.as_tensor(grid_maps, dtype=torch.float32, device=self.device)
-        assert grid_maps.shape[0] == self.dphys_cfg.n_sim_trajs
+        assert grid_maps.dim() == 3 and grid_maps.shape[0] == 1
         controls = torch.as_tensor(self.controls, dtype=torch.float32, device=self.device)
-        n_sim_steps = int(self.dphys_cfg.traj_sim_time / self.dphys_cfg.dt)
-        assert controls.shape == (self.dphys_cfg.n_sim_trajs, n_sim_steps, 2)
+        # constant (v, w) for each trajectory, or piecewise-constant (v, w) held for control_dt
+        assert controls.shape[0] == self.dphys_cfg.n_sim_trajs and controls.shape[-1] == 2
 
         # initial state
         x = torch.as_tensor(xyz_qs_init[:, :3], dtype=torch.float32, device=self.device)
@@ -72,26 +106,46 @@ class FusionForce(TerrainEncoder):
         state0 = (x, xd, R, omega)
 
         # simulate trajectories
-        states, forces = self.physics_engine(grid_maps, controls=controls, state=state0, friction=frictions)
+        traj_sim_time, dt = self.dphys_cfg.traj_sim_time, self.dphys_cfg.dt
+        if self.control_optimizer is not None:
+            # the states and costs of the lowest-cost control inputs found for each trajectory
+            controls, info = self.control_optimizer.optimize(grid_maps, controls, state=state0, friction=frictions)
+            states = info['states']
+            rospy.logdebug('Control inputs optimized: %d rollouts in %.3f [sec]' % (info['n_evals'], info['time']))
+        elif self.scheduler is not None:
+            # the trajectories evaluated within the deadline
+            states, path_costs, sched_info = self.scheduler.run(grid_maps, controls, state0, friction=frictions,
+                                                                costs=self.path_costs, control_dt=self.control_dt)
+            controls, info = controls[sched_info['ids']], {'cost': path_costs}
+            # the horizon and step size adapt to the timings
+            traj_sim_time, dt = sched_info['traj_sim_time'], sched_info['dt']
+            self.pose_step = int(0.5 / dt)
+            rospy.logdebug('Scheduled rollouts: %d/%d trajectories, horizon %.1f [sec], dt %.3f [sec]'
+                           % (len(controls), sched_info['n_planned'], sched_info['traj_sim_time'], sched_info['dt']))
+        else:
+            states, forces, info = self.physics_engine(grid_maps, controls=controls, state=state0, friction=frictions,
+                                                       control_dt=self.control_dt, costs=self.path_costs,
+                                                       return_info=True)
+        if self.sampler is not None:
+            self.sampler.update(controls, info['cost'])
         Xs, Xds, Rs, Omegas = states
-        assert Xs.shape == (self.dphys_cfg.n_sim_trajs, n_sim_steps, 3)
-        assert Rs.shape == (self.dphys_cfg.n_sim_trajs, n_sim_steps, 3, 3)
+        n_trajs = len(controls)  # fewer than n_sim_trajs with the scheduler
+        n_sim_steps = int(traj_sim_time / dt)
+        assert Xs.shape == (n_trajs, n_sim_steps, 3)
+        assert Rs.shape == (n_trajs, n_sim_steps, 3, 3)
 
         # convert rotation matrices to quaternions
-        poses = torch.zeros((self.dphys_cfg.n_sim_trajs, n_sim_steps, 4, 4), device=self.device)
+        poses = torch.zeros((n_trajs, n_sim_steps, 4, 4), device=self.device)
         poses[:, :, :3, 3] = Xs
         poses[:, :, :3, :3] = Rs
         poses[:, :, 3, 3] = 1.0
         assert not torch.any(torch.isnan(poses))
 
-        # compute path costs
-        F_springs, F_frictions = forces
-        assert F_springs.shape == (self.dphys_cfg.n_sim_trajs, n_sim_steps, len(self.dphys_cfg.robot_points), 3)
-        assert F_frictions.shape == (self.dphys_cfg.n_sim_trajs, n_sim_steps, len(self.dphys_cfg.robot_points), 3)
-        path_costs = torch.norm(F_springs, dim=-1).std(dim=-1).std(dim=-1)
+        # path costs: std over time of the contact forces spread over the robot points
+        path_costs = info['cost']
         assert not torch.any(torch.isnan(path_costs))
-        assert poses.shape == (self.dphys_cfg.n_sim_trajs, n_sim_steps, 4, 4)
-        assert path_costs.shape == (self.dphys_cfg.n_sim_trajs,)
+        assert poses.shape == (n_trajs, n_sim_steps, 4, 4)
+        assert path_costs.shape == (n_trajs,)
 
         return poses, path_costs
 
@@ -153,9 +207,13 @@ class FusionForce(TerrainEncoder):
         height_terrain, friction = terrain['terrain'], terrain['friction']
         rospy.loginfo('Predicted height map shape: %s' % str(height_terrain.shape))
 
-        grid_maps = height_terrain.squeeze(1).repeat(self.dphys_cfg.n_sim_trajs, 1, 1)
-        frictions = friction.squeeze(1).repeat(self.dphys_cfg.n_sim_trajs, 1, 1)
+        grid_maps = height_terrain.squeeze(1)
+        frictions = friction.squeeze(1)
         xyz_qs_init = torch.tensor([[0., 0., 0., 0., 0., 0., 1.]]).repeat(self.dphys_cfg.n_sim_trajs, 1)
+        if self.sampler is not None:
+            # shift the sampling distribution by the time elapsed since the previous cycle
+            self.sampler.shift(msgs[0].header.stamp.to_sec())
+            self.controls = self.sampler.sample()
         xyz_qs, path_costs = self.predict_paths(grid_maps, xyz_qs_init, frictions)
 
         # update path cost bounds
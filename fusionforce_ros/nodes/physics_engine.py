@@ -9,6 +9,9 @@ import tf2_ros
 from geometry_msgs.msg import TransformStamped
 from fusionforce.models.traj_predictor.dphys_config import DPhysConfig
 from fusionforce.models.traj_predictor.dphysics import DPhysics, generate_controls
+from fusionforce.models.traj_predictor.costs import InclinationCost
+from fusionforce.models.traj_predictor.samplers import ControlSampler
+from fusionforce.models.traj_predictor.scheduler import RolloutScheduler
 from fusionforce.ros import poses_to_marker, poses_to_path, gridmap_msg_to_numpy
 from fusionforce.transformations import pose_to_xyz_q
 from nav_msgs.msg import Path
@@ -27,9 +30,11 @@ class DiffPhysBase:
                  dphys_cfg: DPhysConfig = None,
                  max_age=0.5,
                  device='cpu',
-                 dt=0.01):
+                 dt=0.01,
+                 control_sampling='random'):
         self.robot_frame = robot_frame
         self.dphys_cfg = dphys_cfg
+        self.dphys_cfg.record_forces = None  # the path costs are accumulated during the rollout
         self.gridmap_layer = gridmap_layer
         self.gridmap_frame = None
         self.gridmap_center_frame = 'grid_map_link'
@@ -38,6 +43,8 @@ class DiffPhysBase:
         self.max_age = max_age
         self.device = device
         self.n_sim_trajs = dphys_cfg.n_sim_trajs
+        self.control_sampling = control_sampling  # 'random', 'sobol', 'halton' or 'lattice', see generate_controls
+        self.sampler = None  # receding-horizon control sampler, see ControlSampler
 
         self.tf_buffer = tf2_ros.Buffer()
         self.tf_listener = tf2_ros.TransformListener(self.tf_buffer)
@@ -79,11 +86,13 @@ class DiffPhysBase:
         controls_front, _ = generate_controls(n_trajs=self.dphys_cfg.n_sim_trajs // 2,
                                               v_range=(self.dphys_cfg.vel_max / 2, self.dphys_cfg.vel_max),
                                               w_range=(-self.dphys_cfg.omega_max, self.dphys_cfg.omega_max),
-                                              time_horizon=self.dphys_cfg.traj_sim_time, dt=self.dt)
+                                              time_horizon=self.dphys_cfg.traj_sim_time, dt=self.dt,
+                                              per_step=False, sampling=self.control_sampling)
         controls_back, _ = generate_controls(n_trajs=self.dphys_cfg.n_sim_trajs // 2,
                                              v_range=(-self.dphys_cfg.vel_max, -self.dphys_cfg.vel_max / 2),
                                              w_range=(-self.dphys_cfg.omega_max, self.dphys_cfg.omega_max),
-                                             time_horizon=self.dphys_cfg.traj_sim_time, dt=self.dt)
+                                             time_horizon=self.dphys_cfg.traj_sim_time, dt=self.dt,
+                                             per_step=False, sampling=self.control_sampling)
         controls = torch.cat([controls_front, controls_back], dim=0)
         return controls
 
@@ -167,9 +176,12 @@ class DiffPhysBase:
         t1 = time()
         rospy.logdebug('Grid map preprocessing took %.3f [sec]' % (t1 - t0))
 
-        # predict path
-        grid_maps = [grid_map for _ in range(self.n_sim_trajs)]
+        # predict path: the grid map is shared by all the sampled trajectories
+        grid_maps = grid_map[np.newaxis]
         xyz_qs_init = np.repeat(robot_xyz_q_wrt_gridmap[None, :], self.n_sim_trajs, axis=0)
+        if self.sampler is not None:
+            # shift the sampling distribution by the time elapsed since the previous cycle
+            self.sampler.shift(gridmap_msg.info.header.stamp.to_sec())
         with torch.no_grad():
             t2 = time()
             xyz_qs, path_costs = self.predict_paths(grid_maps, xyz_qs_init)
@@ -210,24 +222,46 @@ class DPhysEngine(DiffPhysBase):
                  robot_frame='base_link',
                  max_age=0.5,
                  dt=0.01,
-                 device='cpu'):
+                 device='cpu',
+                 sampler=None,
+                 n_samples=None,
+                 control_dt=0.5,
+                 control_sampling='random',
+                 deadline=None,
+                 n_trajs_min=8,
+                 horizons=None,
+                 dts=None,
+                 chunk_size=16):
+        if sampler:
+            # the sampled control inputs are warm-started, a fraction of the trajectories is simulated
+            dphys_cfg.n_sim_trajs = n_samples or dphys_cfg.n_sim_trajs // 4
         super().__init__(dphys_cfg=dphys_cfg, gridmap_topic=gridmap_topic, gridmap_layer=gridmap_layer, robot_frame=robot_frame,
-                         max_age=max_age, device=device, dt=dt)
+                         max_age=max_age, device=device, dt=dt, control_sampling=control_sampling)
         self.dphysics = DPhysics(dphys_cfg, device=device)
+        self.path_costs = {'inclination': InclinationCost()}
         self.track_vels = self.init_controls()
+        self.control_dt = control_dt
+        if sampler:
+            self.sampler = ControlSampler(dphys_cfg, n_samples=self.n_sim_trajs, control_dt=control_dt,
+                                          method=sampler, device=device)
+        # anytime rollouts within the latency budget [sec], see RolloutScheduler
+        self.scheduler = None
+        if deadline is not None:
+            self.scheduler = RolloutScheduler(self.dphysics, deadline=deadline,
+                                              n_trajs_range=(n_trajs_min, self.n_sim_trajs),
+                                              horizons=horizons, dts=dts, chunk_size=chunk_size)
         # grid map subscriber
         self.gridmap_sub = rospy.Subscriber(gridmap_topic, GridMap, self.gridmap_callback)
 
     def predict_paths(self, grid_maps, xyz_qs_init):
-        assert len(grid_maps) == len(xyz_qs_init) == self.n_sim_trajs
-        # for grid_map in grid_maps:
-        #     assert isinstance(grid_map, np.ndarray)
-        #     assert grid_map.shape[0] == grid_map.shape[1]
+        assert len(xyz_qs_init) == self.n_sim_trajs
         grid_maps = torch.as_tensor(grid_maps, dtype=torch.float32, device=self.device)
-        assert grid_maps.shape[0] == self.n_sim_trajs
-        controls = torch.as_tensor(self.track_vels, dtype=torch.float32, device=self.device)
-        assert controls.shape == (self.n_sim_trajs, self.n_sim_steps, 2), \
-            f'controls shape: {controls.shape} != {(self.n_sim_trajs, self.n_sim_steps, 2)}'
+        assert grid_maps.dim() == 3 and grid_maps.shape[0] == 1
+        controls = self.track_vels if self.sampler is None else self.sampler.sample()
+        controls = torch.as_tensor(controls, dtype=torch.float32, device=self.device)
+        # constant (v, w) for each trajectory, or piecewise-constant (v, w) held for control_dt
+        assert controls.shape[0] == self.n_sim_trajs and controls.shape[-1] == 2, \
+            f'controls shape: {controls.shape} != {(self.n_sim_trajs, 2)}'
 
         # initial state
         x = torch.as_tensor(xyz_qs_init[:, :3], dtype=torch.float32, device=self.device)
@@ -238,32 +272,38 @@ class DPhysEngine(DiffPhysBase):
         state0 = (x, xd, R, omega)
 
         # simulate trajectories
-        states, forces = self.dphysics(grid_maps, controls=controls, state=state0)
+        if self.scheduler is not None:
+            # the trajectories evaluated within the deadline, the horizon and step size adapt to the timings
+            states, path_costs, sched_info = self.scheduler.run(grid_maps, controls, state0, costs=self.path_costs,
+                                                                control_dt=self.control_dt)
+            controls, info = controls[sched_info['ids']], {'cost': path_costs}
+            self.dt = sched_info['dt']
+            self.n_sim_steps = int(sched_info['traj_sim_time'] / self.dt)
+            self.pose_step = int(0.5 / self.dt)
+            rospy.logdebug('Scheduled rollouts: %d/%d trajectories, horizon %.1f [sec], dt %.3f [sec]'
+                           % (len(controls), sched_info['n_planned'], sched_info['traj_sim_time'], sched_info['dt']))
+        else:
+            states, forces, info = self.dphysics(grid_maps, controls=controls, state=state0,
+                                                 control_dt=self.control_dt, costs=self.path_costs, return_info=True)
+        if self.sampler is not None:
+            self.sampler.update(controls, info['cost'])
         Xs, Xds, Rs, Omegas = states
-        assert Xs.shape == (self.n_sim_trajs, self.n_sim_steps, 3)
-        assert Rs.shape == (self.n_sim_trajs, self.n_sim_steps, 3, 3)
+        n_trajs = len(controls)  # fewer than n_sim_trajs with the scheduler
+        assert Xs.shape == (n_trajs, self.n_sim_steps, 3)
+        assert Rs.shape == (n_trajs, self.n_sim_steps, 3, 3)
 
         # convert rotation matrices to quaternions
-        poses = torch.zeros((self.n_sim_trajs, self.n_sim_steps, 4, 4), device=self.device)
+        poses = torch.zeros((n_trajs, self.n_sim_steps, 4, 4), device=self.device)
         poses[:, :, :3, 3] = Xs
         poses[:, :, :3, :3] = Rs
         poses[:, :, 3, 3] = 1.0
         assert not torch.any(torch.isnan(poses))
 
-        # compute path costs: interaction forces-based
-        # F_normals, F_frictions = forces
-        # assert F_normals.shape == (self.n_sim_trajs, self.n_sim_steps, len(self.dphys_cfg.robot_points), 3)
-        # assert F_frictions.shape == (self.n_sim_trajs, self.n_sim_steps, len(self.dphys_cfg.robot_points), 3)
-        # path_costs = F_normals.norm(dim=-1).std(dim=-1).std(dim=-1)
-        # assert not torch.any(torch.isnan(path_costs))
-        # assert poses.shape == (self.n_sim_trajs, self.n_sim_steps, 4, 4)
-        # assert path_costs.shape == (self.n_sim_trajs,)
-
-        # compute path costs: inclination-based
-        Rs_pred = states[2].cpu().reshape(-1, 3, 3)  # (n_trajs * time_horizon, 3, 3)
-        rpy = torch.as_tensor(Rotation.from_matrix(Rs_pred).as_euler('xyz'))  # (n_trajs * time_horizon, 3)
-        roll, pitch = rpy[:, 0].reshape(self.n_sim_trajs, -1), rpy[:, 1].reshape(self.n_sim_trajs, -1)  # (n_trajs, time_horizon)
-        path_costs = roll.abs().mean(dim=-1) + pitch.abs().mean(dim=-1)  # (n_trajs,)
+        # path costs: inclination-based, accumulated during the rollout
+        # (interaction forces-based: self.path_costs = {'contact_forces': ContactForceCost()})
+        path_costs = info['cost']
+        assert not torch.any(torch.isnan(path_costs))
+        assert path_costs.shape == (n_trajs,)
 
         return poses, path_costs
 
@@ -278,13 +318,27 @@ def main():
     gridmap_layer = rospy.get_param('~gridmap_layer', 'elevation')
     max_age = rospy.get_param('~max_age', 0.5)
     device = rospy.get_param('~device', 'cuda' if torch.cuda.is_available() else 'cpu')
+    sampler = rospy.get_param('~sampler', None)  # 'mppi' or 'cem', fixed control inputs if not set
+    n_samples = rospy.get_param('~n_samples', None)
+    control_dt = rospy.get_param('~control_dt', 0.5)
+    control_sampling = rospy.get_param('~control_sampling', 'random')
+    deadline = rospy.get_param('~deadline', None)  # latency budget of the rollouts [sec], fixed rollouts if not set
 
     node = DPhysEngine(dphys_cfg=dphys_cfg,
                        robot_frame=robot_frame,
                        gridmap_topic=gridmap_topic,
                        gridmap_layer=gridmap_layer,
                        max_age=max_age,
-                       device=device)
+                       device=device,
+                       sampler=sampler,
+                       n_samples=n_samples,
+                       control_dt=control_dt,
+                       control_sampling=control_sampling,
+                       deadline=deadline,
+                       n_trajs_min=rospy.get_param('~n_trajs_min', 8),
+                       horizons=rospy.get_param('~horizons', None),
+                       dts=rospy.get_param('~dts', None),
+                       chunk_size=rospy.get_param('~chunk_size', 16))
     node.spin()
 
 